@@ -0,0 +1,135 @@
+###*********************************************************
+###*  benchmark of the assesment report generator       *###
+###*********************************************************
+
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+###
+# Runs the end to end flow of script.py against the fake audit manager of fake_auditmanager.py at several scales and
+# records the wall time, the audit manager calls and the peak memory of every scenario. Every scenario runs in its own
+# process so that the peak memory of one scenario does not hide the next one.
+#
+# usage: python3 benchmark.py [--scales small,medium] [--output results.json] [--baseline benchmark_baseline.json]
+#
+# With --baseline the run fails when a scenario makes more audit manager calls than the baseline, or is slower or
+# uses more memory than the baseline by more than --tolerance, or is missing from the baseline. Calls are deterministic, wall time and memory depend
+# on the machine the baseline was recorded on.
+###
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+# folders and evidences per folder of the synthetic assessment at every scale
+SCALES = {
+    'smoke': {'folders': 4, 'evidences': 300},
+    'small': {'folders': 20, 'evidences': 500},
+    'medium': {'folders': 60, 'evidences': 2000},
+    'large': {'folders': 200, 'evidences': 5000},
+}
+
+# script options of the benchmarked scenarios, every scenario runs at every selected scale
+SCENARIOS = {
+    # no evidence filter, every folder is associated as a whole
+    'all_evidences': ['--max_workers', '8'],
+    # filters checked per evidence, matching evidences are associated in batches
+    'filtered': ['--max_workers', '8', '--filter_automatic', 'True', '--account_Ids', '111111111111'],
+    # filtered with the evidences csv streamed to s3
+    'filtered_streamed': ['--max_workers', '8', '--filter_automatic', 'True', '--account_Ids', '111111111111', '--stream_csv', '--gzip_csv'],
+    # filtered with the evidences exported as partitioned gzipped json lines
+    'filtered_jsonl': ['--max_workers', '8', '--filter_automatic', 'True', '--account_Ids', '111111111111', '--export_format', 'jsonl'],
+}
+
+
+def run_scenario(scale, scenario, latencyMs, maxTps, directory):
+    summaryPath = os.path.join(directory, '{}-{}.json'.format(scale, scenario))
+    command = [sys.executable, os.path.join(REPOSITORY, 'fake_auditmanager.py'),
+        '--fake_folders', str(SCALES[scale]['folders']), '--fake_evidences', str(SCALES[scale]['evidences']),
+        '--fake_bucket', 'reports', '--fake_latency_ms', str(latencyMs), '--fake_summary', summaryPath, '--',
+        '--name', 'test', '--max_tps', str(maxTps)] + SCENARIOS[scenario]
+    environment = {key: value for key, value in os.environ.items() if not key.startswith('AWS_BATCH_')}
+    completed = subprocess.run(command, cwd=directory, env=environment, capture_output=True, text=True)
+    if not os.path.exists(summaryPath):
+        raise Exception("scenario {} at scale {} failed : {}".format(scenario, scale, completed.stderr[-2000:]))
+    with open(summaryPath) as summaryFile:
+        summary = json.load(summaryFile)
+    return {'scale': scale, 'scenario': scenario, 'exitCode': summary['exitCode'],
+        'evidences': SCALES[scale]['folders'] * SCALES[scale]['evidences'],
+        'wallSeconds': round(summary['wallSeconds'], 3), 'peakMemoryMb': summary['peakMemoryMb'],
+        'apiCalls': sum(summary['calls'].values()), 'calls': summary['calls']}
+
+
+# compares the results with the baseline, returns the list of regressions
+def find_regressions(results, baseline, tolerance):
+    baselineResults = {(result['scale'], result['scenario']): result for result in baseline}
+    regressions = []
+    for result in results:
+        expected = baselineResults.get((result['scale'], result['scenario']))
+        name = result['scenario'] + '@' + result['scale']
+        # a scenario without a baseline would never be checked, it has to be recorded first
+        if not expected:
+            regressions.append("{} has no baseline, record it with --output".format(name))
+            continue
+        if result['exitCode'] != 0:
+            regressions.append("{} exited with {}".format(name, result['exitCode']))
+        if result['apiCalls'] > expected['apiCalls']:
+            regressions.append("{} makes {} audit manager calls, baseline {}".format(name, result['apiCalls'], expected['apiCalls']))
+        if result['wallSeconds'] > expected['wallSeconds'] * (1 + tolerance):
+            regressions.append("{} takes {}s, baseline {}s".format(name, result['wallSeconds'], expected['wallSeconds']))
+        if result['peakMemoryMb'] and expected['peakMemoryMb'] and result['peakMemoryMb'] > expected['peakMemoryMb'] * (1 + tolerance):
+            regressions.append("{} peaks at {} MiB, baseline {} MiB".format(name, result['peakMemoryMb'], expected['peakMemoryMb']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 benchmark.py', description='benchmark of script.py against a simulated audit manager')
+    parser.add_argument('--scales', type=str, default='small,medium', help="comma seperated scales out of " + ", ".join(SCALES))
+    parser.add_argument('--scenarios', type=str, default=",".join(SCENARIOS), help="comma seperated scenarios out of " + ", ".join(SCENARIOS))
+    parser.add_argument('--latency_ms', type=float, default=20, help="simulated latency of every audit manager call, defaults to 20")
+    parser.add_argument('--max_tps', type=float, default=100, help="--max_tps of the benchmarked runs, defaults to 100")
+    parser.add_argument('--output', type=str, default=None, help="file the results are written to as JSON")
+    parser.add_argument('--baseline', type=str, default=None, help="results of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="allowed increase of wall time and memory over the baseline, defaults to 0.5")
+    options = parser.parse_args(argv)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in options.scales.split(','):
+            for scenario in options.scenarios.split(','):
+                result = run_scenario(scale, scenario, options.latency_ms, options.max_tps, directory)
+                results.append(result)
+                print("{:<20} {:<8} {:>10} evidences {:>8.2f}s {:>7} calls {:>8} MiB".format(scenario, scale, result['evidences'],
+                    result['wallSeconds'], result['apiCalls'], result['peakMemoryMb']), flush=True)
+    if options.output:
+        with open(options.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2)
+    if options.baseline:
+        with open(options.baseline) as baselineFile:
+            regressions = find_regressions(results, json.load(baselineFile), options.tolerance)
+        for regression in regressions:
+            print("regression : " + regression)
+        if regressions:
+            return 1
+    return 1 if any(result['exitCode'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,4 +9,13 @@ docker build -t script .
 docker tag script $(aws sts get-caller-identity --query 'Account' --output text).dkr.ecr.$REGION.amazonaws.com/$STACK_NAME-repository
 aws ecr get-login-password --region $REGION | docker login --username AWS --password-stdin $(aws sts get-caller-identity --query 'Account' --output text).dkr.ecr.$REGION.amazonaws.com
 docker push $(aws sts get-caller-identity --query 'Account' --output text).dkr.ecr.$REGION.amazonaws.com/$STACK_NAME-repository
-aws batch submit-job --job-name test --job-queue $STACK_NAME-queue --job-definition $STACK_NAME-BatchJobDefinition
\ No newline at end of file
+# SHARD_COUNT=<n> splits the assessment across an array job of n shards followed by a coordinator job generating the report
+if [ "${SHARD_COUNT:-1}" -gt 1 ]; then
+    RUN_ID=$(python3 -c 'import uuid; print(uuid.uuid4())')
+    SHARDS_JOB_ID=$(aws batch submit-job --job-name test-shards --job-queue $STACK_NAME-queue --job-definition $STACK_NAME-ShardJobDefinition \
+        --array-properties size=$SHARD_COUNT --parameters runid=$RUN_ID,shardcount=$SHARD_COUNT --query 'jobId' --output text)
+    aws batch submit-job --job-name test-coordinator --job-queue $STACK_NAME-queue --job-definition $STACK_NAME-CoordinatorJobDefinition \
+        --depends-on jobId=$SHARDS_JOB_ID --parameters runid=$RUN_ID,shardcount=$SHARD_COUNT
+else
+    aws batch submit-job --job-name test --job-queue $STACK_NAME-queue --job-definition $STACK_NAME-BatchJobDefinition
+fi
\ No newline at end of file
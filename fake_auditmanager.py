@@ -0,0 +1,477 @@
+###*********************************************************
+###*  fake AWS audit manager backend for local runs     *###
+###*********************************************************
+
+'''
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this
+software and associated documentation files (the "Software"), to deal in the Software
+without restriction, including without limitation the rights to use, copy, modify,
+merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+permit persons to whom the Software is furnished to do so.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+'''
+###
+# In-process fakes of the audit manager, s3 and sns clients used by script.py, to run the script without an AWS account.
+# The evidences are generated deterministically from the options below, so separate processes (e.g. the shards of a run)
+# see the same assessment. S3 objects can be kept in a local directory to share them between processes.
+#
+# Every call can be slowed down by a simulated latency and throttled at a given rate, reports move from IN_PROGRESS to
+# COMPLETE (or FAILED) after a number of status polls.
+#
+# usage: python3 fake_auditmanager.py [--fake_folders 20] [--fake_evidences 120] [--fake_s3_dir DIR] [--fake_summary FILE] -- <script.py options>
+###
+
+import argparse
+import datetime
+import io
+import json
+import os
+import sys
+import threading
+import time
+import random
+import boto3
+from botocore.exceptions import ClientError
+
+
+# raises a botocore ClientError as the real clients do
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class FakeAuditManager:
+    """
+    Audit manager client serving synthetic assessments, with the pagination and batch limits of the real API
+    """
+    MAX_RESULTS = 1000
+    MAX_EVIDENCE_IDS = 50
+
+    def __init__(self, assessments=('test',), folders=5, evidencesPerFolder=120, accountIds=('111111111111', '222222222222'),
+            manualRatio=0.25, notApplicableRatio=0.1, days=3, bucket=None, assessmentPageSize=10,
+            latency=0.0, throttleRate=0.0, reportPolls=0, failReports=False, seed=0, controls=None, noResourcesRatio=0.0,
+            dataSources=('AWS Config',)):
+        """
+        :param controls: number of controls collecting a folder every day, the compliance results of their resources change
+                         every 3 days. By default every folder has a control of its own and the folders are spread over the days
+        :param noResourcesRatio: share of the evidences without resourcesIncluded
+        :param dataSources: data sources of the folders, assigned round robin
+        :param latency: seconds every call takes
+        :param throttleRate: share of the calls rejected with a ThrottlingException
+        :param reportPolls: listings of the reports before a created report completes
+        """
+        self.assessmentPageSize = assessmentPageSize
+        self.dataSources = dataSources
+        self.bucket = bucket
+        self.latency = latency
+        self.throttleRate = throttleRate
+        self.reportPolls = reportPolls
+        self.failReports = failReports
+        self.random = random.Random(seed)
+        self.assessments = []
+        self.folders = {}
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.throttles = {}
+        self.associatedIds = {}
+        self.associatedFolders = {}
+        self.disassociatedIds = {}
+        self.disassociatedFolders = {}
+        self.reports = []
+        for assessmentIndex, name in enumerate(assessments):
+            assessmentId = 'assessment-{:04d}'.format(assessmentIndex)
+            self.assessments.append({'id': assessmentId, 'name': name, 'status': 'ACTIVE'})
+            self.folders[assessmentId] = [self.generate_folder(assessmentId, index, evidencesPerFolder, accountIds, manualRatio,
+                notApplicableRatio, days, controls, noResourcesRatio) for index in range(folders)]
+            self.associatedIds[assessmentId] = set()
+            self.associatedFolders[assessmentId] = set()
+            self.disassociatedIds[assessmentId] = set()
+            self.disassociatedFolders[assessmentId] = set()
+
+    def generate_folder(self, assessmentId, index, evidencesPerFolder, accountIds, manualRatio, notApplicableRatio, days, controls=None,
+            noResourcesRatio=0.0):
+        if controls:
+            controlIndex, day = index % controls, index // controls
+            stateIndex = day // 3
+        else:
+            controlIndex, day = index, index % max(1, days)
+            stateIndex = index
+        folderDate = datetime.datetime(2024, 1, 1) + datetime.timedelta(days=day)
+        folder = {'id': '{}-folder-{:05d}'.format(assessmentId, index), 'assessmentId': assessmentId,
+            'controlSetId': 'control-set-{}'.format(controlIndex % 2), 'controlId': 'control-{}'.format(controlIndex),
+            'name': folderDate.strftime('%Y-%m-%d'), 'date': folderDate, 'dataSource': self.dataSources[index % len(self.dataSources)],
+            'totalEvidence': evidencesPerFolder, 'assessmentReportSelectionCount': 0,
+            'accountIds': accountIds, 'manualRatio': manualRatio, 'notApplicableRatio': notApplicableRatio, 'index': index,
+            'stateIndex': stateIndex, 'noResourcesRatio': noResourcesRatio}
+        folder['evidenceByTypeManualCount'] = sum(1 for number in range(evidencesPerFolder) if self.is_manual(folder, number))
+        return folder
+
+    @staticmethod
+    def is_manual(folder, number):
+        return (number * 37 + folder['index'] * 11) % 100 < folder['manualRatio'] * 100
+
+    # evidence number of a folder, computed on demand so that large assessments need no memory
+    def generate_evidence(self, folder, number):
+        accountIds = folder['accountIds']
+        complianceCheck = 'NOT_APPLICABLE' if (number * 53 + folder['index']) % 100 < folder['notApplicableRatio'] * 100 \
+            else ('COMPLIANT', 'NON_COMPLIANT')[(number + folder['stateIndex']) % 2]
+        evidence = {'id': '{}-evidence-{:06d}'.format(folder['id'], number), 'dataSource': folder['dataSource'],
+            'evidenceAwsAccountId': accountIds[(number + folder['index']) % len(accountIds)],
+            'eventSource': 'config.amazonaws.com', 'eventName': 'rule-{}'.format(number % 7),
+            'evidenceByType': 'Manual' if self.is_manual(folder, number) else 'Compliance check',
+            'resourcesIncluded': [{'arn': 'arn:aws:s3:::bucket-{}'.format(number % 13), 'value': '{"status": "ok"}'}],
+            'attributes': {'findingId': str(number), 'rule': 'rule-{}'.format(number % 7)},
+            'complianceCheck': complianceCheck, 'evidenceFolderId': folder['id'], 'time': folder['date'],
+            'assessmentReportSelection': 'No'}
+        if (number * 29 + folder['index'] * 7) % 100 < folder['noResourcesRatio'] * 100:
+            del evidence['resourcesIncluded']
+        return evidence
+
+    def call(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            throttled = self.throttleRate and self.random.random() < self.throttleRate
+            if throttled:
+                self.throttles[operation] = self.throttles.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise client_error('ThrottlingException', operation, 'Rate exceeded')
+
+    def find_folder(self, assessmentId, evidenceFolderId):
+        for folder in self.folders.get(assessmentId, []):
+            if folder['id'] == evidenceFolderId:
+                return folder
+        raise client_error('ResourceNotFoundException', 'GetEvidenceByEvidenceFolder', evidenceFolderId)
+
+    @staticmethod
+    def page(items, maxResults, nextToken, operation):
+        if maxResults is not None and not 1 <= maxResults <= FakeAuditManager.MAX_RESULTS:
+            raise client_error('ValidationException', operation, 'maxResults must be between 1 and 1000')
+        start = int(nextToken or 0)
+        end = start + (maxResults or FakeAuditManager.MAX_RESULTS)
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    @staticmethod
+    def folder_metadata(folder):
+        return {key: value for key, value in folder.items() if key not in ('accountIds', 'manualRatio', 'notApplicableRatio', 'index', 'stateIndex',
+            'noResourcesRatio')}
+
+    def get_account_status(self):
+        self.call('get_account_status')
+        return {'status': 'ACTIVE'}
+
+    def list_assessments(self, status=None, nextToken=None, maxResults=None):
+        self.call('list_assessments')
+        assessments = [assessment for assessment in self.assessments if not status or assessment['status'] == status]
+        # pages may hold fewer items than requested, the script has to follow nextToken
+        items, token = self.page(assessments, min(maxResults or self.assessmentPageSize, self.assessmentPageSize), nextToken, 'ListAssessments')
+        response = {'assessmentMetadata': [dict(item) for item in items]}
+        if token:
+            response['nextToken'] = token
+        return response
+
+    def get_assessment(self, assessmentId):
+        self.call('get_assessment')
+        metadata = {'id': assessmentId}
+        if self.bucket:
+            metadata['assessmentReportsDestination'] = {'destinationType': 'S3', 'destination': 's3://' + self.bucket}
+        return {'assessment': {'metadata': metadata}}
+
+    def get_evidence_folders_by_assessment(self, assessmentId, maxResults=None, nextToken=None):
+        self.call('get_evidence_folders_by_assessment')
+        items, token = self.page(self.folders.get(assessmentId, []), maxResults, nextToken, 'GetEvidenceFoldersByAssessment')
+        response = {'evidenceFolders': [self.folder_metadata(folder) for folder in items]}
+        if token:
+            response['nextToken'] = token
+        return response
+
+    def get_evidence_by_evidence_folder(self, assessmentId, controlSetId, evidenceFolderId, maxResults=None, nextToken=None):
+        self.call('get_evidence_by_evidence_folder')
+        folder = self.find_folder(assessmentId, evidenceFolderId)
+        numbers, token = self.page(range(folder['totalEvidence']), maxResults, nextToken, 'GetEvidenceByEvidenceFolder')
+        response = {'evidence': [self.generate_evidence(folder, number) for number in numbers]}
+        if token:
+            response['nextToken'] = token
+        return response
+
+    def batch_associate_assessment_report_evidence(self, assessmentId, evidenceFolderId, evidenceIds):
+        self.call('batch_associate_assessment_report_evidence')
+        if len(evidenceIds) > self.MAX_EVIDENCE_IDS:
+            raise client_error('ValidationException', 'BatchAssociateAssessmentReportEvidence', 'at most 50 evidence ids')
+        with self.lock:
+            self.associatedIds[assessmentId].update(evidenceIds)
+        return {'evidenceIds': list(evidenceIds), 'errors': []}
+
+    def batch_disassociate_assessment_report_evidence(self, assessmentId, evidenceFolderId, evidenceIds):
+        self.call('batch_disassociate_assessment_report_evidence')
+        if len(evidenceIds) > self.MAX_EVIDENCE_IDS:
+            raise client_error('ValidationException', 'BatchDisassociateAssessmentReportEvidence', 'at most 50 evidence ids')
+        with self.lock:
+            self.associatedIds[assessmentId].difference_update(evidenceIds)
+            self.disassociatedIds[assessmentId].update(evidenceIds)
+        return {'evidenceIds': list(evidenceIds), 'errors': []}
+
+    # ids of every evidence of a folder, including the NOT_APPLICABLE ones
+    @staticmethod
+    def folder_evidence_ids(folder):
+        return ['{}-evidence-{:06d}'.format(folder['id'], number) for number in range(folder['totalEvidence'])]
+
+    # associating a folder associates every evidence it holds
+    def associate_assessment_report_evidence_folder(self, assessmentId, evidenceFolderId):
+        self.call('associate_assessment_report_evidence_folder')
+        folder = self.find_folder(assessmentId, evidenceFolderId)
+        with self.lock:
+            self.associatedFolders[assessmentId].add(evidenceFolderId)
+            self.associatedIds[assessmentId].update(self.folder_evidence_ids(folder))
+        return {}
+
+    def disassociate_assessment_report_evidence_folder(self, assessmentId, evidenceFolderId):
+        self.call('disassociate_assessment_report_evidence_folder')
+        folder = self.find_folder(assessmentId, evidenceFolderId)
+        with self.lock:
+            self.associatedFolders[assessmentId].discard(evidenceFolderId)
+            self.disassociatedFolders[assessmentId].add(evidenceFolderId)
+            self.associatedIds[assessmentId].difference_update(self.folder_evidence_ids(folder))
+        return {}
+
+    def create_assessment_report(self, name, assessmentId, description=None):
+        self.call('create_assessment_report')
+        with self.lock:
+            report = {'id': 'report-{:04d}'.format(len(self.reports)), 'name': name, 'assessmentId': assessmentId,
+                'status': 'IN_PROGRESS', 'pollsRemaining': self.reportPolls}
+            self.complete_report(report)
+            self.reports.append(report)
+        return {'assessmentReport': dict(report)}
+
+    def complete_report(self, report):
+        if report['status'] == 'IN_PROGRESS' and report['pollsRemaining'] <= 0:
+            report['status'] = 'FAILED' if self.failReports else 'COMPLETE'
+
+    def list_assessment_reports(self, maxResults=None, nextToken=None):
+        self.call('list_assessment_reports')
+        with self.lock:
+            for report in self.reports:
+                report['pollsRemaining'] -= 1
+                self.complete_report(report)
+        items, token = self.page(self.reports, maxResults, nextToken, 'ListAssessmentReports')
+        response = {'assessmentReports': [{key: value for key, value in item.items() if key != 'pollsRemaining'} for item in items]}
+        if token:
+            response['nextToken'] = token
+        return response
+
+    def get_assessment_report_url(self, assessmentReportId, assessmentId):
+        self.call('get_assessment_report_url')
+        return {'preSignedUrl': {'link': 'https://example.com/' + assessmentReportId, 'expirationTime': None}}
+
+    # state of the fake after a run, used by the tests to check what the script did
+    def summary(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'throttles': dict(self.throttles),
+                'associatedIds': {assessmentId: sorted(ids) for assessmentId, ids in self.associatedIds.items()},
+                'associatedFolders': {assessmentId: sorted(ids) for assessmentId, ids in self.associatedFolders.items()},
+                'disassociatedIds': {assessmentId: sorted(ids) for assessmentId, ids in self.disassociatedIds.items()},
+                'disassociatedFolders': {assessmentId: sorted(ids) for assessmentId, ids in self.disassociatedFolders.items()},
+                'reports': [dict(report) for report in self.reports]}
+
+
+class FakeS3:
+    """
+    S3 client keeping objects in memory, or as files under a local directory so that several processes share them
+    """
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def path(self, bucket, key):
+        return os.path.join(self.directory, bucket, *key.split('/'))
+
+    def store(self, bucket, key, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        elif not isinstance(body, (bytes, bytearray)):
+            body = body.read()
+        if not self.directory:
+            with self.lock:
+                self.objects[(bucket, key)] = bytes(body)
+            return
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as objectFile:
+            objectFile.write(body)
+        os.replace(path + '.tmp', path)
+
+    def load(self, bucket, key):
+        if not self.directory:
+            with self.lock:
+                if (bucket, key) in self.objects:
+                    return self.objects[(bucket, key)]
+        elif os.path.isfile(self.path(bucket, key)):
+            with open(self.path(bucket, key), 'rb') as objectFile:
+                return objectFile.read()
+        raise client_error('NoSuchKey', 'GetObject', key)
+
+    def keys(self, bucket):
+        if not self.directory:
+            with self.lock:
+                return sorted(key for objectBucket, key in self.objects if objectBucket == bucket)
+        root = os.path.join(self.directory, bucket)
+        keys = []
+        for directory, _, fileNames in os.walk(root):
+            for fileName in fileNames:
+                if not fileName.endswith('.tmp'):
+                    keys.append(os.path.relpath(os.path.join(directory, fileName), root).replace(os.sep, '/'))
+        return sorted(keys)
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self.store(Bucket, Key, Body)
+        return {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        return {'Body': io.BytesIO(self.load(Bucket, Key))}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        if not self.directory:
+            with self.lock:
+                self.objects.pop((Bucket, Key), None)
+        elif os.path.isfile(self.path(Bucket, Key)):
+            os.remove(self.path(Bucket, Key))
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for item in Delete['Objects']:
+            self.delete_object(Bucket, item['Key'])
+        return {}
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs=None, **kwargs):
+        self.store(Bucket, Key, self.load(CopySource['Bucket'], CopySource['Key']))
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, **kwargs):
+        self.store(Bucket, Key, Fileobj)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        Fileobj.write(self.load(Bucket, Key))
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        return {'Contents': [{'Key': key} for key in self.keys(Bucket) if key.startswith(Prefix)]}
+
+    def get_paginator(self, operation):
+        fakeS3 = self
+        class Paginator:
+            def paginate(self, **kwargs):
+                return iter([getattr(fakeS3, operation)(**kwargs)])
+        return Paginator()
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        with self.lock:
+            uploadId = 'upload-{}'.format(len(self.uploads) + 1)
+            self.uploads[uploadId] = {'bucket': Bucket, 'key': Key, 'parts': {}, 'kwargs': kwargs}
+        return {'UploadId': uploadId}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        with self.lock:
+            if UploadId not in self.uploads:
+                raise client_error('NoSuchUpload', 'UploadPart', UploadId)
+            self.uploads[UploadId]['parts'][PartNumber] = bytes(Body)
+        return {'ETag': '"etag-{}"'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self.lock:
+            upload = self.uploads.pop(UploadId)
+        parts = [upload['parts'][part['PartNumber']] for part in MultipartUpload['Parts']]
+        # every part except the last one has to be at least 5 MiB
+        if any(len(part) < self.MIN_PART_SIZE for part in parts[:-1]):
+            raise client_error('EntityTooSmall', 'CompleteMultipartUpload')
+        self.store(Bucket, Key, b''.join(parts))
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+class FakeSns:
+    """
+    SNS client recording the published messages
+    """
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn, Message, Subject=None):
+        self.messages.append({'TopicArn': TopicArn, 'Subject': Subject, 'Message': Message})
+        return {'MessageId': str(len(self.messages))}
+
+
+# runs script.py with the given options against the fakes, boto3 clients created by the script are replaced by them
+# returns the exit code of the script
+def run_script(scriptArgs, fakeAuditManager, fakeS3=None, fakeSns=None):
+    fakeS3 = fakeS3 or FakeS3()
+    fakeSns = fakeSns or FakeSns()
+    fakeClients = {'auditmanager': fakeAuditManager, 's3': fakeS3, 'sns': fakeSns}
+    boto3.client = lambda service, *args, **kwargs: fakeClients[service]
+    # the script only creates its client when credentials are found
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'fake')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'fake')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import script
+    try:
+        return script.main(list(scriptArgs)) or 0
+    except SystemExit as exit:
+        # options rejected by argparse
+        return exit.code or 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 fake_auditmanager.py', usage='%(prog)s [fake options] -- [script.py options]')
+    parser.add_argument('--fake_assessments', type=str, default='test', help="comma seperated assessment names")
+    parser.add_argument('--fake_folders', type=int, default=5, help="evidence folders per assessment")
+    parser.add_argument('--fake_evidences', type=int, default=120, help="evidences per evidence folder")
+    parser.add_argument('--fake_controls', type=int, default=None, help="controls collecting a folder every day, defaults to a control per folder")
+    parser.add_argument('--fake_accounts', type=str, default='111111111111,222222222222', help="comma seperated account ids of the evidences")
+    parser.add_argument('--fake_manual_ratio', type=float, default=0.25, help="share of manual evidences")
+    parser.add_argument('--fake_no_resources_ratio', type=float, default=0, help="share of the evidences without resources")
+    parser.add_argument('--fake_bucket', type=str, default=None, help="report destination bucket of the assessments")
+    parser.add_argument('--fake_latency_ms', type=float, default=0, help="milliseconds every audit manager call takes")
+    parser.add_argument('--fake_throttle_rate', type=float, default=0, help="share of the audit manager calls which are throttled")
+    parser.add_argument('--fake_report_polls', type=int, default=0, help="report listings before a created report completes")
+    parser.add_argument('--fake_fail_reports', action='store_true', default=False, help="created reports fail instead of completing")
+    parser.add_argument('--fake_s3_dir', type=str, default=None, help="local directory holding the objects of the fake s3")
+    parser.add_argument('--fake_summary', type=str, default=None, help="file the state of the fake is written to after the run")
+    argv = sys.argv[1:]
+    scriptArgs = []
+    if '--' in argv:
+        scriptArgs = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    options = parser.parse_args(argv)
+    fakeAuditManager = FakeAuditManager(assessments=options.fake_assessments.split(','), folders=options.fake_folders,
+        evidencesPerFolder=options.fake_evidences, accountIds=options.fake_accounts.split(','),
+        manualRatio=options.fake_manual_ratio, bucket=options.fake_bucket, latency=options.fake_latency_ms / 1000,
+        throttleRate=options.fake_throttle_rate, reportPolls=options.fake_report_polls, failReports=options.fake_fail_reports,
+        controls=options.fake_controls, noResourcesRatio=options.fake_no_resources_ratio)
+    fakeSns = FakeSns()
+    started = time.monotonic()
+    exitCode = run_script(scriptArgs, fakeAuditManager, FakeS3(options.fake_s3_dir), fakeSns)
+    wallSeconds = time.monotonic() - started
+    if options.fake_summary:
+        import script
+        with open(options.fake_summary, 'w') as summaryFile:
+            json.dump(dict(fakeAuditManager.summary(), exitCode=exitCode, messages=fakeSns.messages, wallSeconds=wallSeconds,
+                peakMemoryMb=script.peak_memory_mb()), summaryFile, default=str)
+    return exitCode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
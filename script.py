@@ -27,8 +27,49 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 # 2. filterAutomatic(Boolean)   : (optional) if set to 'True' excludes manual evidence from the assesment report, defaults to 'False'.
 # 3. AccountIds(String)         : (optional) comma seperated AWS Accounts ids for which the report is to be generated, defaults to None
 # 4. filterLatest(Boolean)      : (optional) if set to 'True' associates only lastest evidences to the assesment report, defaults to 'False'
+# 5. maxWorkers(Integer)        : (optional) number of evidence folders processed concurrently, defaults to 1
+# 6. associationWorkers(Integer): (optional) number of evidence batches associated concurrently per run, defaults to 4
+# 7. streamCsv(Boolean)         : (optional) streams the evidences csv to S3 in multipart chunks as folders complete, defaults to 'False'
+# 8. gzipCsv(Boolean)           : (optional) gzip compresses the streamed evidences csv, defaults to 'False'
+# 9. checkpoint(String)         : (optional) local directory or s3://bucket/prefix used to journal the progress of the run
+# 10. runId(String)             : (optional) identifier of the run in the checkpoint, defaults to the AWS Batch job id
+# 11. resume(Boolean)           : (optional) continues a run from its checkpoint instead of starting over, defaults to 'False'
+# 12. maxTps(Float)             : (optional) maximum calls per second for each audit manager API, lowered automatically on throttling, defaults to 10
+# 13. fromDate/toDate(String)   : (optional) YYYY-MM-DD range of evidence folder dates to include, defaults to None
+# 14. controlSetIds(String)     : (optional) comma seperated control set ids to include, defaults to None
+# 15. dataSources(String)       : (optional) comma seperated evidence data sources to include, defaults to None
+# 16. complianceStatus(String)  : (optional) comma seperated compliance check results to include, defaults to None
+# 17. reportTimeout(Integer)    : (optional) seconds to wait for the report to be generated, defaults to 900
+# 18. pendingReports(String)    : (optional) local directory or s3://bucket/prefix where reports still being generated are recorded
+# 19. detach(Boolean)           : (optional) records the report as pending instead of waiting for it, defaults to 'False'
+# 20. completePending(Boolean)  : (optional) publishes the urls of completed pending reports without collecting evidences, defaults to 'False'
+# 21. manifest(String)          : (optional) local path or s3://bucket/key of a JSON list or JSON lines file of assessments to report on in one run,
+#                                 every entry takes a 'name' and optionally the filters 2-4 and 13-16 and 'sns_topic', named after their command line flags
+# 22. shardCount(Integer)       : (optional) splits the evidence folders of the assessment across this many shards, e.g. the jobs of an AWS Batch array job
+# 23. shardIndex(Integer)       : (optional) shard processed by this run, defaults to AWS_BATCH_JOB_ARRAY_INDEX
+# 24. shardOutput(String)       : (optional) local directory or s3://bucket/prefix where the shards write their partial evidences csv
+# 25. coordinate(Boolean)       : (optional) merges the partial csvs once every shard has succeeded and generates the report, defaults to 'False'
+# 26. assessmentCache(String)   : (optional) local file or s3://bucket/key caching the assessment name to id and report bucket index between runs
+# 27. assessmentCacheTtl(Integer): (optional) seconds the cached assessment index is used before it is rebuilt, defaults to 86400
+# 28. metricsFormat(String)     : (optional) 'json' logs the run metrics as JSON, 'emf' prints them in CloudWatch embedded metric format, defaults to 'json'
+# 29. profile(Boolean)          : (optional) times every stage of the run and logs the slowest functions, defaults to 'False'
+# 30. memoryBudget(Integer)     : (optional) MiB of evidences held in memory per assessment before they are spilled to a temporary file, defaults to None (unbounded)
+# 31. exportFormat(String)      : (optional) 'csv' exports the evidences as one csv, 'jsonl' as gzipped JSON lines partitioned by account id and evidence date
+#                                 for Athena, defaults to 'csv'
+# 32. plan(Boolean)             : (optional) estimates the api calls and wall time of the run from the evidence folder metadata and picks the
+#                                 worker counts, without retrieving evidences or generating reports, defaults to 'False'
+# 33. planOutput(String)        : (optional) local path or s3://bucket/key the plan is written to as JSON
+# 34. fromPlan(String)          : (optional) local path or s3://bucket/key of a plan whose folder associations and worker counts the run follows
+# 35. dedup(String)             : (optional) 'latest' keeps the most recent evidence of every control, resource, data source and compliance result,
+#                                 'changes' the first evidence after every change of the compliance result, defaults to None (all evidences)
+# 36. sync(String)              : (optional) local directory or s3://bucket/prefix recording the evidences associated to the reports of every assessment:
+#                                 only folders collected since the last sync are retrieved again, and only the evidences added or removed since
+#                                 then are associated or disassociated, defaults to None (every folder is retrieved and associated)
 
 # By default this script generates the assessment report with 'ALL' evidences.
+# Besides the command line, the script can be imported: generate_assessment_reports(parse_options([...options...])) returns the outcome
+# of every assessment, and lambda_handler(event, context) runs it as an AWS Lambda function or long-lived worker with the options
+# given in the event, e.g. {"name": "my assessment", "detach": true, "pending_reports": "s3://bucket/pending"}
 # The Assesment report post generation would be generated and uploaded along with the evidences in the S3 bucket specified during the assesment creation
 
 # Note:- once an assessment is created, Audit Manager continuously collects evidence across the selected resources in 1 or more AWS accounts.
@@ -36,6 +77,9 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 # IAM Permissions required to execute the script:
 #    auditmanager:BatchAssociateAssessmentReportEvidence
+#    auditmanager:BatchDisassociateAssessmentReportEvidence
+#    auditmanager:AssociateAssessmentReportEvidenceFolder
+#    auditmanager:DisassociateAssessmentReportEvidenceFolder
 #    auditmanager:ListAssessments
 #    auditmanager:GetAssessmentReportUrl
 #    auditmanager:GetEvidenceByEvidenceFolder
@@ -49,6 +93,7 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #    s3:DeleteObject
 #    s3:GetBucketLocation
 #    s3:PutObjectAcl
+#    s3:AbortMultipartUpload
 #    sns:publish
 # optional(if S3 bucket is enrypted)
 #    kms:Decrypt
@@ -66,19 +111,45 @@ import uuid
 import argparse
 import time
 import json
+import datetime
 import sys
 import io
+import os
 import csv
-from botocore.exceptions import InvalidRegionError
+import zlib
+import tempfile
+import shutil
+import operator
+import threading
+import random
+import collections
+import itertools
+import math
+import contextlib
+import cProfile
+import pstats
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.config import Config
+from botocore.exceptions import InvalidRegionError, ClientError, ConnectionError, HTTPClientError
+try:
+    # peak memory of the run, not available on windows
+    import resource
+except ImportError:
+    resource = None
+
 
+LOGGER = logging.getLogger(__name__)
 
-#setting logger
-LOGGER = logging.getLogger()
-syslog = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s %(name)s : %(message)s')
-syslog.setFormatter(formatter)
-LOGGER.setLevel(logging.INFO)
-LOGGER.addHandler(syslog)
+#setting logger, only when run as a script or lambda function, an importing application configures logging itself
+def configure_logging():
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+    # the lambda runtime installs its own handler
+    if not rootLogger.handlers:
+        syslog = logging.StreamHandler()
+        formatter = logging.Formatter('%(asctime)s %(name)s : %(message)s')
+        syslog.setFormatter(formatter)
+        rootLogger.addHandler(syslog)
 
 ##**********************************MANUAL CONFIG*********************************************************************##
 
@@ -93,98 +164,1051 @@ REGION=None
 AWS_ACCESS_KEY_ID=None
 AWS_SECRET_ACCESS_KEY=None
 
+# maximum number of pooled HTTP connections per client, --max_workers plus --association_workers may not exceed it
+MAX_POOL_CONNECTIONS=50
+
+# max number of evidence ids allowed by the batch association API
+MAX_EVIDENCE_IDS_PER_BATCH=50
+
+# folders with up to this many evidences are checked for a whole folder association: their batches are held back
+# until the folder is known to match completely. Larger folders are associated in batches while they are fetched,
+# trading the single folder level call for overlapping fetch and association.
+MAX_WHOLE_FOLDER_EVIDENCES=5000
+
+# retries of throttled or failed audit manager calls are handled by the rate limited client below,
+# botocore's own retries are disabled so that every throttle is seen by the rate limiter
+CLIENT_CONFIG=Config(max_pool_connections=MAX_POOL_CONNECTIONS, retries={'total_max_attempts': 1, 'mode': 'standard'})
+
 ##*******************************************************************************************************************##
 
-# initializing audit manager client
-try:
-    # check for active credentials
-    if boto3.session.Session().get_credentials() is None:
-        LOGGER.error("boto3 was unable to get credentials from the environment")
-        LOGGER.info("falling back to manual credentials")
-        LOGGER.info('checking if credentials are provided in MANUAL CONFIG section of the script')   
-        if REGION and AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
-            LOGGER.info('locally populated credentials found, attempting to instantiate boto3 client')
-            client = boto3.client('auditmanager',region_name=REGION,
-                aws_access_key_id = AWS_ACCESS_KEY_ID , aws_secret_access_key= AWS_SECRET_ACCESS_KEY )
-            LOGGER.info('client creation complete')
-        else:
-            LOGGER.error("value(s) of : REGION, AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY  are missing")
-            
-    elif REGION:
-        client = boto3.client('auditmanager',region_name=REGION)
-    else:
-        client = boto3.client('auditmanager')
-except InvalidRegionError as invalidRegion:
-    LOGGER.error(invalidRegion)
-    LOGGER.error("please ensure the correct region is configured")
-    LOGGER.error("exiting the program")
-    #sys.exit(1)
-except Exception as error:
-    LOGGER.error(error)
-    LOGGER.error("exiting the program")
-    raise Exception("boto3 client instantiation failed")
+# clients of the aws services, created on first use and kept for the lifetime of the process: the threads and assessments
+# of a run, and the warm invocations of a long-lived worker or lambda, share their resolved credentials and pooled connections
+awsClients = {}
+awsClientsLock = threading.Lock()
+
+# returns the pooled audit manager client, None if it cannot be instantiated in the configured region
+def get_audit_manager_client():
+    with awsClientsLock:
+        if 'auditmanager' in awsClients:
+            return awsClients['auditmanager']
+        auditManagerClient = None
+        try:
+            # check for active credentials
+            if boto3.session.Session().get_credentials() is None:
+                LOGGER.error("boto3 was unable to get credentials from the environment")
+                LOGGER.info("falling back to manual credentials")
+                LOGGER.info('checking if credentials are provided in MANUAL CONFIG section of the script')   
+                if REGION and AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
+                    LOGGER.info('locally populated credentials found, attempting to instantiate boto3 client')
+                    auditManagerClient = boto3.client('auditmanager',region_name=REGION,
+                        aws_access_key_id = AWS_ACCESS_KEY_ID , aws_secret_access_key= AWS_SECRET_ACCESS_KEY,
+                        config=CLIENT_CONFIG)
+                    LOGGER.info('client creation complete')
+                else:
+                    LOGGER.error("value(s) of : REGION, AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY  are missing")
+                    
+            elif REGION:
+                auditManagerClient = boto3.client('auditmanager',region_name=REGION,config=CLIENT_CONFIG)
+            else:
+                auditManagerClient = boto3.client('auditmanager',config=CLIENT_CONFIG)
+        except InvalidRegionError as invalidRegion:
+            LOGGER.error(invalidRegion)
+            LOGGER.error("please ensure the correct region is configured")
+            LOGGER.error("exiting the program")
+            return None
+        except Exception as error:
+            LOGGER.error(error)
+            LOGGER.error("exiting the program")
+            raise Exception("boto3 client instantiation failed")
+        if auditManagerClient:
+            awsClients['auditmanager'] = auditManagerClient
+        return auditManagerClient
     
 
+#################################rate limiting#################################
+
+# error codes returned by audit manager when a call is throttled
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded', 'Throttling'}
+# error codes of transient failures which are safe to retry
+TRANSIENT_ERROR_CODES = {'InternalServerException', 'ServiceUnavailableException', 'ServiceUnavailable', 'InternalFailure'}
+# per item error codes of batch calls which are worth retrying, any other item error is permanent
+RETRYABLE_ITEM_ERROR_CODES = THROTTLING_ERROR_CODES | TRANSIENT_ERROR_CODES | {'429', '500', '502', '503', '504'}
+
+
+class AdaptiveTokenBucket:
+    """
+    Token bucket whose rate increases additively while calls succeed and is halved on every throttle
+    """
+    def __init__(self, maxRate, minRate=0.5, increaseStep=0.1):
+        self.maxRate = maxRate
+        self.minRate = min(minRate, maxRate)
+        self.increaseStep = increaseStep
+        self.rate = maxRate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # reserve the token up front, concurrent callers queue up behind each other
+            self.tokens -= 1
+            waitTime = -self.tokens / self.rate if self.tokens < 0 else 0
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.increaseStep)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.minRate, self.rate / 2)
+
+
+class RateLimitedClient:
+    """
+    Wraps a boto3 client, paces every operation with its own adaptive token bucket
+    and retries throttled and transient failures with exponential backoff and jitter.
+    Batch association calls are retried for the evidence ids which failed with a retryable error only.
+    """
+    # operations returning per item errors for the evidence ids sent in the request
+    BATCH_OPERATIONS = {'batch_associate_assessment_report_evidence', 'batch_disassociate_assessment_report_evidence'}
+    # operations which may have taken effect when the response is lost or the server fails,
+    # they are only retried when throttled since a throttled request is never executed
+    NON_IDEMPOTENT_OPERATIONS = {'create_assessment_report'}
+    # upper bounds in milliseconds of the latency histogram buckets
+    LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, client, maxRate, maxAttempts=8, baseDelay=0.5, maxDelay=20):
+        self.client = client
+        self.maxRate = maxRate
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.buckets = {}
+        self.counters = collections.Counter()
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        operation = getattr(self.client, name)
+        if not callable(operation) or name.startswith('get_paginator') or name.startswith('can_paginate'):
+            return operation
+        if name in self.BATCH_OPERATIONS:
+            return lambda **kwargs: self.call_batch(name, operation, kwargs)
+        return lambda **kwargs: self.call(name, operation, kwargs)
+
+    def count(self, name, counter, value=1):
+        with self.lock:
+            self.counters[(name, counter)] += value
+
+    def observe_latency(self, name, seconds):
+        milliseconds = seconds * 1000
+        with self.lock:
+            histogram = self.latencies.setdefault(name, [0] * (len(self.LATENCY_BUCKETS_MS) + 1))
+            for index, bound in enumerate(self.LATENCY_BUCKETS_MS):
+                if milliseconds <= bound:
+                    histogram[index] += 1
+                    break
+            else:
+                histogram[-1] += 1
+            self.counters[(name, 'latency_ms_total')] += milliseconds
+            self.counters[(name, 'latency_ms_max')] = max(self.counters[(name, 'latency_ms_max')], milliseconds)
+
+    def bucket(self, name):
+        with self.lock:
+            if name not in self.buckets:
+                self.buckets[name] = AdaptiveTokenBucket(self.maxRate)
+            return self.buckets[name]
+
+    def backoff(self, attempt):
+        # full jitter
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * (2 ** attempt)))
+
+    def call(self, name, operation, kwargs):
+        bucket = self.bucket(name)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            self.count(name, 'calls')
+            started = time.monotonic()
+            try:
+                response = operation(**kwargs)
+                self.observe_latency(name, time.monotonic() - started)
+                bucket.on_success()
+                return response
+            except ClientError as error:
+                self.observe_latency(name, time.monotonic() - started)
+                code = error.response.get('Error', {}).get('Code')
+                if code in THROTTLING_ERROR_CODES:
+                    self.count(name, 'throttles')
+                    bucket.on_throttle()
+                elif code not in TRANSIENT_ERROR_CODES or name in self.NON_IDEMPOTENT_OPERATIONS:
+                    raise
+                if attempt + 1 >= self.maxAttempts:
+                    raise
+            except (ConnectionError, HTTPClientError):
+                if name in self.NON_IDEMPOTENT_OPERATIONS or attempt + 1 >= self.maxAttempts:
+                    raise
+            self.count(name, 'retries')
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def call_batch(self, name, operation, kwargs):
+        pendingIds = list(kwargs['evidenceIds'])
+        succeededIds = []
+        for attempt in range(self.maxAttempts):
+            response = self.call(name, operation, dict(kwargs, evidenceIds=pendingIds))
+            errors = response.get('errors') or []
+            failedIdSet = set(error['evidenceId'] for error in errors)
+            succeededIds.extend(evidenceId for evidenceId in pendingIds if evidenceId not in failedIdSet)
+            if not errors:
+                return {'evidenceIds': succeededIds, 'errors': []}
+            self.count(name, 'failed_items', len(errors))
+            permanentErrors = [error for error in errors if str(error.get('errorCode')) not in RETRYABLE_ITEM_ERROR_CODES]
+            if permanentErrors or attempt + 1 >= self.maxAttempts:
+                break
+            LOGGER.info("{} of {} evidences failed in {}, retrying them".format(len(errors), len(pendingIds), name))
+            pendingIds = [error['evidenceId'] for error in errors]
+            time.sleep(self.backoff(attempt))
+        raise Exception("{} failed for evidences {} : {}".format(name, ", ".join(error['evidenceId'] for error in errors),
+            "; ".join(str(error.get('errorCode')) + " " + str(error.get('errorMessage')) for error in errors)))
+
+    def statistics(self):
+        with self.lock:
+            statistics = {}
+            for (name, counter), value in sorted(self.counters.items()):
+                statistics.setdefault(name, {})[counter] = round(value, 1) if isinstance(value, float) else value
+            for name, histogram in self.latencies.items():
+                bounds = ['<=' + str(bound) for bound in self.LATENCY_BUCKETS_MS] + ['>' + str(self.LATENCY_BUCKETS_MS[-1])]
+                statistics[name]['latency_ms_histogram'] = {bound: count for bound, count in zip(bounds, histogram) if count}
+            return statistics
+
+
+class RunMetrics:
+    """
+    Counters of the evidence pipeline and the duration of the stages of a run, updated by the worker threads
+    """
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.stages = {}
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    # adds the counters of another metrics, e.g. of an assessment to the totals of the run
+    def merge(self, metrics):
+        with metrics.lock:
+            counters = dict(metrics.counters)
+        with self.lock:
+            self.counters.update(counters)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + time.monotonic() - started
+
+    def summary(self):
+        with self.lock:
+            summary = dict(sorted(self.counters.items()))
+            elapsed = time.monotonic() - self.started
+            processingTime = self.stages.get('process_folders', elapsed)
+        summary['elapsed_seconds'] = round(elapsed, 3)
+        if summary.get('folders_processed') and processingTime > 0:
+            summary['folders_per_second'] = round(summary['folders_processed'] / processingTime, 2)
+        return summary
+
+    def stage_summary(self):
+        with self.lock:
+            return {name: round(seconds, 3) for name, seconds in self.stages.items()}
+
+
+# peak resident memory of the process in MiB, None where it cannot be measured
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+#################################evidence filters#################################
+
+# parses boolean command line values such as 'True' / 'False'
+def str_to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if value.strip().lower() in ('true', 'yes', '1'):
+        return True
+    if value.strip().lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError("boolean value expected, got " + value)
+
+# splits a comma seperated command line value, 'EMPTY' or an empty value means no filter
+def split_filter_values(value):
+    if not value or value == 'EMPTY':
+        return None
+    values = [item.strip() for item in value.split(',') if item.strip()]
+    return values or None
+
+# date of an evidence folder, folders are created per day
+def evidence_folder_date(evidenceFolder):
+    if isinstance(evidenceFolder.get('date'), datetime.datetime):
+        return evidenceFolder['date'].date()
+    return datetime.date.fromisoformat(str(evidenceFolder.get('date') or evidenceFolder['name'])[:10])
+
+
+class EvidenceFilter:
+    """
+    Compiles the report filters into a single evidence predicate and decides from evidence folder
+    metadata which folders can be skipped without retrieving their evidences.
+    Date range and control set are properties of the folder, account, type, data source and
+    compliance status are checked for every evidence.
+    """
+    def __init__(self, accountIds=None, automaticOnly=False, fromDate=None, toDate=None,
+            controlSetIds=None, dataSources=None, complianceStatuses=None):
+        self.accountIds = frozenset(accountIds) if accountIds else None
+        self.automaticOnly = automaticOnly
+        self.fromDate = fromDate
+        self.toDate = toDate
+        self.controlSetIds = frozenset(controlSetIds) if controlSetIds else None
+        self.dataSources = frozenset(source.lower() for source in dataSources) if dataSources else None
+        self.complianceStatuses = frozenset(status.upper() for status in complianceStatuses) if complianceStatuses else None
+        self.predicate = self.compile()
+
+    # true if evidences have to be inspected one by one, otherwise whole folders can be associated
+    def has_evidence_predicates(self):
+        return bool(self.accountIds or self.automaticOnly or self.dataSources or self.complianceStatuses)
+
+    def compile(self):
+        checks = []
+        if self.accountIds:
+            accountIds = self.accountIds
+            checks.append(lambda evidence: evidence['evidenceAwsAccountId'] in accountIds)
+        if self.automaticOnly:
+            checks.append(lambda evidence: bool(evidence['evidenceByType']) and evidence['evidenceByType'] != 'Manual')
+        if self.dataSources:
+            dataSources = self.dataSources
+            checks.append(lambda evidence: (evidence.get('dataSource') or '').lower() in dataSources)
+        if self.complianceStatuses:
+            complianceStatuses = self.complianceStatuses
+            checks.append(lambda evidence: (evidence.get('complianceCheck') or '').upper() in complianceStatuses)
+        if not checks:
+            return lambda evidence: True
+        if len(checks) == 1:
+            return checks[0]
+        return lambda evidence: all(check(evidence) for check in checks)
+
+    # folder level filters which select the folders in scope of the report
+    def folder_in_scope(self, evidenceFolder):
+        if self.controlSetIds and evidenceFolder.get('controlSetId') not in self.controlSetIds:
+            return False
+        if self.fromDate or self.toDate:
+            folderDate = evidence_folder_date(evidenceFolder)
+            if self.fromDate and folderDate < self.fromDate:
+                return False
+            if self.toDate and folderDate > self.toDate:
+                return False
+        if self.dataSources and evidenceFolder.get('dataSource') and evidenceFolder['dataSource'].lower() not in self.dataSources:
+            return False
+        return True
+
+    # false if the folder metadata proves that none of its evidences can match the evidence predicates
+    def folder_may_match(self, evidenceFolder):
+        if not self.has_evidence_predicates():
+            return True
+        totalEvidence = evidenceFolder.get('totalEvidence')
+        if totalEvidence == 0:
+            return False
+        if self.automaticOnly and totalEvidence is not None and evidenceFolder.get('evidenceByTypeManualCount') == totalEvidence:
+            return False
+        return True
+
+    # false if the folder metadata proves that some of its evidences do not match the evidence predicates
+    def folder_may_fully_match(self, evidenceFolder):
+        if self.automaticOnly and evidenceFolder.get('evidenceByTypeManualCount'):
+            return False
+        return True
+
+    def apply(self, evidences):
+        predicate = self.predicate
+        return [evidence for evidence in evidences if predicate(evidence)]
+
+    def describe(self):
+        return str({'accountIds': sorted(self.accountIds) if self.accountIds else None, 'automaticOnly': self.automaticOnly,
+            'fromDate': str(self.fromDate) if self.fromDate else None, 'toDate': str(self.toDate) if self.toDate else None,
+            'controlSetIds': sorted(self.controlSetIds) if self.controlSetIds else None,
+            'dataSources': sorted(self.dataSources) if self.dataSources else None,
+            'complianceStatuses': sorted(self.complianceStatuses) if self.complianceStatuses else None})
+
+
+#################################report runs#################################
+
+class ReportRun:
+    """
+    State of the report generation for one assessment. The assessments of a manifest share the settings, the client,
+    the rate limiter and the worker pools, everything specific to an assessment is kept here
+    """
+    def __init__(self, settings, name, evidenceFilter, filterLatest=False, snsTopic=None, dedupMode=None):
+        self.settings = settings
+        self.name = name
+        self.evidenceFilter = evidenceFilter
+        self.filterLatest = filterLatest
+        self.snsTopic = snsTopic
+        self.dedupMode = dedupMode
+        # set for de-duplicated runs once their folders are known
+        self.deduplicator = None
+        self.assessmentId = None
+        self.bucketName = None
+        self.evidenceFolders = []
+        # evidences exported to the csv, or the s3 stream they are written to
+        self.csvEvidenceSpool = EvidenceSpool(settings.memoryBudget)
+        self.csvEvidenceStream = None
+        self.csvEvidenceLock = threading.Lock()
+        # set with --export_format jsonl, the evidences are written to it instead
+        self.evidenceJsonl = None
+        self.stagingPath = None
+        # set when a checkpoint location is provided
+        self.checkpointStore = None
+        self.checkpointState = None
+        # set with --sync, the evidences associated by the last sync of the assessment and the folders recorded for the next one
+        self.syncState = None
+        # folders associated as a whole by this run, recorded as such in the checkpoint and the sync state
+        self.folderAssociations = set()
+        self.folderErrors = []
+        # summaries of the shards merged by the coordinator
+        self.shardSummaries = []
+        self.metrics = RunMetrics()
+        self.reportId = None
+        # 'ERROR' if no report was generated, 'SHARD_COMPLETE' once a shard has written its partial csv,
+        # otherwise the report status 'COMPLETE', 'FAILED' or 'PENDING'
+        self.status = None
+        self.error = None
+
+    # marks the run as failed, the evidences streamed or spilled so far are discarded
+    def fail(self, error):
+        LOGGER.error("assessment {} failed : {}".format(self.name, error))
+        self.status = 'ERROR'
+        self.error = str(error)
+        self.close()
+
+    # deletes the local temporary files of the run and aborts its csv upload unless it was completed,
+    # called on failure and once the invocation is over whatever its outcome
+    def close(self):
+        self.csvEvidenceSpool.close()
+        if self.evidenceJsonl:
+            self.evidenceJsonl.close()
+            self.evidenceJsonl = None
+        if self.syncState:
+            self.syncState.close()
+        if self.csvEvidenceStream:
+            if not self.csvEvidenceStream.completed():
+                try:
+                    self.csvEvidenceStream.abort()
+                except Exception:
+                    LOGGER.exception("unable to abort the evidences csv upload of assessment %s", self.name)
+            self.csvEvidenceStream = None
+
+    def failed(self):
+        return self.status == 'ERROR'
+
+    def result(self):
+        return {'name': self.name, 'assessmentId': self.assessmentId, 'status': self.status, 'reportId': self.reportId,
+            'folders': len(self.evidenceFolders) + sum(summary['folders'] for summary in self.shardSummaries), 'failedFolders': len(self.folderErrors), 'error': self.error,
+            'metrics': self.metrics.summary()}
+
+
+# keys of a manifest entry, named after the command line flags they override
+MANIFEST_KEYS = {'name', 'filter_automatic', 'account_Ids', 'filter_latest', 'from_date', 'to_date',
+    'control_set_ids', 'data_sources', 'compliance_status', 'sns_topic', 'dedup'}
+
+# comma seperated filter values may also be given as a JSON list in the manifest
+def manifest_filter_values(value):
+    if isinstance(value, list):
+        value = ",".join(str(item) for item in value)
+    return split_filter_values(value)
+
+# builds the run of a manifest entry, the filters given on the command line apply unless the entry overrides them
+def report_run_from_manifest_entry(settings, entry):
+    unknownKeys = set(entry) - MANIFEST_KEYS
+    if unknownKeys:
+        # a misspelt filter would silently widen the report
+        raise ValueError("unknown manifest keys {} for assessment {}".format(sorted(unknownKeys), entry.get('name')))
+    if not entry.get('name'):
+        raise ValueError("manifest entry without a name : " + json.dumps(entry))
+    def value(key, default, convert=None):
+        if entry.get(key) is None:
+            return default
+        return convert(entry[key]) if convert else entry[key]
+    evidenceFilter = settings.evidenceFilter
+    entryFilter = EvidenceFilter(
+        accountIds=value('account_Ids', evidenceFilter.accountIds, manifest_filter_values),
+        automaticOnly=value('filter_automatic', evidenceFilter.automaticOnly, str_to_bool),
+        fromDate=value('from_date', evidenceFilter.fromDate, datetime.date.fromisoformat),
+        toDate=value('to_date', evidenceFilter.toDate, datetime.date.fromisoformat),
+        controlSetIds=value('control_set_ids', evidenceFilter.controlSetIds, manifest_filter_values),
+        dataSources=value('data_sources', evidenceFilter.dataSources, manifest_filter_values),
+        complianceStatuses=value('compliance_status', evidenceFilter.complianceStatuses, manifest_filter_values))
+    entryDedupMode = value('dedup', settings.dedupMode)
+    if entryDedupMode not in DEDUP_MODES:
+        raise ValueError("unknown dedup mode {} for assessment {}".format(entryDedupMode, entry['name']))
+    return ReportRun(settings, entry['name'], entryFilter, value('filter_latest', settings.filterLatestEvidence, str_to_bool),
+        value('sns_topic', settings.snsTopic), entryDedupMode)
+
+# reads the manifest from a local path or s3://bucket/key, either a JSON list of entries or one JSON entry per line
+def load_manifest(location):
+    content = read_location(location)
+    if content is None:
+        raise ValueError("manifest {} not found".format(location))
+    content = content.decode('utf-8')
+    if content.lstrip().startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+# runs of the assessments to report on: the manifest entries, or the single assessment given with --name
+def load_report_runs(settings):
+    if not settings.manifestLocation:
+        return [ReportRun(settings, settings.assessmentName, settings.evidenceFilter, settings.filterLatestEvidence, settings.snsTopic,
+            settings.dedupMode)]
+    runs = [report_run_from_manifest_entry(settings, entry) for entry in load_manifest(settings.manifestLocation)]
+    names = [run.name for run in runs]
+    duplicateNames = sorted(set(name for name in names if names.count(name) > 1))
+    # evidences are associated per assessment, the reports of two entries would include each others evidences
+    if duplicateNames:
+        raise ValueError("assessments listed more than once in the manifest : " + ", ".join(duplicateNames))
+    LOGGER.info("{} assessments found in manifest {}".format(len(runs), settings.manifestLocation))
+    return runs
+
+
+class AssessmentIndex:
+    """
+    Index of the active assessments by name, holding the report destination bucket of the assessments resolved so far.
+    When a location is given the index is kept in a local file or s3 object and reused by later runs until it is older
+    than the ttl, a name missing from it rebuilds it once per run. The runs of a warm worker share the index, possibly
+    concurrently, every run resolves with its own client and the time it started
+    """
+    def __init__(self, location=None, ttl=86400):
+        self.location = location
+        self.ttl = ttl
+        self.assessments = None
+        self.updatedAt = 0
+        # time of the last rebuild by a run, a run started later may rebuild the index once more
+        self.refreshedAt = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        self.loaded = True
+        if not self.location:
+            return
+        try:
+            content = read_location(self.location)
+            if content is None:
+                return
+            index = json.loads(content)
+            self.assessments = index['assessments']
+            self.updatedAt = index['updatedAt']
+        except (ValueError, KeyError):
+            LOGGER.info("ignoring unreadable assessment index " + self.location)
+
+    def save(self):
+        if not self.location:
+            return
+        write_location(self.location, json.dumps({'updatedAt': self.updatedAt, 'assessments': self.assessments}).encode('utf-8'))
+
+    def refresh(self, client):
+        previous = self.assessments or {}
+        self.assessments = {}
+        for assessment in list_active_assessments(client):
+            # names are not unique, the first active assessment of a name wins as it did before the index
+            if assessment['name'] not in self.assessments:
+                entry = {'id': assessment['id']}
+                if assessment['name'] in previous and previous[assessment['name']]['id'] == assessment['id'] and 'bucket' in previous[assessment['name']]:
+                    entry['bucket'] = previous[assessment['name']]['bucket']
+                self.assessments[assessment['name']] = entry
+        self.updatedAt = self.refreshedAt = time.time()
+        LOGGER.info("assessment index rebuilt : {} active assessments".format(len(self.assessments)))
+
+    # returns the (id, report bucket) of the assessment, (None, None) if no active assessment has the name
+    def resolve(self, client, name, runStartedAt):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            changed = False
+            if self.assessments is None or time.time() - self.updatedAt > self.ttl:
+                self.refresh(client)
+                changed = True
+            elif name not in self.assessments and self.refreshedAt < runStartedAt:
+                LOGGER.info("assessment {} not found in the cached assessment index, rebuilding it".format(name))
+                self.refresh(client)
+                changed = True
+            entry = self.assessments.get(name)
+            if entry and 'bucket' not in entry:
+                entry['bucket'] = get_assessment_bucket(get_assessment_details(client, entry['id']))
+                changed = True
+            if changed:
+                self.save()
+            return (entry['id'], entry['bucket']) if entry else (None, None)
+
+    # drops a cached assessment whose id turned out to be stale, returns False if the index was already rebuilt by this run
+    def invalidate(self, name, runStartedAt):
+        with self.lock:
+            if self.refreshedAt >= runStartedAt or not self.assessments or name not in self.assessments:
+                return False
+            del self.assessments[name]
+            self.updatedAt = 0
+            return True
+
+
+# assessment indexes by location and ttl, kept for the lifetime of the process like the clients
+assessmentIndexes = {}
+
+# returns the assessment index of the location and ttl, shared by the runs of a long-lived worker
+def get_assessment_index(location, ttl):
+    with awsClientsLock:
+        if (location, ttl) not in assessmentIndexes:
+            assessmentIndexes[(location, ttl)] = AssessmentIndex(location, ttl)
+        return assessmentIndexes[(location, ttl)]
+
+
 #################################input parameters#################################
 
-LOGGER.info("executing script")
-
-# Initialize parser
-parser = argparse.ArgumentParser(prog='python3 script.py', usage='%(prog)s [options] assessment report generator ',
-    description='script aims to automate evidence association to help generate assesment reports',
-    epilog='by default this script generates the assessment report with ALL evidences')
-
-
-# Adding arguments
-requiredNamed = parser.add_argument_group('required named arguments')
-requiredNamed.add_argument('--name', type=str, action='store',dest='assesmentName' ,
-help = "name of the audit manager assesment for which the report would be generated")
-parser.add_argument('--filter_automatic', type=bool, action='store',dest='filterAutomaticEvidence' , choices=[True,False], default=False,
-    help = "if set to \'True\' excludes manual evidence from the assesment report, defaults to \'False\'")
-parser.add_argument('--account_Ids',  type=str, action='store',dest='filterAccountIds', default=None,
-    help = "comma seperated AWS Accounts ids for which the report is to be generated, defaults to include all AWS Account Ids in Assesment scope")
-parser.add_argument('--filter_latest', type=bool,  action='store',dest='filterLatestEvidence' , choices=[True,False], default=False,
-    help = "if set to \'True\' associates only latest days evidences to the assesment report, defaults to \'False\'")
-
-parser.add_argument('--sns_topic', type=str,  action='store',dest='snsTopic' ,
-    help = "SnS Topic to which events are published")
-
-# Read arguments from command line
-args = parser.parse_args()
-
-assessmentName=None
-if args.assesmentName:
-    assessmentName=args.assesmentName
-else:
-    LOGGER.error(" \'-- name\': name of the audit manager assesment for which the report would be generated is required")
-    sys.exit(1)
-    
-filterAutomaticEvidence = args.filterAutomaticEvidence
-if not args.filterAccountIds:
-    filterAccountIds=['EMPTY']
-else:
-    filterAccountIds        = [args.filterAccountIds]
+# builds the parser of the options, the command line and the events of lambda_handler() take the same options
+def build_parser():
+    # Initialize parser
+    parser = argparse.ArgumentParser(prog='python3 script.py', usage='%(prog)s [options] assessment report generator ',
+        description='script aims to automate evidence association to help generate assesment reports',
+        epilog='by default this script generates the assessment report with ALL evidences')
 
-filterLatestEvidence    = args.filterLatestEvidence
-snsTopic                = args.snsTopic
-csvEvidenceList         = []
 
-LOGGER.info( "parameters values : " + assessmentName + str(snsTopic) + str(filterAutomaticEvidence) +  str(filterAccountIds) + str(filterLatestEvidence) )
+    # Adding arguments
+    requiredNamed = parser.add_argument_group('required named arguments')
+    requiredNamed.add_argument('--name', type=str, action='store',dest='assesmentName' ,
+    help = "name of the audit manager assesment for which the report would be generated")
+    parser.add_argument('--filter_automatic', type=str_to_bool, action='store',dest='filterAutomaticEvidence' , choices=[True,False], default=False,
+        help = "if set to \'True\' excludes manual evidence from the assesment report, defaults to \'False\'")
+    parser.add_argument('--account_Ids',  type=str, action='store',dest='filterAccountIds', default=None,
+        help = "comma seperated AWS Accounts ids for which the report is to be generated, defaults to include all AWS Account Ids in Assesment scope")
+    parser.add_argument('--filter_latest', type=str_to_bool,  action='store',dest='filterLatestEvidence' , choices=[True,False], default=False,
+        help = "if set to \'True\' associates only latest days evidences to the assesment report, defaults to \'False\'")
+    parser.add_argument('--from_date', type=datetime.date.fromisoformat, action='store', dest='filterFromDate', default=None,
+        help = "(YYYY-MM-DD) excludes evidence folders collected before this date, defaults to None")
+    parser.add_argument('--to_date', type=datetime.date.fromisoformat, action='store', dest='filterToDate', default=None,
+        help = "(YYYY-MM-DD) excludes evidence folders collected after this date, defaults to None")
+    parser.add_argument('--control_set_ids', type=str, action='store', dest='filterControlSetIds', default=None,
+        help = "comma seperated control set ids to include, defaults to all control sets")
+    parser.add_argument('--data_sources', type=str, action='store', dest='filterDataSources', default=None,
+        help = "comma seperated evidence data sources to include (e.g. 'AWS Config,AWS Security Hub'), defaults to all data sources")
+    parser.add_argument('--compliance_status', type=str, action='store', dest='filterComplianceStatus', default=None,
+        help = "comma seperated compliance check results to include (e.g. 'NON_COMPLIANT'), defaults to all results")
+
+    parser.add_argument('--sns_topic', type=str,  action='store',dest='snsTopic' ,
+        help = "SnS Topic to which events are published")
+    parser.add_argument('--max_workers', type=int, action='store',dest='maxWorkers', default=None,
+        help = "number of evidence folders processed concurrently, defaults to the worker count of --from_plan, otherwise 1 (sequential processing)")
+    parser.add_argument('--association_workers', type=int, action='store',dest='associationWorkers', default=None,
+        help = "number of evidence batches associated concurrently while evidences are still being retrieved, defaults to the worker count of --from_plan, otherwise 4")
+    parser.add_argument('--stream_csv', action='store_true', dest='streamCsv', default=False,
+        help = "stream evidence rows to s3 with multipart upload as folders complete instead of building the csv in memory, "
+            "memory is bounded by the part size plus the evidences of the folders in flight")
+    parser.add_argument('--gzip_csv', action='store_true', dest='gzipCsv', default=False,
+        help = "gzip compress the streamed evidences csv, only applies with --stream_csv")
+    parser.add_argument('--part_size_mb', type=int, action='store', dest='partSizeMb', default=8,
+        help = "size in MiB of the multipart upload parts used by --stream_csv (minimum 5), defaults to 8")
+    parser.add_argument('--memory_budget', type=int, action='store', dest='memoryBudgetMb', default=None,
+        help = "MiB of evidences held in memory per assessment until the csv is uploaded, beyond it the rows are spilled to a temporary file, "
+            "defaults to unbounded. Does not apply with --stream_csv")
+    parser.add_argument('--export_format', type=str, action='store', dest='exportFormat', default='csv', choices=['csv', 'jsonl'],
+        help = "format of the exported evidences: 'csv' uploads one csv to evidence_csv/<name>/<report id>/, 'jsonl' uploads gzipped JSON lines "
+            "with nested resourcesIncluded and attributes to evidence_jsonl/<name>/<report id>/account_id=<id>/evidence_date=<YYYY-MM-DD>/, "
+            "partitioned for Athena, defaults to 'csv'")
+    parser.add_argument('--dedup', type=str, action='store', dest='dedupMode', default=None, choices=['latest', 'changes'],
+        help = "collapse the evidences repeated by daily snapshots, keyed on control, resource, data source and compliance result: "
+            "'latest' keeps the most recent evidence of every compliance result, 'changes' the first evidence after every change of the result. "
+            "Only the kept evidences are associated and exported, defaults to all evidences")
+    parser.add_argument('--sync', type=str, action='store', dest='syncLocation', default=None,
+        help = "local directory or s3://bucket/prefix where the evidences associated to the reports of every assessment are recorded. "
+            "Folders collected before the last sync are restored from the record instead of being retrieved, the other folders are "
+            "retrieved and only the evidences added or removed since the last sync are associated or disassociated. "
+            "Changed filters retrieve every folder again, defaults to None")
+    parser.add_argument('--plan', action='store_true', dest='planOnly', default=False,
+        help = "list the evidence folders and estimate the api calls and wall time of the run from their metadata, and pick the worker counts, "
+            "without retrieving evidences or generating reports")
+    parser.add_argument('--plan_output', type=str, action='store', dest='planOutputLocation', default=None,
+        help = "local path or s3://bucket/key the plan of --plan is written to as JSON")
+    parser.add_argument('--from_plan', type=str, action='store', dest='fromPlanLocation', default=None,
+        help = "local path or s3://bucket/key of a plan written by --plan_output: the run still lists the evidence folders, associates "
+            "the planned ones as planned and uses the planned worker counts unless they are given. Filters have to match the plan")
+    parser.add_argument('--checkpoint', type=str, action='store', dest='checkpointLocation', default=None,
+        help = "local directory or s3://bucket/prefix where completed folders and associated evidence batches are journaled")
+    parser.add_argument('--run_id', type=str, action='store', dest='runId', default=None,
+        help = "identifier of the run used to key the checkpoint and the shard outputs, defaults to the AWS Batch job id which is kept across job retries")
+    parser.add_argument('--resume', action='store_true', dest='resume', default=False,
+        help = "skip the work recorded in the checkpoint of the run and continue from there, requires --checkpoint")
+    parser.add_argument('--max_tps', type=float, action='store', dest='maxTps', default=10,
+        help = "maximum calls per second issued for each audit manager operation, lowered automatically when throttled, defaults to 10")
+    parser.add_argument('--report_timeout', type=int, action='store', dest='reportTimeout', default=900,
+        help = "seconds to wait for the assessment report to be generated, defaults to 900")
+    parser.add_argument('--pending_reports', type=str, action='store', dest='pendingReportsLocation', default=None,
+        help = "local directory or s3://bucket/prefix where reports not completed by the deadline, or created with --detach, are recorded")
+    parser.add_argument('--detach', action='store_true', dest='detachReport', default=False,
+        help = "record the generated report as pending and exit without waiting for it, requires --pending_reports")
+    parser.add_argument('--complete_pending', action='store_true', dest='completePending', default=False,
+        help = "publish the urls of the pending reports which are complete without waiting or collecting evidences, requires --pending_reports")
+    parser.add_argument('--manifest', type=str, action='store', dest='manifestLocation', default=None,
+        help = "local path or s3://bucket/key of a JSON list or JSON lines file of assessments, e.g. {\"name\": \"...\", \"filter_automatic\": true}. "
+            "The folders of all assessments share the worker pools and the rate limiter, filters given on the command line are the defaults of every entry")
+    parser.add_argument('--assessment_cache', type=str, action='store', dest='assessmentCacheLocation', default=None,
+        help = "local file or s3://bucket/key where the index of assessment names to ids and report buckets is cached between runs")
+    parser.add_argument('--assessment_cache_ttl', type=int, action='store', dest='assessmentCacheTtl', default=86400,
+        help = "seconds the cached assessment index is used before it is rebuilt, an assessment missing from it rebuilds it earlier, defaults to 86400")
+    parser.add_argument('--metrics_format', type=str, action='store', dest='metricsFormat', default='json', choices=['json', 'emf'],
+        help = "format of the metrics emitted at the end of the run: 'json' logs a summary, 'emf' prints CloudWatch embedded metric format "
+            "documents to stdout, extracted into metrics by Lambda or the CloudWatch agent, defaults to 'json'")
+    parser.add_argument('--profile', action='store_true', dest='profileRun', default=False,
+        help = "time every stage of the run and log the functions with the highest cumulative time")
+    parser.add_argument('--shard_count', type=int, action='store', dest='shardCount', default=None,
+        help = "number of shards the evidence folders of the assessment are split across, every shard associates its folders "
+            "and writes a partial evidences csv to --shard_output, the report is generated by --coordinate")
+    parser.add_argument('--shard_index', type=int, action='store', dest='shardIndex',
+        default=int(os.environ['AWS_BATCH_JOB_ARRAY_INDEX']) if os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX') else None,
+        help = "shard processed by this run, from 0 to --shard_count - 1, defaults to the AWS Batch array job index")
+    parser.add_argument('--shard_output', type=str, action='store', dest='shardOutputLocation', default=None,
+        help = "local directory or s3://bucket/prefix where the shards write their partial evidences csv")
+    parser.add_argument('--coordinate', action='store_true', dest='coordinateShards', default=False,
+        help = "merge the partial evidences csvs of all --shard_count shards of the run and generate the report, "
+            "fails if any shard has not completed, requires --run_id")
+    return parser
+
+# parses the options of the command line, argv defaults to the arguments of the process
+def parse_options(argv=None):
+    return build_parser().parse_args(argv)
+
+# options of a lambda event: the keys are the option names without the leading dashes, e.g.
+# {"name": "my assessment", "filter_automatic": true, "account_Ids": ["111111111111"], "detach": true}
+def options_from_event(event):
+    parser = build_parser()
+    flags = set(option[2:] for action in parser._actions if action.nargs == 0 for option in action.option_strings)
+    argv = []
+    for key, value in event.items():
+        if value is None or value is False:
+            continue
+        if key in flags:
+            if value is True or str_to_bool(str(value)):
+                argv.append('--' + key)
+            continue
+        if isinstance(value, list):
+            value = ",".join(str(item) for item in value)
+        argv.extend(['--' + key, str(value)])
+    try:
+        return parser.parse_args(argv)
+    except SystemExit:
+        raise ValueError("invalid options in event : " + json.dumps(event, default=str))
+
+
+class ReportSettings:
+    """
+    Settings of one invocation, resolved from the options as returned by parse_options() or options_from_event(),
+    with the rate limited client, the association pool, the metrics and the profile of the invocation.
+    The runs of the invocation and the functions processing them are handed the settings,
+    invocations in the same process, one after the other or concurrently, each have their own
+    """
+    # raises ValueError if the options are inconsistent
+    def __init__(self, args):
+        self.assessmentName = None
+        self.manifestLocation = args.manifestLocation
+        if args.assesmentName and self.manifestLocation:
+            raise ValueError("\'--name\' and \'--manifest\' cannot be used together")
+        if args.assesmentName:
+            self.assessmentName = args.assesmentName
+        elif not args.completePending and not self.manifestLocation:
+            raise ValueError("\'-- name\': name of the audit manager assesment for which the report would be generated is required")
+
+        self.evidenceFilter        = EvidenceFilter(accountIds=split_filter_values(args.filterAccountIds), automaticOnly=args.filterAutomaticEvidence,
+            fromDate=args.filterFromDate, toDate=args.filterToDate, controlSetIds=split_filter_values(args.filterControlSetIds),
+            dataSources=split_filter_values(args.filterDataSources), complianceStatuses=split_filter_values(args.filterComplianceStatus))
+
+        self.filterLatestEvidence  = args.filterLatestEvidence
+        self.snsTopic              = args.snsTopic
+        self.planOnly              = args.planOnly
+        self.planOutputLocation    = args.planOutputLocation
+        self.fromPlanLocation      = args.fromPlanLocation
+        if self.planOnly and self.fromPlanLocation:
+            raise ValueError("\'--plan\' and \'--from_plan\' cannot be used together")
+        try:
+            self.loadedPlan        = load_plan(self.fromPlanLocation) if self.fromPlanLocation else None
+        except (OSError, ValueError, ClientError) as error:
+            raise ValueError("unable to read the plan {} : {}".format(self.fromPlanLocation, error))
+        loadedPlan = self.loadedPlan
+        if loadedPlan is not None and not all(key in loadedPlan for key in ('assessments', 'maxWorkers', 'associationWorkers')):
+            raise ValueError("{} is not a plan written by \'--plan_output\'".format(self.fromPlanLocation))
+        self.maxWorkers            = max(1, args.maxWorkers or (loadedPlan['maxWorkers'] if loadedPlan else 1))
+        self.associationWorkers    = max(1, args.associationWorkers or (loadedPlan['associationWorkers'] if loadedPlan else 4))
+        if self.maxWorkers + self.associationWorkers > MAX_POOL_CONNECTIONS:
+            # every worker holds a connection, beyond the pool size connections would be discarded and re-established
+            raise ValueError("--max_workers plus --association_workers may not exceed {} (MAX_POOL_CONNECTIONS)".format(MAX_POOL_CONNECTIONS))
+        self.streamCsv             = args.streamCsv
+        self.gzipCsv               = args.gzipCsv
+        self.partSize              = args.partSizeMb * 1024 * 1024
+        self.exportFormat          = args.exportFormat
+        if self.exportFormat == 'jsonl' and (self.streamCsv or args.shardCount or args.coordinateShards):
+            raise ValueError("\'--export_format jsonl\' cannot be combined with \'--stream_csv\' or sharded runs")
+        self.dedupMode             = args.dedupMode
+        if self.dedupMode and (args.shardCount or args.coordinateShards):
+            # every evidence of a series has to be seen by the same run
+            raise ValueError("\'--dedup\' cannot be combined with sharded runs")
+        self.syncLocation          = args.syncLocation
+        if self.syncLocation and (self.dedupMode or args.shardCount or args.coordinateShards):
+            # the kept evidences of a de-duplication and the folders of a shard depend on folders a sync does not retrieve again
+            raise ValueError("\'--sync\' cannot be combined with \'--dedup\' or sharded runs")
+        self.memoryBudget          = args.memoryBudgetMb * 1024 * 1024 if args.memoryBudgetMb is not None else None
+        self.checkpointLocation    = args.checkpointLocation
+        self.shardCount            = args.shardCount
+        self.shardIndex            = args.shardIndex
+        self.shardOutputLocation   = args.shardOutputLocation
+        self.coordinateShards      = args.coordinateShards
+        shardCount, shardIndex, coordinateShards = self.shardCount, self.shardIndex, self.coordinateShards
+        batchJobId                 = os.environ.get('AWS_BATCH_JOB_ID')
+        if shardCount and not coordinateShards and batchJobId:
+            # the jobs of an array job are identified as <array job id>:<index>, the shards share the array job id
+            batchJobId             = batchJobId.split(':')[0]
+        if (shardCount or coordinateShards) and (self.manifestLocation or not self.shardOutputLocation or not shardCount or shardCount < 1):
+            raise ValueError("sharded runs require \'--name\', \'--shard_count\' and \'--shard_output\' to be set and cannot be combined with \'--manifest\'")
+        if shardCount and not coordinateShards and (shardIndex is None or not 0 <= shardIndex < shardCount):
+            raise ValueError("\'--shard_index\' or AWS_BATCH_JOB_ARRAY_INDEX must be set between 0 and {}".format(shardCount - 1))
+        if coordinateShards and not args.runId:
+            # the coordinator is a job of its own, it only finds the shard outputs by the run id they were written with
+            raise ValueError("\'--coordinate\' requires \'--run_id\' to be set to the run id of the shards")
+        self.runId                 = args.runId or batchJobId or str(uuid.uuid4())
+        # every shard journals its own folders
+        self.checkpointRunId       = self.runId + "-shard-" + str(shardIndex) if shardCount and not coordinateShards else self.runId
+        self.resume                = args.resume
+        if self.resume and not self.checkpointLocation:
+            raise ValueError("\'--resume\' requires \'--checkpoint\' to be set")
+        if shardCount and not coordinateShards and not (args.runId or batchJobId):
+            raise ValueError("\'--shard_count\' requires \'--run_id\' or the AWS_BATCH_JOB_ID environment variable to be set")
+        if self.resume and not (args.runId or batchJobId):
+            # a generated run id would never match the journal of an earlier attempt
+            raise ValueError("\'--resume\' requires \'--run_id\' or the AWS_BATCH_JOB_ID environment variable to be set")
+        self.maxTps                = max(0.1, args.maxTps)
+        self.reportTimeout         = max(0, args.reportTimeout)
+        self.pendingReportsLocation = args.pendingReportsLocation
+        self.detachReport          = args.detachReport
+        self.completePending       = args.completePending
+        if (self.detachReport or self.completePending) and not self.pendingReportsLocation:
+            raise ValueError("\'--detach\' and \'--complete_pending\' require \'--pending_reports\' to be set")
+        self.metricsFormat         = args.metricsFormat
+        self.profileRun            = args.profileRun
+        # resolves assessment names, shared with the other runs of the process configured with the same cache
+        self.assessmentIndex       = get_assessment_index(args.assessmentCacheLocation, max(0, args.assessmentCacheTtl))
+        self.startedAt             = time.time()
+
+        # audit manager client of the run, the pooled client wrapped by the rate limiter of the run
+        self.client                = get_audit_manager_client()
+        if self.client:
+            self.client = RateLimitedClient(self.client, self.maxTps)
+        # shared by all folders so the number of in-flight association calls stays bounded
+        self.associationExecutor   = ThreadPoolExecutor(max_workers=self.associationWorkers, thread_name_prefix='association')
+        # api call statistics are kept by the rate limited client, the evidence counters of every assessment by its run
+        self.runMetrics            = RunMetrics()
+        # profiles of the worker threads merged in --profile mode
+        self.workerProfileStats    = None
+        self.workerProfileLock     = threading.Lock()
+
+        LOGGER.info( "parameters values : " + str(self.assessmentName or self.manifestLocation) + str(self.snsTopic) + self.evidenceFilter.describe() +
+            str(self.filterLatestEvidence) + str(self.maxWorkers) + str(self.associationWorkers) )
+
+    # returns the (id, report bucket) of an assessment
+    def resolve_assessment(self, name):
+        return self.assessmentIndex.resolve(self.client, name, self.startedAt)
+
+    def close(self):
+        self.associationExecutor.shutdown()
 
 ##################################################################################
 
-def publish_to_sns_topic(message):
-    sns = boto3.client('sns')
+# returns the shared client of an aws service other than audit manager
+def get_aws_client(service):
+    with awsClientsLock:
+        if service not in awsClients:
+            clientArgs = {'config': Config(max_pool_connections=MAX_POOL_CONNECTIONS)}
+            if REGION:
+                clientArgs['region_name'] = REGION
+            if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY and boto3.session.Session().get_credentials() is None:
+                clientArgs['aws_access_key_id'] = AWS_ACCESS_KEY_ID
+                clientArgs['aws_secret_access_key'] = AWS_SECRET_ACCESS_KEY
+            awsClients[service] = boto3.client(service, **clientArgs)
+        return awsClients[service]
+
+
+#################################stores#################################
+
+# splits s3://bucket/key into the bucket and the key or prefix
+def split_s3_location(location):
+    bucket, _, key = location[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class LocalStore:
+    """
+    Objects kept as files under a local directory, named by their path relative to it. Writes replace the file atomically
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, *name.split('/'))
+
+    # writes bytes or the content of a binary file object
+    def write(self, name, data, contentType=None):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'wb') as objectFile:
+            if isinstance(data, (bytes, bytearray)):
+                objectFile.write(data)
+            else:
+                shutil.copyfileobj(data, objectFile)
+            objectFile.flush()
+            os.fsync(objectFile.fileno())
+        os.replace(path + '.tmp', path)
+
+    # returns the content of the object, None if it does not exist
+    def read(self, name):
+        path = self.path(name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as objectFile:
+            return objectFile.read()
+
+    # returns the object opened as a binary file, None if it does not exist
+    def open(self, name):
+        path = self.path(name)
+        return open(path, 'rb') if os.path.isfile(path) else None
+
+    # names of the objects starting with the prefix, in order
+    def list(self, prefix=''):
+        names = []
+        for directory, _, fileNames in os.walk(self.directory):
+            for fileName in fileNames:
+                name = os.path.relpath(os.path.join(directory, fileName), self.directory).replace(os.sep, '/')
+                if name.startswith(prefix) and not name.endswith('.tmp'):
+                    names.append(name)
+        return sorted(names)
+
+    def delete(self, name):
+        path = self.path(name)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def delete_many(self, names):
+        for name in names:
+            self.delete(name)
+
+
+class S3Store:
+    """
+    Objects kept under an s3 prefix, named by their key relative to it
+    """
+    def __init__(self, s3, bucket, prefix):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+
+    # writes bytes or the content of a binary file object, files are uploaded in multipart parts when large
+    def write(self, name, data, contentType='application/json'):
+        if isinstance(data, (bytes, bytearray)):
+            self.s3.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=bytes(data), ContentType=contentType)
+        else:
+            self.s3.upload_fileobj(data, self.bucket, self.prefix + name, ExtraArgs={'ContentType': contentType})
+
+    def read(self, name):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=self.prefix + name)['Body'].read()
+        except ClientError as error:
+            if error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    # the object is downloaded to a temporary file, it may not fit in memory
+    def open(self, name):
+        objectFile = tempfile.TemporaryFile()
+        try:
+            self.s3.download_fileobj(self.bucket, self.prefix + name, objectFile)
+        except ClientError as error:
+            objectFile.close()
+            if error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                return None
+            raise
+        objectFile.seek(0)
+        return objectFile
+
+    def list(self, prefix=''):
+        names = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            names.extend(item['Key'][len(self.prefix):] for item in page.get('Contents', []))
+        return sorted(names)
+
+    def delete(self, name):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+    # deletes up to 1000 objects per call
+    def delete_many(self, names):
+        names = list(names)
+        for start in range(0, len(names), 1000):
+            self.s3.delete_objects(Bucket=self.bucket, Delete={'Quiet': True,
+                'Objects': [{'Key': self.prefix + name} for name in names[start:start + 1000]]})
+
+
+# opens the store of a local directory or s3://bucket/prefix, the path parts are appended to the directory or prefix
+def open_store(location, *path):
+    if location.startswith('s3://'):
+        bucket, prefix = split_s3_location(location)
+        return S3Store(get_aws_client('s3'), bucket, '/'.join(part.strip('/') for part in (prefix,) + path if part.strip('/')))
+    return LocalStore(os.path.join(location, *path))
+
+# returns the store holding the object of a local path or s3://bucket/key and the name of the object in it
+def open_object_location(location):
+    if location.startswith('s3://'):
+        bucket, key = split_s3_location(location)
+        prefix, _, name = key.rpartition('/')
+        return S3Store(get_aws_client('s3'), bucket, prefix), name
+    directory, name = os.path.split(location)
+    return LocalStore(directory or '.'), name
+
+# reads the object of a local path or s3://bucket/key, None if it does not exist
+def read_location(location):
+    store, name = open_object_location(location)
+    return store.read(name)
+
+# writes the object of a local path or s3://bucket/key
+def write_location(location, data, contentType='application/json'):
+    store, name = open_object_location(location)
+    store.write(name, data, contentType)
+
+
+def publish_to_sns_topic(message,name,topic):
+    sns = get_aws_client('sns')
     try:
-        sns.publish(TopicArn=snsTopic,
-        Subject="audit manager report generator - " + str(assessmentName),
+        sns.publish(TopicArn=topic,
+        Subject="audit manager report generator - " + str(name),
         Message=message)
     except Exception:
-        LOGGER.exception("Couldn't publish message to %s.", snsTopic)
+        LOGGER.exception("Couldn't publish message to %s.", topic)
 
 
 # generates assesment report
-def create_assesment_report(Id):
+def create_assesment_report(client,Id):
     response = client.create_assessment_report(name=str(uuid.uuid4()) ,assessmentId=Id,
         description='This report is generated via evidence collector automation')
     return response
@@ -201,34 +1225,35 @@ def get_latest_evidence_folders(evidenceFolders,Id):
     return(latestEvidenceFolders)
 
 # checks whether audit manager is in 'ACTIVE' state
-def is_account_active():
+def is_account_active(client):
     response = client.get_account_status()
     if response['status'] == "ACTIVE":
         return True
         
     return False
 
-# gets assesment Id based on assesment name
-def get_assesment_id():
+# retrieves all active assessments
+def list_active_assessments(client):
     assessments = []
     token = None
     assessmentsResult = {}
     while True:
         if not token:
-            assessmentsResult = client.list_assessments(status='ACTIVE')
+            assessmentsResult = client.list_assessments(status='ACTIVE', maxResults=1000)
         else:
-            assessmentsResult = client.list_assessments(nextToken=token)
-        assessments.extend(assessmentsResult)
-        if 'nextToken' in assessmentsResult['assessmentMetadata']:
-            token = assessmentsResult['assessmentMetadata']['nextToken']
+            assessmentsResult = client.list_assessments(status='ACTIVE', maxResults=1000, nextToken=token)
+        assessments.extend(assessmentsResult['assessmentMetadata'])
+        if 'nextToken' in assessmentsResult:
+            token = assessmentsResult['nextToken']
         else:
-            break
-    for assessment in assessmentsResult['assessmentMetadata']:
-        if assessment['name'] == assessmentName:
-            return assessment['id']
+            return assessments
+
+# gets assesment Id based on assesment name
+def get_assesment_id(settings,assessmentName):
+    return settings.resolve_assessment(assessmentName)[0]
 
 # retrieves all evidence folders pertaining to the assesment            
-def get_evidence_folders(Id):
+def get_evidence_folders(client,Id):
     evidenceFolders = []
     token = None
     evidenceFoldersResult = {}
@@ -244,154 +1269,635 @@ def get_evidence_folders(Id):
         else:
             return evidenceFolders
     
-# retrieves all evidences pertaining to the assesment    
-def get_evidence_details(Id,evidenceFolder):
-    evidences = []
+# retrieves evidences of an evidence folder page by page, yields each page as soon as it arrives
+def iterate_raw_evidence_pages(client,Id,evidenceFolder,metrics=None):
     token = None
     evidencesResult = {}
     while True:
-        LOGGER.info("retrieving evidence details ...")
+        LOGGER.debug("retrieving evidence details ...")
         if not token:
             evidencesResult = client.get_evidence_by_evidence_folder(assessmentId=Id, controlSetId=evidenceFolder['controlSetId'],
                 evidenceFolderId=evidenceFolder['id'], maxResults=1000)
         else:
             evidencesResult = client.get_evidence_by_evidence_folder(assessmentId=Id, controlSetId=evidenceFolder['controlSetId'],
                 evidenceFolderId=evidenceFolder['id'],  maxResults=1000, nextToken=token)
-        evidences.extend(evidencesResult['evidence'])
+        if metrics:
+            metrics.add('pages')
+            metrics.add('evidences_scanned', len(evidencesResult['evidence']))
+        yield evidencesResult['evidence']
         if 'nextToken' in evidencesResult:
             token = evidencesResult['nextToken']
         else:
-            evidencesList=[]
-            for evidence in evidences:
-                if evidence['complianceCheck'] == "NOT_APPLICABLE":
-                    LOGGER.info("removing evidences where compliance check is not applicable")
-                else:
-                    evidencesList.append(evidence)
-            return evidencesList
+            return
 
-# filters evidences based on AWS Account Ids as provided in the input
-def filter_evidences_by_accounts(evidenceDetails):
-    evidences=[]
-    for evidence in evidenceDetails:
-        if evidence['evidenceAwsAccountId'] in filterAccountIds:
-            evidences.extend([evidence])
-    return evidences
+# removes evidences where the compliance check is not applicable
+def remove_not_applicable(evidences):
+    return [evidence for evidence in evidences if evidence['complianceCheck'] != "NOT_APPLICABLE"]
 
-# filters out 'Manual' evidence types    
-def filter_evidences_by_type(evidenceDetails):
-    evidences=[]
-    for evidence in evidenceDetails:
-        if evidence['evidenceByType'] and evidence['evidenceByType'] != 'Manual':
-            evidences.extend([evidence])
+# retrieves evidences of an evidence folder page by page without the not applicable ones
+def iterate_evidence_pages(client,Id,evidenceFolder,metrics=None):
+    for rawEvidences in iterate_raw_evidence_pages(client,Id,evidenceFolder,metrics):
+        evidences=remove_not_applicable(rawEvidences)
+        if metrics:
+            metrics.add('evidences_not_applicable', len(rawEvidences) - len(evidences))
+        yield evidences
+
+# retrieves all evidences pertaining to the assesment as records, the raw pages are released as they are projected
+def get_evidence_details(run,evidenceFolder):
+    evidences = []
+    for evidencesList in iterate_evidence_pages(run.settings.client,run.assessmentId,evidenceFolder,run.metrics):
+        evidences.extend(project_evidences(evidencesList,run.settings.exportFormat))
     return evidences
 
+# compiles evidences to add to the assesment report based on input parameters, in a single pass
+def filter_evidences(evidenceDetails,evidenceFilter):
+    return evidenceFilter.apply(evidenceDetails)
+
+# selects the evidence folders to process, folders which cannot contain matching evidences are skipped
+# without retrieving their evidences
+def select_evidence_folders(run,evidenceFolders):
+    evidenceFilter=run.evidenceFilter
+    evidenceFolders=[evidenceFolder for evidenceFolder in evidenceFolders if evidenceFilter.folder_in_scope(evidenceFolder)]
+    #filter evidence folders based on latest date
+    if run.filterLatest and evidenceFolders:
+        evidenceFolders=get_latest_evidence_folders(evidenceFolders,run.assessmentId)
+    selectedFolders=[evidenceFolder for evidenceFolder in evidenceFolders if evidenceFilter.folder_may_match(evidenceFolder)]
+    if len(selectedFolders) < len(evidenceFolders):
+        LOGGER.info("skipping {} evidence folders without matching evidences".format(len(evidenceFolders) - len(selectedFolders)))
+    return selectedFolders
 
-# compiles evidences to add to the assesment report based on input parameters    
-def filter_evidences(evidenceDetails):
-    evidences=evidenceDetails
-    if filterAccountIds != ['EMPTY']:
-        evidences=filter_evidences_by_accounts(evidenceDetails)
-        if filterAutomaticEvidence:
-            evidences=filter_evidences_by_type(evidences)
-    if filterAutomaticEvidence:
-        evidences=filter_evidences_by_type(evidenceDetails)
-        if filterAccountIds != ['EMPTY']:
-            evidences=filter_evidences_by_accounts(evidenceDetails)
+# associates a single batch of evidence ids to the report
+def associate_evidence_batch(run,folderId,evidenceIds):
+    LOGGER.debug("associating processed evidences to assessment report")
+    run.settings.client.batch_associate_assessment_report_evidence(assessmentId=run.assessmentId, evidenceFolderId=folderId,evidenceIds=evidenceIds)
+    run.metrics.add('association_batches')
+    run.metrics.add('evidences_associated', len(evidenceIds))
+    if run.checkpointStore:
+        run.checkpointStore.record_batch(folderId, evidenceIds)
+
+# disassociates a single batch of evidence ids from the report
+def disassociate_evidence_batch(run,folderId,evidenceIds):
+    LOGGER.debug("disassociating evidences no longer selected from assessment report")
+    run.settings.client.batch_disassociate_assessment_report_evidence(assessmentId=run.assessmentId, evidenceFolderId=folderId,evidenceIds=evidenceIds)
+    run.metrics.add('disassociation_batches')
+    run.metrics.add('evidences_disassociated', len(evidenceIds))
+
+# fetches, filters and associates the evidences of a folder as a pipeline:
+# every page is filtered as soon as it arrives and full batches are handed to the association workers
+# while the following pages are still being downloaded.
+# For folders up to MAX_WHOLE_FOLDER_EVIDENCES, the ids are held back as long as every evidence seen so far
+# matches the filters. If the whole folder matches, it is associated with a single folder level call instead of one
+# call per 50 evidences.
+# returns the filtered evidences of the folder as records
+def stream_evidences_to_report(run,evidenceFolder):
+    accesId=run.assessmentId
+    evidenceFilter=run.evidenceFilter
+    settings=run.settings
+    evidences=[]
+    pendingIds=[]
+    futures=[]
+    maxItems=MAX_EVIDENCE_IDS_PER_BATCH
+    # evidences associated by an interrupted earlier attempt of this run
+    associatedIds=run.checkpointState.associatedIds.get(evidenceFolder['id'], set()) if run.checkpointState else set()
+    if run.syncState:
+        # and evidences associated by the last sync
+        associatedIds=associatedIds | run.syncState.associatedIds.get(evidenceFolder['id'], set())
+    # skip the whole folder check when the folder metadata already proves that some evidences do not match,
+    # or when the folder is too large to hold its batches back, or when the plan of the run associates it in batches
+    wholeFolder=evidenceFilter.folder_may_fully_match(evidenceFolder) and \
+        (evidenceFolder.get('totalEvidence') or 0) <= MAX_WHOLE_FOLDER_EVIDENCES and evidenceFolder.get('association') != 'batches'
+    scannedCount=0
+    try:
+        for rawEvidences in iterate_raw_evidence_pages(settings.client,accesId,evidenceFolder,run.metrics):
+            scannedCount+=len(rawEvidences)
+            evidencesList=remove_not_applicable(rawEvidences)
+            filteredEvidences=filter_evidences(evidencesList,evidenceFilter)
+            run.metrics.add('evidences_not_applicable', len(rawEvidences) - len(evidencesList))
+            run.metrics.add('evidences_filtered_out', len(evidencesList) - len(filteredEvidences))
+            evidences.extend(project_evidences(filteredEvidences,settings.exportFormat))
+            pendingIds.extend(evidence['id'] for evidence in filteredEvidences if evidence['id'] not in associatedIds)
+            # a folder level association would also include the not applicable evidences
+            if wholeFolder and len(filteredEvidences) < len(rawEvidences):
+                LOGGER.info("evidence folder {} partially matches the filters, associating evidences in batches".format(evidenceFolder['id']))
+                wholeFolder=False
+            # folder metadata may be missing or stale, never hold back more than the limit
+            if wholeFolder and scannedCount > MAX_WHOLE_FOLDER_EVIDENCES:
+                wholeFolder=False
+            if wholeFolder:
+                continue
+            while len(pendingIds) >= maxItems:
+                futures.append(settings.associationExecutor.submit(run_profiled,settings,associate_evidence_batch,run,evidenceFolder['id'],pendingIds[:maxItems]))
+                del pendingIds[:maxItems]
+        if wholeFolder and evidences:
+            LOGGER.info("all evidences of folder {} match the filters".format(evidenceFolder['id']))
+            associate_report_evidence_folder(settings.client,accesId,evidenceFolder['id'])
+            run.folderAssociations.add(evidenceFolder['id'])
+            run.metrics.add('folders_associated')
+            run.metrics.add('evidences_associated', len(evidences))
+        elif pendingIds and not wholeFolder:
+            futures.append(settings.associationExecutor.submit(run_profiled,settings,associate_evidence_batch,run,evidenceFolder['id'],pendingIds))
+    finally:
+        # never leave batches of this folder running in the background, even if fetching failed
+        wait(futures)
+    for future in futures:
+        future.result()
     return evidences
 
-# adds processed evidences to report
-def add_evidences_to_report(accesId,evidences,folderId):
-    evidenceIdList=[]
-    for evidence in evidences:
-        evidenceIdList.append(evidence['id'])
-    # max value allowed by the API
-    maxItems=50
-    evidenceIdList = [evidenceIdList[i * maxItems:(i + 1) * maxItems] for i in range((len(evidenceIdList) + maxItems - 1) // maxItems )]  
-    for maxEvidenceIdList in evidenceIdList:
-        LOGGER.info("associating processed evidences to assessment report")
-        client.batch_associate_assessment_report_evidence(assessmentId=accesId, evidenceFolderId=folderId,evidenceIds=maxEvidenceIdList)
-        # LOGGER.info("dissociateting now")
-        # re=client.batch_disassociate_assessment_report_evidence(assessmentId=accesId, evidenceFolderId=folderId,evidenceIds=maxEvidenceIdList)
-        # LOGGER.info(str(re))
-
-
-# validates whether the assessment report is generated successfully
-def get_assesment_reports():
-    reports = []
+
+# looks up assessment reports by id, stops paging as soon as all of them are found
+# returns a dict of report id to report for the reports found
+def find_assessment_reports(client,reportIds):
+    remainingIds = set(reportIds)
+    reports = {}
     token = None
-    reportResult = {}
-    while True:
+    while remainingIds:
         if not token:
-            reportResult = client.list_assessment_reports()
+            reportResult = client.list_assessment_reports(maxResults=1000)
         else:
-            reportResult = client.list_assessment_reports(nextToken=token)
-        reports.extend(reportResult['assessmentReports'])
+            reportResult = client.list_assessment_reports(maxResults=1000, nextToken=token)
+        for report in reportResult['assessmentReports']:
+            if report['id'] in remainingIds:
+                reports[report['id']] = report
+                remainingIds.discard(report['id'])
         if 'nextToken' in reportResult:
             token = reportResult['nextToken']
         else:
-            return reports
+            break
+    return reports
 
-# waits until the report is successfully generated
-def check_assesment_report_status(reportId):
-    timeCheck=False
-    waitTme=30
-    startTime = time.time()
+# looks up a single assessment report, stops paging as soon as the report is found
+def find_assessment_report(client,reportId):
+    return find_assessment_reports(client,[reportId]).get(reportId)
+
+# polls the status of the reports with exponential backoff and jitter until they complete, fail or the deadline passes,
+# every poll looks up all reports still being generated with a single listing
+# returns a dict of report id to 'COMPLETE' or 'FAILED', reports still being generated at the deadline are left out
+def wait_for_assessment_reports(client, reportIds, timeout, initialDelay=5, maxDelay=60):
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    statuses = {}
+    remainingIds = set(reportIds)
     while True:
-        if time.time() - startTime > waitTme:
-            LOGGER.info("looks like report generation may take a while, exiting the script ")
-            LOGGER.info("Note :- Audit manager would continue generating the report at the backend.")
-            LOGGER.info("Once completed you can extract the report from the audit manager console/configured S3 bucket")
-            sys.exit()
-        assessmentReports=get_assesment_reports()
-        for report in assessmentReports:
-            if reportId == report['id'] and 'COMPLETE' == report['status']:
-                return('COMPLETE')
-            elif reportId == report['id'] and 'IN_PROGRESS' == report['status']:
-                LOGGER.info("waiting for the report to generate..")
-                time.sleep(10)
-            elif reportId == report['id'] and 'FAILED' == report['status']:
-                LOGGER.info("report generation failed")
-                sys.exit()
-            else:
-                continue
+        for reportId, report in find_assessment_reports(client, remainingIds).items():
+            if report['status'] in ('COMPLETE', 'FAILED'):
+                statuses[reportId] = report['status']
+                remainingIds.discard(reportId)
+        if not remainingIds:
+            return statuses
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return statuses
+        delay = min(remaining, random.uniform(initialDelay, min(maxDelay, initialDelay * (2 ** attempt))))
+        LOGGER.info("waiting for {} reports to generate.., checking again in {:.0f} seconds".format(len(remainingIds), delay))
+        time.sleep(delay)
+        attempt += 1
+
+# polls the status of a single report, returns 'COMPLETE', 'FAILED' or None if the report is still being generated at the deadline
+def wait_for_assessment_report(client, reportId, timeout, initialDelay=5, maxDelay=60):
+    return wait_for_assessment_reports(client, [reportId], timeout, initialDelay, maxDelay).get(reportId)
 
 #generates and returns the S3 signed URL
-def generate_report_url(reportId,Id):
+def generate_report_url(client,reportId,Id,name=None,topic=None,summary=None):
     response = client.get_assessment_report_url(
         assessmentReportId=reportId,assessmentId=Id)
-    publish_to_sns_topic(str(response))
+    publish_to_sns_topic(str(response) + run_summary_message(summary),name,topic)
     return response
 
+# summary of the run appended to the sns messages
+def run_summary_message(summary):
+    if not summary:
+        return ""
+    return "\n\nrun summary : " + json.dumps(summary, default=str)
+
+# records the report of a run as pending, to be completed by a later --complete_pending invocation
+def save_pending_report(run):
+    pendingReport={'reportId': run.reportId, 'assessmentId': run.assessmentId, 'assessmentName': run.name, 'snsTopic': run.snsTopic,
+        'createdAt': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    open_pending_report_store(run.settings.pendingReportsLocation).save(pendingReport)
+    LOGGER.info("report {} recorded as pending in {}, complete it with --complete_pending".format(run.reportId,run.settings.pendingReportsLocation))
+
+# waits for the reports of the runs to complete and publishes their urls
+# in detached mode, or when a report is not complete by the deadline, the report is recorded as pending instead
+def wait_and_publish_reports(settings,runs):
+    if not runs:
+        return
+    if settings.detachReport:
+        for run in runs:
+            run.status='PENDING'
+            save_pending_report(run)
+        return
+    # check status of the reports
+    reportStatuses=wait_for_assessment_reports(settings.client, [run.reportId for run in runs], settings.reportTimeout)
+    for run in runs:
+        run.status=reportStatuses.get(run.reportId, 'PENDING')
+        if run.status == 'COMPLETE':
+            #generating urls of the completed report
+            assesmentUrls=generate_report_url(settings.client,run.reportId,run.assessmentId,run.name,run.snsTopic,run.metrics.summary())
+            LOGGER.info('URL details as follows : {}'.format(json.dumps(assesmentUrls['preSignedUrl'], default=str,indent=4)))
+        elif run.status == 'FAILED':
+            LOGGER.info("report generation failed for assessment " + run.name)
+            publish_to_sns_topic("assessment report {} generation failed".format(run.reportId) + run_summary_message(run.metrics.summary()),
+                run.name,run.snsTopic)
+        else:
+            LOGGER.info("looks like report generation may take a while for assessment {}, exiting the script ".format(run.name))
+            LOGGER.info("Note :- Audit manager would continue generating the report at the backend.")
+            LOGGER.info("Once completed you can extract the report from the audit manager console/configured S3 bucket")
+            if settings.pendingReportsLocation:
+                save_pending_report(run)
+
+# completes the reports recorded as pending by earlier detached runs: publishes the url of completed reports
+# and notifies failed ones. The statuses are looked up once without waiting, reports still in progress
+# are kept for the next invocation
+def complete_pending_reports(settings):
+    store=open_pending_report_store(settings.pendingReportsLocation)
+    pendingReports=store.list()
+    LOGGER.info("{} pending reports found".format(len(pendingReports)))
+    if not pendingReports:
+        return
+    reports=find_assessment_reports(settings.client,[pendingReport['reportId'] for pendingReport in pendingReports])
+    for pendingReport in pendingReports:
+        reportStatus=reports[pendingReport['reportId']]['status'] if pendingReport['reportId'] in reports else None
+        if reportStatus == 'COMPLETE':
+            assesmentUrls=generate_report_url(settings.client,pendingReport['reportId'],pendingReport['assessmentId'],
+                pendingReport.get('assessmentName'),pendingReport.get('snsTopic'))
+            LOGGER.info('report {} complete, URL details as follows : {}'.format(pendingReport['reportId'],
+                json.dumps(assesmentUrls['preSignedUrl'], default=str,indent=4)))
+            store.remove(pendingReport['reportId'])
+        elif reportStatus == 'FAILED':
+            LOGGER.info("report {} generation failed".format(pendingReport['reportId']))
+            publish_to_sns_topic("assessment report {} generation failed".format(pendingReport['reportId']),
+                pendingReport.get('assessmentName'),pendingReport.get('snsTopic'))
+            store.remove(pendingReport['reportId'])
+        else:
+            LOGGER.info("report {} is still being generated".format(pendingReport['reportId']))
+
+
+class PendingReportStore:
+    """
+    Pending reports stored as one JSON object per report in a local directory or under an s3 prefix
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def save(self, pendingReport):
+        self.store.write(pendingReport['reportId'] + '.json', json.dumps(pendingReport).encode('utf-8'))
+
+    def list(self):
+        pendingReports = []
+        for name in self.store.list():
+            if name.endswith('.json'):
+                content = self.store.read(name)
+                # completed by a concurrent invocation
+                if content is not None:
+                    pendingReports.append(json.loads(content))
+        return pendingReports
+
+    def remove(self, reportId):
+        self.store.delete(reportId + '.json')
+
+
+# opens the pending report store for the location given as a local directory or s3://bucket/prefix
+def open_pending_report_store(location):
+    return PendingReportStore(open_store(location))
+
 # associates an evidence folder to the assesment report
-def associate_report_evidence_folder(Id,folderId):
+def associate_report_evidence_folder(client,Id,folderId):
     LOGGER.info("associating evidence folder with Id " + folderId)
     client.associate_assessment_report_evidence_folder(assessmentId=Id, evidenceFolderId=folderId)
-    # LOGGER.info("dissociateting now")
-    # re=client.disassociate_assessment_report_evidence_folder(assessmentId=Id, evidenceFolderId=folderId)
-    # LOGGER.info(str(re))
-    
+
+# disassociates an evidence folder from the assesment report
+def disassociate_report_evidence_folder(client,Id,folderId):
+    LOGGER.info("disassociating evidence folder with Id " + folderId)
+    client.disassociate_assessment_report_evidence_folder(assessmentId=Id, evidenceFolderId=folderId)
+
 
 # identifies whether filters are applied for the assessment report generation
-def process_evidences(evidenceFolder,assesmentId):
-    LOGGER.info("processing evidence folder with Id " + evidenceFolder['id'])
-
-    if filterAutomaticEvidence or filterAccountIds != ['EMPTY']:
-        LOGGER.info("processing evidences based on filters applied ")
-        #compile evidence details
-        evidenceDetails=get_evidence_details(assesmentId,evidenceFolder)
-        #filter evidences base on input variables
-        evidences= filter_evidences(evidenceDetails)
-        # append filtered evidence details for csv
-        csvEvidenceList.extend(evidences)  
-        #add evidences to the audit report
-        add_evidences_to_report(assesmentId,evidences,evidenceFolder['id'])
+# returns the evidences of the folder which are to be exported to the csv
+def process_evidences(run,evidenceFolder):
+    assesmentId=run.assessmentId
+    if run.syncState and evidenceFolder['id'] in run.syncState.unchangedFolders:
+        LOGGER.info("evidence folder with Id " + evidenceFolder['id'] + " unchanged since the last sync, restoring it from the sync state")
+        run.metrics.add('folders_unchanged')
+        if evidenceFolder['id'] in run.syncState.associatedFolders:
+            run.folderAssociations.add(evidenceFolder['id'])
+        return [EvidenceRecord.from_row(row) for row in run.syncState.restore(evidenceFolder['id'])]
+    if run.syncState and evidenceFolder['id'] in run.syncState.associatedFolders and run.evidenceFilter.has_evidence_predicates():
+        reset_folder_association(run,evidenceFolder['id'])
+    if run.checkpointState and evidenceFolder['id'] in run.checkpointState.completedFolders:
+        LOGGER.info("evidence folder with Id " + evidenceFolder['id'] + " already processed, restoring it from the checkpoint")
+        run.metrics.add('folders_restored')
+        if evidenceFolder['id'] in run.checkpointState.folderAssociations:
+            run.folderAssociations.add(evidenceFolder['id'])
+        evidenceDetails=[EvidenceRecord.from_row(row) for row in run.checkpointState.completedFolders[evidenceFolder['id']]]
     else:
-         # append evidences to the csv list
-        evidenceDetails=get_evidence_details(assesmentId,evidenceFolder)
-        csvEvidenceList.extend(evidenceDetails)
-        # associate evidence folder with the assessment report     
-        associate_report_evidence_folder(assesmentId,evidenceFolder['id'] )
+        LOGGER.info("processing evidence folder with Id " + evidenceFolder['id'] + " of assessment " + run.name)
+        if run.dedupMode:
+            # only the evidences kept by the de-duplication are associated, once every folder has been seen
+            return fetch_evidences_to_deduplicate(run,evidenceFolder)
+        if run.evidenceFilter.has_evidence_predicates():
+            LOGGER.debug("processing evidences based on filters applied ")
+            #fetch, filter and add evidences to the audit report page by page
+            evidenceDetails=stream_evidences_to_report(run,evidenceFolder)
+        else:
+            evidenceDetails=get_evidence_details(run,evidenceFolder)
+            # associate evidence folder with the assessment report     
+            associate_report_evidence_folder(run.settings.client,assesmentId,evidenceFolder['id'] )
+            run.folderAssociations.add(evidenceFolder['id'])
+            run.metrics.add('folders_associated')
+            run.metrics.add('evidences_associated', len(evidenceDetails))
+    if run.syncState:
+        disassociate_stale_evidences(run,evidenceFolder['id'],evidenceDetails)
+    return evidenceDetails
+
+
+# disassociates a folder associated as a whole by the last sync before it is filtered again. The folder level association
+# also included evidences the last sync did not export, e.g. the not applicable ones, which are unknown to the sync state.
+# The evidences of the folder matching the filters are then associated again like those of a new folder. The disassociation
+# is recorded in the checkpoint, a resumed run does not disassociate the evidences an earlier attempt associated again
+def reset_folder_association(run,folderId):
+    if run.checkpointState and (folderId in run.checkpointState.resetFolders or folderId in run.checkpointState.completedFolders):
+        LOGGER.info("evidence folder {} already disassociated by an earlier attempt of this run".format(folderId))
+    else:
+        LOGGER.info("evidence folder {} was associated as a whole by the last sync, disassociating it before filtering it".format(folderId))
+        disassociate_report_evidence_folder(run.settings.client,run.assessmentId,folderId)
+        run.metrics.add('folders_disassociated')
+        if run.checkpointStore:
+            run.checkpointStore.record_reset(folderId)
+    run.syncState.associatedIds.pop(folderId, None)
+
+
+# disassociates the evidences of a folder associated by the last sync which no longer match the filters
+def disassociate_stale_evidences(run,folderId,evidences):
+    staleIds=run.syncState.associatedIds.get(folderId, set()).difference(evidence.id for evidence in evidences)
+    if not staleIds:
+        return
+    LOGGER.info("disassociating {} evidences of folder {} associated by the last sync".format(len(staleIds),folderId))
+    staleIds=sorted(staleIds)
+    futures=[run.settings.associationExecutor.submit(run_profiled,run.settings,disassociate_evidence_batch,run,folderId,staleIds[start:start + MAX_EVIDENCE_IDS_PER_BATCH])
+        for start in range(0, len(staleIds), MAX_EVIDENCE_IDS_PER_BATCH)]
+    wait(futures)
+    for future in futures:
+        future.result()
+
+# disassociates the folders associated by the last sync which are no longer selected, e.g. by --filter_latest or changed filters
+def disassociate_removed_folders(run):
+    futures=[run.settings.associationExecutor.submit(run_profiled,run.settings,disassociate_report_evidence_folder,run.settings.client,run.assessmentId,folderId)
+        for folderId in sorted(run.syncState.removedFolders)]
+    wait(futures)
+    for future in futures:
+        future.result()
+    run.metrics.add('folders_disassociated', len(futures))
+
+
+# retrieves and filters the evidences of a folder without associating them, with the fields the de-duplication is keyed on
+def fetch_evidences_to_deduplicate(run,evidenceFolder):
+    evidences=[]
+    for evidencesList in iterate_evidence_pages(run.settings.client,run.assessmentId,evidenceFolder,run.metrics):
+        filteredEvidences=filter_evidences(evidencesList,run.evidenceFilter)
+        run.metrics.add('evidences_filtered_out', len(evidencesList) - len(filteredEvidences))
+        evidences.extend(project_evidences(filteredEvidences, run.settings.exportFormat, dedupFields=True))
+    return evidences
+
+
+# interleaves the evidence folders of the runs round robin, so every assessment progresses at the same pace
+# yields (run, evidenceFolder) tuples, the folders of each run keep their order
+def interleave_run_folders(runs):
+    folderIterators = collections.deque((run, iter(run.evidenceFolders)) for run in runs)
+    while folderIterators:
+        run, folderIterator = folderIterators.popleft()
+        # the remaining folders of a failed run are dropped
+        if run.failed():
+            continue
+        for evidenceFolder in itertools.islice(folderIterator, 1):
+            yield run, evidenceFolder
+            folderIterators.append((run, folderIterator))
+
+
+# processes (run, evidenceFolder) tasks sequentially or on a bounded worker pool
+# yields (run, evidenceFolder, evidences, error) tuples in the order of the input tasks irrespective of completion order
+def iterate_processed_folders(settings,tasks):
+    maxWorkers = settings.maxWorkers
+    if maxWorkers == 1:
+        for run, evidenceFolder in tasks:
+            try:
+                yield run, evidenceFolder, process_evidences(run,evidenceFolder), None
+            except Exception as error:
+                yield run, evidenceFolder, None, error
+        return
+    # keep a bounded window of submitted folders so completed results do not pile up in memory
+    taskIterator = iter(tasks)
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='evidence-folder') as executor:
+        for run, evidenceFolder in itertools.islice(taskIterator, maxWorkers * 2):
+            pending.append((run, evidenceFolder, executor.submit(run_profiled,settings,process_evidences,run,evidenceFolder)))
+        while pending:
+            run, evidenceFolder, future = pending.popleft()
+            for nextRun, nextFolder in itertools.islice(taskIterator, 1):
+                pending.append((nextRun, nextFolder, executor.submit(run_profiled,settings,process_evidences,nextRun,nextFolder)))
+            try:
+                yield run, evidenceFolder, future.result(), None
+            except Exception as error:
+                yield run, evidenceFolder, None, error
+
+
+# appends evidences to the csv spool of the run, or to its s3 stream when streaming is enabled,
+# or to its partitioned JSON lines export
+def append_csv_evidences(run,evidences):
+    with run.csvEvidenceLock:
+        if run.evidenceJsonl:
+            run.evidenceJsonl.write_evidences(evidences)
+        elif run.csvEvidenceStream:
+            run.csvEvidenceStream.write_evidences(evidences)
+        else:
+            run.csvEvidenceSpool.extend(evidences)
+
+
+# processes the evidence folders of all runs on the shared worker pool, a failing folder is recorded
+# in the folderErrors of its run as (folderId, error) and does not abort the other folders. A run whose results
+# cannot be recorded, e.g. its csv upload or checkpoint failing, fails on its own and its remaining folders are skipped
+def process_evidence_folders(settings,runs):
+    for run, evidenceFolder, evidences, error in iterate_processed_folders(settings,interleave_run_folders(runs)):
+        if run.failed():
+            continue
+        if error:
+            LOGGER.error("processing of evidence folder {} of assessment {} failed : {}".format(evidenceFolder['id'], run.name, error))
+            run.folderErrors.append((evidenceFolder['id'], error))
+            continue
+        try:
+            record_processed_folder(run,evidenceFolder,evidences)
+        except Exception as error:
+            run.fail(error)
+
+# records the evidences of a processed folder in the checkpoint and sync state, and exports them
+def record_processed_folder(run,evidenceFolder,evidences):
+    run.metrics.add('folders_processed')
+    folderAssociated=evidenceFolder['id'] in run.folderAssociations
+    if run.checkpointStore and not (run.checkpointState and evidenceFolder['id'] in run.checkpointState.completedFolders):
+        run.checkpointStore.record_folder(evidenceFolder['id'], [evidence_checkpoint_row(evidence) for evidence in evidences], folderAssociated)
+    if run.syncState:
+        run.syncState.record(evidenceFolder, evidences, folderAssociated)
+    if run.deduplicator:
+        run.deduplicator.add(evidences)
+    else:
+        run.metrics.add('evidences_exported', len(evidences))
+        append_csv_evidences(run,evidences)
+
+
+# de-duplication modes, see EvidenceDeduplicator
+DEDUP_MODES = {None, 'latest', 'changes'}
+
+
+class EvidenceDeduplicator:
+    """
+    Collapses the evidences repeated by the daily snapshots of audit manager. The evidences of a control, resource and
+    data source form a series, in 'latest' mode the most recent evidence of every compliance result of a series is kept,
+    in 'changes' mode the first evidence after every change of the compliance result. The folders have to be added
+    in ascending date order. Evidences without resources are all kept.
+    """
+    def __init__(self, mode, evidenceFolders):
+        self.mode = mode
+        self.folderControls = {evidenceFolder['id']: evidenceFolder.get('controlId') for evidenceFolder in evidenceFolders}
+        # 'latest' : the kept evidence of every series and compliance result, 'changes' : the last compliance result of every series
+        self.states = {}
+        self.kept = []
+        self.count = 0
+
+    def add(self, evidences):
+        self.count += len(evidences)
+        for evidence in sorted(evidences, key=lambda evidence: evidence.evidenceTime or ''):
+            seriesKey = (self.folderControls.get(evidence.evidenceFolderId), evidence.resourceArns or evidence.id, evidence.dataSource)
+            if self.mode == 'latest':
+                self.states[seriesKey + (evidence.complianceCheck,)] = evidence
+            elif seriesKey not in self.states or self.states[seriesKey] != evidence.complianceCheck:
+                self.states[seriesKey] = evidence.complianceCheck
+                self.kept.append(evidence)
+
+    # the kept evidences in the order they were collected
+    def selected(self):
+        if self.mode == 'latest':
+            return sorted(self.states.values(), key=lambda evidence: (evidence.evidenceTime or '', evidence.id))
+        return self.kept
+
+
+# associates the evidences kept by the de-duplication of a run in batches per folder and exports them
+def associate_deduplicated_evidences(run):
+    evidences=run.deduplicator.selected()
+    run.metrics.add('evidences_deduplicated', run.deduplicator.count - len(evidences))
+    LOGGER.info("de-duplication kept {} of {} evidences of assessment {}".format(len(evidences),run.deduplicator.count,run.name))
+    folderIds=collections.defaultdict(list)
+    for evidence in evidences:
+        # evidences associated by an interrupted earlier attempt of this run
+        if not (run.checkpointState and evidence.id in run.checkpointState.associatedIds.get(evidence.evidenceFolderId, ())):
+            folderIds[evidence.evidenceFolderId].append(evidence.id)
+    futures=[run.settings.associationExecutor.submit(run_profiled,run.settings,associate_evidence_batch,run,folderId,ids[start:start + MAX_EVIDENCE_IDS_PER_BATCH])
+        for folderId, ids in folderIds.items() for start in range(0, len(ids), MAX_EVIDENCE_IDS_PER_BATCH)]
+    wait(futures)
+    for future in futures:
+        future.result()
+    run.deduplicator=None
+    run.metrics.add('evidences_exported', len(evidences))
+    append_csv_evidences(run,evidences)
+
+
+# columns of the evidences csv
+CSV_EVIDENCE_HEADER=['dataSource', 'evidenceAwsAccountId','eventSource','eventName','evidenceByType','resourcesIncluded','attributes', 'complianceCheck','evidenceFolderId','id']
+
+
+class EvidenceRecord:
+    """
+    Projection of an evidence onto the exported columns, built as soon as a page is retrieved so that the raw evidence
+    is released with its page. Values repeated across evidences are interned, the nested resourcesIncluded and
+    attributes are kept rendered the way they are exported
+    """
+    # the date of the evidence partitions the jsonl export, its time and resource arns key the de-duplication,
+    # they are not csv columns
+    __slots__ = tuple(CSV_EVIDENCE_HEADER) + ('evidenceDate', 'evidenceTime', 'resourceArns')
+    # columns with few distinct values, e.g. account ids, data sources and event names
+    INTERNED_COLUMNS = frozenset(['dataSource', 'evidenceAwsAccountId', 'eventSource', 'eventName', 'evidenceByType',
+        'complianceCheck', 'evidenceFolderId'])
+    # estimated bytes of a record on top of its values which are not interned
+    RECORD_OVERHEAD = 250
+    ROW_GETTER = operator.attrgetter(*CSV_EVIDENCE_HEADER)
+
+    def __init__(self, values, evidenceDate=None, evidenceTime=None, resourceArns=None):
+        for column, value in zip(CSV_EVIDENCE_HEADER, values):
+            if column in self.INTERNED_COLUMNS and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, column, value)
+        self.evidenceDate = sys.intern(evidenceDate) if evidenceDate else None
+        self.evidenceTime = evidenceTime or None
+        # the same resources are collected day after day
+        self.resourceArns = sys.intern(resourceArns) if resourceArns else None
+
+    # the time and resources of the evidence are only kept when it is de-duplicated
+    @classmethod
+    def from_evidence(cls, evidence, exportFormat='csv', dedupFields=False):
+        values = [evidence.get(column) if column in cls.INTERNED_COLUMNS or column == 'id' else render_export_value(evidence.get(column), exportFormat)
+            for column in CSV_EVIDENCE_HEADER]
+        if not dedupFields:
+            return cls(values, evidence_date(evidence))
+        return cls(values, evidence_date(evidence), evidence_time(evidence), evidence_resource_arns(evidence))
+
+    # restores a record from a row of the csv or of the checkpoint, checkpoint rows end with the evidence date, time and resources.
+    # Both hold missing values as empty strings, they are restored as None so that the jsonl export renders them as null
+    @classmethod
+    def from_row(cls, row):
+        values = [None if value == '' else value for value in row[:len(CSV_EVIDENCE_HEADER)]]
+        return cls(values, *row[len(CSV_EVIDENCE_HEADER):len(CSV_EVIDENCE_HEADER) + 3])
+
+    def row(self):
+        return self.ROW_GETTER(self)
+
+    def size(self):
+        return self.RECORD_OVERHEAD + len(self.resourcesIncluded or '') + len(self.attributes or '') + len(self.id or '')
+
+
+# renders a nested value as it is exported: as the csv writer would, or as JSON text for the jsonl export
+def render_export_value(value, exportFormat='csv'):
+    if value is None:
+        return None
+    if exportFormat == 'jsonl':
+        return json.dumps(value, default=str, separators=(',', ':'))
+    return str(value)
+
+# YYYY-MM-DD date on which an evidence was collected
+def evidence_date(evidence):
+    evidenceTime = evidence.get('time')
+    if isinstance(evidenceTime, (datetime.datetime, datetime.date)):
+        return evidenceTime.strftime('%Y-%m-%d')
+    return str(evidenceTime)[:10] if evidenceTime else None
 
+# ISO 8601 time at which an evidence was collected, orders the evidences of a day
+def evidence_time(evidence):
+    evidenceTime = evidence.get('time')
+    if isinstance(evidenceTime, (datetime.datetime, datetime.date)):
+        return evidenceTime.isoformat()
+    return str(evidenceTime) if evidenceTime else None
+
+# comma seperated arns of the resources of an evidence, None if the evidence has no resources
+def evidence_resource_arns(evidence):
+    arns = sorted(set(resource['arn'] for resource in evidence.get('resourcesIncluded') or [] if resource.get('arn')))
+    return ",".join(arns) if arns else None
+
+# projects a page of raw evidences onto records
+def project_evidences(evidences, exportFormat='csv', dedupFields=False):
+    return [EvidenceRecord.from_evidence(evidence, exportFormat, dedupFields) for evidence in evidences]
+
+# projects an evidence onto the csv columns
+def evidence_csv_row(asset):
+    return asset.row()
+
+# projects an evidence onto the csv columns as strings, rendered exactly as the csv writer would, followed by its date,
+# time and resources
+def evidence_checkpoint_row(asset):
+    return ['' if value is None else str(value) for value in evidence_csv_row(asset)] + \
+        [asset.evidenceDate or '', asset.evidenceTime or '', asset.resourceArns or '']
+
+# encodes rows as utf-8 csv
+def encode_csv_rows(rows):
+    csvio = io.StringIO()
+    csv.writer(csvio).writerows(rows)
+    return csvio.getvalue().encode('utf-8')
 
 #compile evidences into csv     
 def compile_evidence_csv(assetList):
@@ -402,13 +1908,117 @@ def compile_evidence_csv(assetList):
     """
     csvio = io.StringIO()
     writer = csv.writer(csvio)
-    writer.writerow(['dataSource', 'evidenceAwsAccountId','eventSource','eventName','evidenceByType','resourcesIncluded','attributes', 'complianceCheck','evidenceFolderId','id'])
+    writer.writerow(CSV_EVIDENCE_HEADER)
     for asset in assetList:
-        writer.writerow([asset['dataSource'],asset['evidenceAwsAccountId'],asset['eventSource'],asset['eventName'],asset['evidenceByType'],asset['resourcesIncluded'],
-        asset['attributes'],asset['complianceCheck'], asset['evidenceFolderId'],asset['id']])
+        writer.writerow(evidence_csv_row(asset))
     return(csvio)
 
 
+class EvidenceSpool:
+    """
+    Evidence records of a run waiting for the csv upload. Records are held in memory up to the memory budget,
+    beyond it they are appended as csv rows to a temporary file which is uploaded instead of the in memory csv
+    """
+    def __init__(self, memoryBudget=None):
+        """
+        :param memoryBudget: estimated bytes of records held in memory, None for unbounded
+        """
+        self.memoryBudget = memoryBudget
+        self.records = []
+        self.size = 0
+        self.count = 0
+        self.spillFile = None
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, records):
+        self.records.extend(records)
+        self.count += len(records)
+        if self.memoryBudget is not None:
+            self.size += sum(record.size() for record in records)
+            if self.size > self.memoryBudget:
+                self.spill()
+
+    def spill(self):
+        if self.spillFile is None:
+            LOGGER.info("evidences exceed the memory budget of {} MiB, spilling them to disk".format(round(self.memoryBudget / 1024 / 1024, 1)))
+            self.spillFile = tempfile.TemporaryFile()
+            self.spillFile.write(encode_csv_rows([CSV_EVIDENCE_HEADER]))
+        self.spillFile.write(encode_csv_rows(evidence_csv_row(record) for record in self.records))
+        self.records = []
+        self.size = 0
+
+    def spilled(self):
+        return self.spillFile is not None
+
+    # returns the complete csv as a binary file object positioned at its start
+    def open_csv(self):
+        if self.spillFile is None:
+            return io.BytesIO(compile_evidence_csv(self.records).getvalue().encode('utf-8'))
+        self.spill()
+        self.spillFile.seek(0)
+        return self.spillFile
+
+    def close(self):
+        self.records = []
+        self.size = 0
+        self.count = 0
+        if self.spillFile is not None:
+            self.spillFile.close()
+            self.spillFile = None
+
+
+# columns of the jsonl export holding JSON text, written as nested values
+JSONL_NESTED_COLUMNS=frozenset(['resourcesIncluded','attributes'])
+# partition value of evidences without an account id or date, as named by hive
+HIVE_DEFAULT_PARTITION='__HIVE_DEFAULT_PARTITION__'
+
+# renders an evidence as a JSON line, the nested columns are already JSON text
+def evidence_json_line(asset):
+    return '{' + ','.join(json.dumps(column) + ':' + (value if column in JSONL_NESTED_COLUMNS and value is not None else json.dumps(value))
+        for column, value in zip(CSV_EVIDENCE_HEADER, evidence_csv_row(asset))) + '}'
+
+
+class PartitionedEvidenceJsonl:
+    """
+    Writes evidences as gzipped JSON lines partitioned by account id and evidence date, in the hive layout
+    account_id=<id>/evidence_date=<YYYY-MM-DD>/ queried by Athena. Every batch of evidences is appended to the local
+    file of its partition as a gzip member of its own, the partitions are uploaded once the report id is known
+    """
+    def __init__(self, name):
+        self.name = name
+        self.directory = tempfile.mkdtemp(prefix='evidence-jsonl-')
+        self.partitions = {}
+        self.rowCount = 0
+
+    def write_evidences(self, evidences):
+        partitionLines = collections.defaultdict(list)
+        for evidence in evidences:
+            partition = (evidence.evidenceAwsAccountId or HIVE_DEFAULT_PARTITION, evidence.evidenceDate or HIVE_DEFAULT_PARTITION)
+            partitionLines[partition].append(evidence_json_line(evidence))
+        for partition, lines in partitionLines.items():
+            if partition not in self.partitions:
+                self.partitions[partition] = os.path.join(self.directory, "part-{:05d}.json.gz".format(len(self.partitions)))
+            compressor = zlib.compressobj(wbits=31)
+            with open(self.partitions[partition], 'ab') as partitionFile:
+                partitionFile.write(compressor.compress(("\n".join(lines) + "\n").encode('utf-8')) + compressor.flush())
+        self.rowCount += len(evidences)
+
+    # uploads every partition under the prefix, returns the number of partitions
+    def upload(self, s3, bucket, prefix):
+        for (accountId, evidenceDate), path in sorted(self.partitions.items()):
+            key = "{}account_id={}/evidence_date={}/{}.json.gz".format(prefix, accountId, evidenceDate, self.name)
+            with open(path, 'rb') as partitionFile:
+                s3.upload_fileobj(partitionFile, bucket, key,
+                    ExtraArgs={'ContentType': 'application/json', 'ACL': 'bucket-owner-full-control'})
+        return len(self.partitions)
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.partitions = {}
+
+
 # store the evicences csv to target s3 bucket
 def put_report_to_s3(csvio,bucket,key):
     """
@@ -416,11 +2026,128 @@ def put_report_to_s3(csvio,bucket,key):
     :param csvio:csv object
     :param key directory where the evidences are to be stored.
     """
-    s3 = boto3.client('s3')
+    s3 = get_aws_client('s3')
     s3.put_object(Body=csvio.getvalue(), ContentType='text/csv', Bucket=bucket, Key=key,ACL='bucket-owner-full-control')
     csvio.close()
 
-def get_assessment_details(id):
+# uploads the evidences csv of a run, a csv spilled to disk is uploaded from the file in multipart parts
+def put_evidence_spool_to_s3(spool,bucket,key):
+    if not spool.spilled():
+        put_report_to_s3(compile_evidence_csv(spool.records),bucket,key)
+    else:
+        get_aws_client('s3').upload_fileobj(spool.open_csv(), bucket, key,
+            ExtraArgs={'ContentType': 'text/csv', 'ACL': 'bucket-owner-full-control'})
+    spool.close()
+
+
+class S3MultipartWriter:
+    """
+    Uploads a stream of bytes to s3 using multipart upload in fixed-size parts,
+    only the current part is held in memory
+    """
+    # s3 requires every part except the last one to be at least 5 MiB
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, s3, bucket, key, partSize, contentType='text/csv', contentEncoding=None):
+        """
+        :param s3: boto3 s3 client
+        :param partSize: size in bytes of the uploaded parts
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.partSize = max(partSize, self.MIN_PART_SIZE)
+        self.buffer = bytearray()
+        self.parts = []
+        self.completed = False
+        extraArgs = {}
+        if contentEncoding:
+            extraArgs['ContentEncoding'] = contentEncoding
+        response = s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=contentType,
+            ACL='bucket-owner-full-control', **extraArgs)
+        self.uploadId = response['UploadId']
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.partSize:
+            self._upload_part(bytes(self.buffer[:self.partSize]))
+            del self.buffer[:self.partSize]
+
+    def _upload_part(self, body):
+        partNumber = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+            PartNumber=partNumber, Body=body)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': partNumber})
+
+    def close(self):
+        # the last part may be smaller than the minimum part size, a multipart upload needs at least one part
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+            MultipartUpload={'Parts': self.parts})
+        self.completed = True
+
+    def abort(self):
+        self.buffer = bytearray()
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId)
+
+
+class StreamingEvidenceCsv:
+    """
+    Writes evidence rows to s3 as folders complete, optionally gzip compressed. The csv itself only
+    takes the multipart part size in memory, the evidences of the folders still in flight
+    (up to 2 * max_workers) are held until their rows are written in folder order
+    """
+    def __init__(self, s3, bucket, key, partSize, compress=False):
+        self.compressor = zlib.compressobj(wbits=31) if compress else None
+        self.writer = S3MultipartWriter(s3, bucket, key, partSize,
+            contentEncoding='gzip' if compress else None)
+        self.rowCount = 0
+        self.write_rows([CSV_EVIDENCE_HEADER])
+
+    def write_rows(self, rows):
+        data = encode_csv_rows(rows)
+        if self.compressor:
+            data = self.compressor.compress(data)
+        if data:
+            self.writer.write(data)
+
+    def write_evidences(self, evidences):
+        self.write_rows([evidence_csv_row(evidence) for evidence in evidences])
+        self.rowCount += len(evidences)
+
+    def close(self):
+        if self.compressor:
+            self.writer.write(self.compressor.flush())
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+    def completed(self):
+        return self.writer.completed
+
+
+# s3 key under which the evidences csv of a report is stored
+def evidence_csv_key(run,reportId):
+    path="evidence_csv/"+run.name+"/"+reportId+"/"+run.name
+    if run.settings.streamCsv and run.settings.gzipCsv:
+        path=path+".gz"
+    return path
+
+# s3 prefix under which the partitioned jsonl evidences of a report are stored
+def evidence_jsonl_prefix(run,reportId):
+    return "evidence_jsonl/"+run.name+"/"+reportId+"/"
+
+# moves the streamed csv from its staging key to the key of the generated report
+def publish_streamed_csv(s3,bucket,stagingKey,key):
+    # managed copy switches to multipart copy for objects larger than 5 GB
+    s3.copy({'Bucket': bucket, 'Key': stagingKey}, bucket, key, ExtraArgs={'ACL': 'bucket-owner-full-control'})
+    s3.delete_object(Bucket=bucket, Key=stagingKey)
+
+
+def get_assessment_details(client,id):
     response = client.get_assessment(assessmentId=id)
     return(response)
 
@@ -431,48 +2158,739 @@ def get_assessment_bucket(assessmentDetails):
                 bucketName=assessmentDetails['assessment']['metadata']['assessmentReportsDestination']['destination']
                 return(bucketName.split("://",1)[1])
 
-# entry point into the program
-def main():
+class CheckpointStore:
+    """
+    Checkpoint of a run in a local directory or under an s3 prefix. The evidences associated while a folder is processed
+    are recorded batch by batch, once the folder completes its rows are recorded as one object and its batch objects
+    are deleted, so a resumed run reads one object per completed folder. The batches of a run associating its evidences
+    after the folders completed, e.g. a de-duplicated run, are not compacted. A folder a sync disassociated before filtering
+    it again is recorded until it completes
+    """
+    # objects read concurrently when the checkpoint is loaded
+    LOAD_WORKERS = 16
+
+    def __init__(self, store, compactBatches=True):
+        self.store = store
+        self.compactBatches = compactBatches
+        # batch and reset objects of the folders not completed yet
+        self.folderNames = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def object_folder_id(name):
+        if name.startswith('reset-'):
+            return name[len('reset-'):-len('.json')]
+        return name[len('batch-'):-len('.json')].rpartition('-')[0]
+
+    def load(self):
+        names = self.store.list()
+        completedFolderIds = set(name[len('folder-'):-len('.json')] for name in names if name.startswith('folder-'))
+        loadNames = []
+        staleNames = []
+        for name in names:
+            if name.startswith(('batch-', 'reset-')) and self.compactBatches:
+                folderId = self.object_folder_id(name)
+                if folderId in completedFolderIds:
+                    # left behind by an attempt which stopped before compacting the folder
+                    staleNames.append(name)
+                    continue
+                self.folderNames[folderId].append(name)
+            loadNames.append(name)
+        if staleNames:
+            self.store.delete_many(staleNames)
+        if not loadNames:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.LOAD_WORKERS, len(loadNames)), thread_name_prefix='checkpoint') as executor:
+            contents = list(executor.map(self.store.read, loadNames))
+        return [json.loads(content) for content in contents if content is not None]
+
+    def record_batch(self, folderId, evidenceIds):
+        name = 'batch-{}-{}.json'.format(folderId, uuid.uuid4().hex)
+        self.store.write(name, json.dumps({'type': 'batch', 'folderId': folderId, 'evidenceIds': list(evidenceIds)}).encode('utf-8'))
+        with self.lock:
+            self.folderNames[folderId].append(name)
+
+    def record_folder(self, folderId, rows, folderAssociated=False):
+        entry = {'type': 'folder', 'folderId': folderId, 'rows': rows}
+        if folderAssociated:
+            entry['association'] = 'folder'
+        self.store.write('folder-' + folderId + '.json', json.dumps(entry, default=str).encode('utf-8'))
+        if self.compactBatches:
+            with self.lock:
+                names = self.folderNames.pop(folderId, [])
+            if names:
+                self.store.delete_many(names)
+
+    def record_reset(self, folderId):
+        name = 'reset-' + folderId + '.json'
+        self.store.write(name, json.dumps({'type': 'reset', 'folderId': folderId}).encode('utf-8'))
+        with self.lock:
+            self.folderNames[folderId].append(name)
+
+    def record_report(self, reportId):
+        self.store.write('report.json', json.dumps({'type': 'report', 'reportId': reportId}).encode('utf-8'))
+
+
+class CheckpointState:
+    """
+    Work completed by earlier attempts of a run, rebuilt from the checkpoint records
+    """
+    def __init__(self, records):
+        self.completedFolders = {}
+        # completed folders which were associated as a whole
+        self.folderAssociations = set()
+        self.associatedIds = {}
+        # folders associated as a whole by the last sync which were already disassociated
+        self.resetFolders = set()
+        self.reportId = None
+        for entry in records:
+            if entry['type'] == 'folder':
+                self.completedFolders[entry['folderId']] = entry['rows']
+                if entry.get('association') == 'folder':
+                    self.folderAssociations.add(entry['folderId'])
+            elif entry['type'] == 'batch':
+                self.associatedIds.setdefault(entry['folderId'], set()).update(entry['evidenceIds'])
+            elif entry['type'] == 'reset':
+                self.resetFolders.add(entry['folderId'])
+            elif entry['type'] == 'report':
+                self.reportId = entry['reportId']
+
+
+# opens the checkpoint store for the location given as a local directory or s3://bucket/prefix
+def open_checkpoint_store(location, assessmentId, runId, compactBatches=True):
+    return CheckpointStore(open_store(location, assessmentId, runId), compactBatches)
+
+
+class SyncState:
+    """
+    Evidences associated to the reports of an assessment by the last sync, and the folders of this run recorded for the next one.
+    The state is a JSON lines file: a header with the watermark, the date of the most recent folder synced, and the filters
+    it was synced with, followed by the exported rows of every folder. Folders collected before the watermark are restored from
+    their rows, later folders are retrieved again. Changed filters drop the watermark, the associated evidences are still
+    known so only the difference is associated or disassociated, folders associated as a whole are disassociated and
+    associated again as they may hold evidences which were not exported. Only the evidence ids of the last sync are held in memory,
+    its rows are copied to a temporary file and read back when a folder is restored
+    """
+    def __init__(self, assessmentId, signature):
+        self.assessmentId = assessmentId
+        self.signature = signature
+        self.watermark = None
+        # evidence ids of every folder of the last sync
+        self.associatedIds = {}
+        # folders the last sync associated as a whole, including evidences it did not export
+        self.associatedFolders = set()
+        # date and offset in previousState of the folders of the last sync, until the folders to process are selected
+        self.previousFolders = {}
+        self.previousState = tempfile.TemporaryFile()
+        # offsets of the folders restored without retrieving them, removed as they are restored
+        self.unchangedFolders = {}
+        self.restoreLock = threading.Lock()
+        # folders of the last sync which are no longer selected
+        self.removedFolders = set()
+        # the folders of this run, written to the state once the report is generated
+        self.records = tempfile.TemporaryFile()
+        self.recordWatermark = None
+
+    # reads the state written by the last sync, a state of other filters keeps the associated evidences but not the watermark
+    def load(self, stateFile):
+        header = json.loads(stateFile.readline())
+        if header.get('signature') == self.signature:
+            self.watermark = header.get('watermark')
+        else:
+            LOGGER.info("the last sync of assessment {} used other filters, retrieving every evidence folder again".format(self.assessmentId))
+        for line in stateFile:
+            offset = self.previousState.tell()
+            self.previousState.write(line if line.endswith(b'\n') else line + b'\n')
+            entry = json.loads(line)
+            self.associatedIds[entry['folderId']] = set(row[CSV_EVIDENCE_HEADER.index('id')] for row in entry['rows'])
+            if entry.get('association') == 'folder':
+                self.associatedFolders.add(entry['folderId'])
+            self.previousFolders[entry['folderId']] = (entry['date'], offset)
+
+    # selects the folders restored from the state and the folders to disassociate, the others are retrieved
+    def select(self, evidenceFolders):
+        selectedIds = set(evidenceFolder['id'] for evidenceFolder in evidenceFolders)
+        self.removedFolders = set(self.previousFolders) - selectedIds
+        for evidenceFolder in evidenceFolders:
+            # the folders of the watermark day may have been synced before audit manager completed them
+            if evidenceFolder['id'] in self.previousFolders and self.watermark and evidence_folder_date(evidenceFolder).isoformat() < self.watermark:
+                self.unchangedFolders[evidenceFolder['id']] = self.previousFolders[evidenceFolder['id']][1]
+        self.previousFolders = {}
+        return len(self.unchangedFolders)
+
+    # reads back the rows of an unchanged folder, once
+    def restore(self, folderId):
+        with self.restoreLock:
+            self.previousState.seek(self.unchangedFolders.pop(folderId))
+            line = self.previousState.readline()
+        return json.loads(line)['rows']
+
+    def record(self, evidenceFolder, evidences, folderAssociated=False):
+        folderDate = evidence_folder_date(evidenceFolder).isoformat()
+        self.recordWatermark = max(self.recordWatermark or folderDate, folderDate)
+        entry = {'folderId': evidenceFolder['id'], 'date': folderDate, 'rows': [evidence_checkpoint_row(evidence) for evidence in evidences]}
+        if folderAssociated:
+            entry['association'] = 'folder'
+        self.records.write((json.dumps(entry) + '\n').encode('utf-8'))
+
+    # writes the header and the recorded folders to a binary file
+    def write(self, stateFile):
+        header = {'assessmentId': self.assessmentId, 'watermark': self.recordWatermark, 'signature': self.signature,
+            'syncedAt': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        stateFile.write((json.dumps(header) + '\n').encode('utf-8'))
+        self.records.seek(0)
+        shutil.copyfileobj(self.records, stateFile)
+
+    def close(self):
+        self.records.close()
+        self.previousState.close()
+        self.unchangedFolders = {}
+
+
+class SyncStateStore:
+    """
+    Sync states in a local directory or under an s3 prefix, one JSON lines object per assessment
+    """
+    def __init__(self, store, assessmentId):
+        self.store = store
+        self.name = assessmentId + '.jsonl'
+
+    # returns the state file opened in binary mode, None before the first sync
+    def open(self):
+        return self.store.open(self.name)
+
+    def save(self, syncState):
+        with tempfile.TemporaryFile() as stateFile:
+            syncState.write(stateFile)
+            stateFile.seek(0)
+            self.store.write(self.name, stateFile)
+
+
+# opens the sync state store for the location given as a local directory or s3://bucket/prefix
+def open_sync_state_store(location, assessmentId):
+    return SyncStateStore(open_store(location), assessmentId)
+
+# filters the evidences of a sync are selected and exported with, a sync with other ones retrieves every folder again
+def sync_signature(run):
+    return {'filters': run.evidenceFilter.describe(), 'filterLatest': run.filterLatest, 'exportFormat': run.settings.exportFormat}
+
+# loads the state of the last sync of a run and selects the folders restored from it
+def prepare_sync_state(run):
+    run.syncState=SyncState(run.assessmentId,sync_signature(run))
+    syncLocation=run.settings.syncLocation
+    store=open_sync_state_store(syncLocation,run.assessmentId)
+    stateFile=store.open()
+    if not stateFile:
+        LOGGER.info("no earlier sync of assessment {} found in {}, every evidence folder is retrieved".format(run.name,syncLocation))
+        return
+    with stateFile:
+        run.syncState.load(stateFile)
+    unchangedCount=run.syncState.select(run.evidenceFolders)
+    LOGGER.info("last sync of assessment {} up to {} : {} evidence folders unchanged, {} to retrieve, {} to disassociate".format(run.name,
+        run.syncState.watermark,unchangedCount,len(run.evidenceFolders) - unchangedCount,len(run.syncState.removedFolders)))
+
+# records the folders of a run whose report is generated as the state of the next sync
+def save_sync_state(run):
     try:
-        #check if audit manager is active
-        if is_account_active() :
-            # get assesment id based on the assesment name provided as input
-            assesmentId = get_assesment_id()
-            if assesmentId:
-                LOGGER.info(("assesment {} found with Id {}").format(assessmentName,assesmentId))
-                #get evidence folders by assesment Id
-                LOGGER.info("retrieving evidence details")
-                evidenceFolders=get_evidence_folders(assesmentId)
-                LOGGER.info("retrieving evidence details, this may take time depending upon the size of the assesment report")
-                #filter evidence folders based on latest date
-                if filterLatestEvidence:
-                    evidenceFolders=get_latest_evidence_folders(evidenceFolders,assesmentId)
-                LOGGER.info("total evidence folders to be processed " + str(len(evidenceFolders)))
-                for evidenceFolder in evidenceFolders:
-                    process_evidences(evidenceFolder,assesmentId)
-                # generate assesment report
-                LOGGER.info("generating report")
-                response=create_assesment_report(assesmentId)
-                #all csv evidence lists
-                bucketName=get_assessment_bucket(get_assessment_details(assesmentId))
-                if bucketName:
-                    path="evidence_csv/"+assessmentName+"/"+response['assessmentReport']['id']+"/"+assessmentName
-                    put_report_to_s3(compile_evidence_csv(csvEvidenceList),bucketName,path)
-                    LOGGER.info("evidences excel workbook uploaded to : " + bucketName)
-                    LOGGER.info("path " + path)
+        open_sync_state_store(run.settings.syncLocation,run.assessmentId).save(run.syncState)
+        LOGGER.info("sync state of assessment {} recorded up to {}".format(run.name,run.syncState.recordWatermark))
+    except Exception:
+        # the next sync starts over from the previous state and retrieves the folders synced since then again
+        LOGGER.exception("unable to record the sync state of assessment %s", run.name)
+    run.syncState.close()
+    run.syncState=None
+
+
+# shard of an evidence folder, stable across shards and job retries even if folders are added in between
+def folder_shard(evidenceFolder,shardCount):
+    return zlib.crc32(evidenceFolder['id'].encode('utf-8')) % shardCount
+
+# writes the partial evidences csv of a shard, the shard is only complete once all of its folders succeeded
+def save_shard_output(run):
+    if run.folderErrors:
+        raise Exception("{} of {} evidence folders could not be processed : {}, the shard output is not written".format(
+            len(run.folderErrors), len(run.evidenceFolders), ", ".join(folderId for folderId, _ in run.folderErrors)))
+    settings=run.settings
+    shardIndex, shardCount=settings.shardIndex, settings.shardCount
+    store=open_shard_store(settings.shardOutputLocation,run.assessmentId,settings.runId)
+    store.save(shardIndex, run.csvEvidenceSpool.open_csv(),
+        {'shardIndex': shardIndex, 'shardCount': shardCount, 'folders': len(run.evidenceFolders), 'evidences': len(run.csvEvidenceSpool)})
+    run.csvEvidenceSpool.close()
+    run.status='SHARD_COMPLETE'
+    LOGGER.info("shard {} of {} written to {}".format(shardIndex,shardCount,settings.shardOutputLocation))
+
+# adds the evidences of the partial csvs of all shards to the run, in shard order
+def merge_shard_outputs(run):
+    settings=run.settings
+    shardCount=settings.shardCount
+    store=open_shard_store(settings.shardOutputLocation,run.assessmentId,settings.runId)
+    summaries=[store.load_summary(index) for index in range(shardCount)]
+    missingShards=[str(index) for index, summary in enumerate(summaries) if summary is None]
+    if missingShards:
+        raise Exception("shards {} of run {} have not completed, the report is not generated".format(", ".join(missingShards),settings.runId))
+    for index in range(shardCount):
+        with store.open_part(index) as partFile:
+            reader=csv.reader(io.TextIOWrapper(partFile, encoding='utf-8', newline=''))
+            next(reader, None)
+            for rows in iter(lambda: list(itertools.islice(reader, 1000)), []):
+                append_csv_evidences(run,[EvidenceRecord.from_row(row) for row in rows])
+    run.shardSummaries=summaries
+    LOGGER.info("merged the evidences of {} shards : {} evidence folders".format(shardCount,sum(summary['folders'] for summary in summaries)))
+
+
+class ShardStore:
+    """
+    Partial evidences csvs of the shards of a run in a local directory or under an s3 prefix,
+    a shard is complete once its summary is written
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def save(self, index, csvFile, summary):
+        self.store.write("part-{:05d}.csv".format(index), csvFile, 'text/csv')
+        self.store.write("part-{:05d}.json".format(index), json.dumps(summary).encode('utf-8'))
+
+    def load_summary(self, index):
+        content = self.store.read("part-{:05d}.json".format(index))
+        return json.loads(content) if content is not None else None
+
+    def open_part(self, index):
+        partFile = self.store.open("part-{:05d}.csv".format(index))
+        if partFile is None:
+            raise Exception("the partial evidences csv of shard {} is missing".format(index))
+        return partFile
+
+
+# opens the shard store for the location given as a local directory or s3://bucket/prefix
+def open_shard_store(location, assessmentId, runId):
+    return ShardStore(open_store(location, assessmentId, runId))
+
+
+# assumed seconds an audit manager call takes, used to size the worker pools and estimate the wall time of a plan
+PLAN_CALL_LATENCY={'get_evidence_by_evidence_folder': 1.0}
+PLAN_DEFAULT_CALL_LATENCY=0.3
+# folder metadata kept in a plan
+PLAN_FOLDER_KEYS=('id', 'controlSetId', 'controlId', 'name', 'dataSource', 'totalEvidence', 'evidenceByTypeManualCount')
+
+# plans the evidence pages and the association of a folder from its metadata.
+# 'folder' association is expected when every evidence may match the filters, the run still falls back to batches
+# when it sees an evidence which does not. Account and compliance filters cannot be judged from the metadata,
+# their folders are associated in batches without holding the ids back
+def plan_folder(run,evidenceFolder):
+    evidenceFilter=run.evidenceFilter
+    totalEvidence=evidenceFolder.get('totalEvidence') or 0
+    matchingEvidence=totalEvidence
+    if evidenceFilter.automaticOnly:
+        matchingEvidence-=evidenceFolder.get('evidenceByTypeManualCount') or 0
+    if run.dedupMode:
+        # the kept evidences are only known once every folder has been seen
+        association='batches'
+    elif not evidenceFilter.has_evidence_predicates():
+        association='folder'
+    elif evidenceFilter.accountIds or evidenceFilter.complianceStatuses or not evidenceFilter.folder_may_fully_match(evidenceFolder) \
+            or evidenceFolder.get('totalEvidence') is None or totalEvidence > MAX_WHOLE_FOLDER_EVIDENCES:
+        association='batches'
+    else:
+        association='folder'
+    folderPlan={key: evidenceFolder[key] for key in PLAN_FOLDER_KEYS if key in evidenceFolder}
+    folderPlan.update({'pages': max(1, -(-totalEvidence // 1000)), 'matchingEvidence': matchingEvidence, 'association': association,
+        'batches': 0 if association == 'folder' else -(-matchingEvidence // MAX_EVIDENCE_IDS_PER_BATCH)})
+    return folderPlan
+
+# plans the selected evidence folders of a run, folders restored from the last sync are not retrieved
+def plan_run(run):
+    return {'name': run.name, 'assessmentId': run.assessmentId, 'filters': run.evidenceFilter.describe(), 'filterLatest': run.filterLatest,
+        'dedup': run.dedupMode, 'folders': [plan_folder(run,evidenceFolder) for evidenceFolder in run.evidenceFolders
+            if not (run.syncState and evidenceFolder['id'] in run.syncState.unchangedFolders)]}
+
+# estimates the api calls and the wall time of the planned runs at the configured rate limit, and picks the worker counts:
+# enough concurrent calls to reach the rate limit of the busiest operation, no more workers than folders or batches
+def estimate_plan(runPlans,maxTps):
+    folders=[folder for runPlan in runPlans for folder in runPlan['folders']]
+    calls=collections.Counter()
+    calls['get_evidence_folders_by_assessment']=len(runPlans)
+    calls['get_evidence_by_evidence_folder']=sum(folder['pages'] for folder in folders)
+    calls['associate_assessment_report_evidence_folder']=sum(1 for folder in folders if folder['association'] == 'folder')
+    calls['batch_associate_assessment_report_evidence']=sum(folder['batches'] for folder in folders)
+    calls['create_assessment_report']=len(runPlans)
+    calls['get_assessment_report_url']=len(runPlans)
+    latency=lambda operation: PLAN_CALL_LATENCY.get(operation, PLAN_DEFAULT_CALL_LATENCY)
+    folderOperations=['get_evidence_by_evidence_folder', 'associate_assessment_report_evidence_folder']
+    batchOperation='batch_associate_assessment_report_evidence'
+    # the worker pools share the connections of the client
+    plannedAssociationWorkers=max(1, min(calls[batchOperation], math.ceil(maxTps * latency(batchOperation)), MAX_POOL_CONNECTIONS // 2))
+    plannedMaxWorkers=max(1, min(len(folders), MAX_POOL_CONNECTIONS - plannedAssociationWorkers,
+        max(math.ceil(maxTps * latency(operation)) for operation in folderOperations)))
+    # the folder workers are busy with the fetches and folder associations, every operation is also paced by its own rate limit
+    folderSeconds=max([sum(calls[operation] * latency(operation) for operation in folderOperations) / plannedMaxWorkers] +
+        [calls[operation] / maxTps for operation in folderOperations])
+    batchSeconds=max(calls[batchOperation] * latency(batchOperation) / plannedAssociationWorkers, calls[batchOperation] / maxTps)
+    return {'maxWorkers': plannedMaxWorkers, 'associationWorkers': plannedAssociationWorkers, 'maxTps': maxTps,
+        'folders': len(folders), 'evidences': sum(folder.get('totalEvidence') or 0 for folder in folders),
+        'apiCalls': sum(calls.values()), 'calls': dict(calls),
+        'estimatedSeconds': round(max(folderSeconds, batchSeconds) + len(runPlans) * (1 + latency('get_evidence_folders_by_assessment')), 1)}
+
+# plans the runs from the metadata of their evidence folders, no evidence is retrieved and no report generated
+def plan_reports(settings,runs):
+    runPlans=[]
+    for run in runs:
+        run.assessmentId, run.bucketName=settings.resolve_assessment(run.name)
+        if not run.assessmentId:
+            raise Exception(("assessment {} not found").format(run.name))
+        run.evidenceFolders=select_evidence_folders(run,get_evidence_folders(settings.client,run.assessmentId))
+        runPlans.append(plan_run(run))
+    plan={'createdAt': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'assessments': runPlans}
+    plan.update(estimate_plan(runPlans,settings.maxTps))
+    for runPlan in runPlans:
+        LOGGER.info("assessment {} : {} evidence folders, {} evidences, {} folder and {} batch associations".format(runPlan['name'],
+            len(runPlan['folders']), sum(folder.get('totalEvidence') or 0 for folder in runPlan['folders']),
+            sum(1 for folder in runPlan['folders'] if folder['association'] == 'folder'), sum(folder['batches'] for folder in runPlan['folders'])))
+    LOGGER.info("plan : {} audit manager calls, estimated {} at {} calls per second per operation with --max_workers {} --association_workers {}".format(
+        plan['apiCalls'], datetime.timedelta(seconds=round(plan['estimatedSeconds'])), settings.maxTps, plan['maxWorkers'], plan['associationWorkers']))
+    if settings.planOutputLocation:
+        save_plan(plan, settings.planOutputLocation)
+        LOGGER.info("plan written to " + settings.planOutputLocation)
+    return plan
+
+# writes a plan to a local path or s3://bucket/key
+def save_plan(plan, location):
+    write_location(location, json.dumps(plan, default=str, indent=1).encode('utf-8'))
+
+# reads a plan written by save_plan
+def load_plan(location):
+    content=read_location(location)
+    if content is None:
+        raise ValueError("plan not found")
+    return json.loads(content.decode('utf-8'))
+
+# planned association of the folders of a run by folder id, None if the plan does not cover the assessment with the same filters
+def planned_folder_associations(run):
+    loadedPlan=run.settings.loadedPlan
+    for runPlan in loadedPlan and loadedPlan['assessments'] or []:
+        if runPlan['name'] != run.name:
+            continue
+        if runPlan['assessmentId'] != run.assessmentId or runPlan['filters'] != run.evidenceFilter.describe() or runPlan['filterLatest'] != run.filterLatest \
+                or runPlan.get('dedup') != run.dedupMode:
+            LOGGER.warning("the plan of assessment {} was made for other filters or an other assessment id, listing its evidence folders".format(run.name))
+            return None
+        return {folder['id']: folder['association'] for folder in runPlan['folders']}
+    return None
+
+# resolves the assessment of a run and the evidence folders to process, opens its checkpoint and csv stream
+# returns False if the run resumes a report which was already generated by an earlier attempt
+def prepare_report_run(run):
+    settings=run.settings
+    # get assesment id and report bucket based on the assesment name provided as input
+    run.assessmentId, run.bucketName=settings.resolve_assessment(run.name)
+    if not run.assessmentId:
+        raise Exception(("assessment {} not found").format(run.name))
+    LOGGER.info(("assesment {} found with Id {}").format(run.name,run.assessmentId))
+    if settings.checkpointLocation:
+        checkpointRunId=settings.checkpointRunId
+        # the evidences of a de-duplicated run are only associated once every folder has completed
+        run.checkpointStore=open_checkpoint_store(settings.checkpointLocation,run.assessmentId,checkpointRunId,compactBatches=not run.dedupMode)
+        LOGGER.info("checkpointing run {} to {}".format(checkpointRunId,settings.checkpointLocation))
+        if settings.resume:
+            run.checkpointState=CheckpointState(run.checkpointStore.load())
+            LOGGER.info("resuming run {} : {} evidence folders already processed".format(checkpointRunId,len(run.checkpointState.completedFolders)))
+            if run.checkpointState.reportId:
+                LOGGER.info("report {} was already generated by this run, waiting for it to complete".format(run.checkpointState.reportId))
+                run.reportId=run.checkpointState.reportId
+                return False
+    if not settings.coordinateShards:
+        #get evidence folders by assesment Id
+        LOGGER.info("retrieving evidence folders of assessment " + run.name)
+        evidenceFolders=get_evidence_folders(settings.client,run.assessmentId)
+        #filter evidence folders based on the folder metadata
+        run.evidenceFolders=select_evidence_folders(run,evidenceFolders)
+        # the folders are listed even with a plan, folders collected since the plan was made are not left out
+        plannedAssociations=planned_folder_associations(run)
+        if plannedAssociations is not None:
+            unplannedCount=0
+            for evidenceFolder in run.evidenceFolders:
+                if evidenceFolder['id'] in plannedAssociations:
+                    evidenceFolder['association']=plannedAssociations[evidenceFolder['id']]
                 else:
-                     LOGGER.info("unable to extract the target S3 bucket, skipping upload of evidences excel workbook")
-                LOGGER.info("Assessment Report Generation initiated, details are as follows : " + str(response['assessmentReport']))
-                # check status of the report
-                reportStatus=check_assesment_report_status(response['assessmentReport']['id'])
-                if reportStatus:
-                    #generating urls of the completed report
-                    assesmentUrls=generate_report_url(response['assessmentReport']['id'],assesmentId)
-                    LOGGER.info('URL details as follows : {}'.format(json.dumps(assesmentUrls['preSignedUrl'], default=str,indent=4)))
+                    unplannedCount+=1
+            LOGGER.info("associating the evidence folders of assessment {} as planned in {}, {} folders collected since the plan are not planned".format(
+                run.name,settings.fromPlanLocation,unplannedCount))
+        if run.dedupMode:
+            # the de-duplication sees the folders from the oldest to the most recent
+            run.evidenceFolders=sorted(run.evidenceFolders, key=evidence_folder_date)
+            run.deduplicator=EvidenceDeduplicator(run.dedupMode, run.evidenceFolders)
+        if settings.syncLocation:
+            if run.dedupMode:
+                raise Exception("the \'dedup\' of a manifest entry cannot be combined with \'--sync\'")
+            prepare_sync_state(run)
+        if settings.shardCount:
+            run.evidenceFolders=[evidenceFolder for evidenceFolder in run.evidenceFolders
+                if folder_shard(evidenceFolder,settings.shardCount) == settings.shardIndex]
+            LOGGER.info("shard {} of {} processes {} evidence folders".format(settings.shardIndex,settings.shardCount,len(run.evidenceFolders)))
+            # the partial csv of a shard is written to the shard output, the report is generated by the coordinator
+            return True
+        LOGGER.info("total evidence folders to be processed for assessment {} : {}".format(run.name,len(run.evidenceFolders)))
+    if settings.exportFormat == 'jsonl' and run.bucketName:
+        run.evidenceJsonl=PartitionedEvidenceJsonl(run.name)
+    elif settings.streamCsv and run.bucketName:
+        # the report id is only known once all evidences are associated, stream to a staging key until then
+        run.stagingPath="evidence_csv/"+run.name+"/staging/"+str(uuid.uuid4())+"/"+run.name
+        run.csvEvidenceStream=StreamingEvidenceCsv(get_aws_client('s3'),run.bucketName,run.stagingPath,settings.partSize,compress=settings.gzipCsv)
+        LOGGER.info("streaming evidences csv to staging path " + run.stagingPath)
+    if settings.coordinateShards:
+        try:
+            merge_shard_outputs(run)
+        except Exception:
+            if run.csvEvidenceStream:
+                run.csvEvidenceStream.abort()
+                run.csvEvidenceStream=None
+            raise
+    return True
+
+# generates the report of a run whose folders are all processed and uploads its evidences csv
+def generate_run_report(run):
+    # a report missing the evidences of failed folders would look complete, do not generate it
+    if run.folderErrors:
+        raise Exception("{} of {} evidence folders could not be processed : {}, the report is not generated".format(
+            len(run.folderErrors), len(run.evidenceFolders), ", ".join(folderId for folderId, _ in run.folderErrors)))
+    if run.csvEvidenceStream:
+        run.csvEvidenceStream.close()
+    # generate assesment report
+    LOGGER.info("generating report for assessment " + run.name)
+    try:
+        response=create_assesment_report(run.settings.client,run.assessmentId)
+        #all csv evidence lists
+        if run.bucketName:
+            path=evidence_csv_key(run,response['assessmentReport']['id'])
+            if run.evidenceJsonl:
+                path=evidence_jsonl_prefix(run,response['assessmentReport']['id'])
+                partitionCount=run.evidenceJsonl.upload(get_aws_client('s3'),run.bucketName,path)
+                LOGGER.info("{} evidences exported in {} partitions".format(run.evidenceJsonl.rowCount,partitionCount))
+                run.evidenceJsonl.close()
+                run.evidenceJsonl=None
+            elif run.csvEvidenceStream:
+                publish_streamed_csv(get_aws_client('s3'),run.bucketName,run.stagingPath,path)
             else:
-                raise Exception(("assessment {} not found").format(assessmentName))
+                put_evidence_spool_to_s3(run.csvEvidenceSpool,run.bucketName,path)
+            LOGGER.info("evidences excel workbook uploaded to : " + run.bucketName)
+            LOGGER.info("path " + path)
+        else:
+             LOGGER.info("unable to extract the target S3 bucket, skipping upload of evidences excel workbook")
+    except Exception:
+        if run.evidenceJsonl:
+            run.evidenceJsonl.close()
+            run.evidenceJsonl=None
+        # the completed staging object is not moved to the report, do not leave it behind
+        if run.csvEvidenceStream:
+            run.csvEvidenceStream=None
+            get_aws_client('s3').delete_object(Bucket=run.bucketName, Key=run.stagingPath)
+        raise
+    run.csvEvidenceSpool.close()
+    LOGGER.info("Assessment Report Generation initiated, details are as follows : " + str(response['assessmentReport']))
+    run.reportId=response['assessmentReport']['id']
+    if run.checkpointStore:
+        run.checkpointStore.record_report(run.reportId)
+    if run.syncState:
+        save_sync_state(run)
+
+# logs the outcome of every assessment, in manifest mode the summary is also published to the sns topic
+def publish_run_results(settings,runs):
+    results=[run.result() for run in runs]
+    for result in results:
+        LOGGER.info("assessment result : " + json.dumps(result, default=str))
+    if settings.manifestLocation and settings.snsTopic:
+        publish_to_sns_topic(json.dumps(results, default=str, indent=4),"manifest " + settings.manifestLocation,settings.snsTopic)
+
+
+# prepares, processes and generates the reports of the runs stage by stage
+def generate_reports(settings,runs):
+    runMetrics=settings.runMetrics
+    processRuns=[]
+    with runMetrics.stage('prepare'):
+        for run in runs:
+            try:
+                try:
+                    ready=prepare_report_run(run)
+                except ClientError as error:
+                    # the cached id may belong to an assessment deleted or recreated since the index was cached
+                    if error.response.get('Error', {}).get('Code') != 'ResourceNotFoundException' or not settings.assessmentIndex.invalidate(run.name,settings.startedAt):
+                        raise
+                    LOGGER.info("assessment {} not found by its cached id, resolving it again".format(run.name))
+                    ready=prepare_report_run(run)
+                if ready:
+                    processRuns.append(run)
+            except Exception as error:
+                run.fail(error)
+    LOGGER.info("retrieving evidence details, this may take time depending upon the size of the assesment report")
+    if processRuns:
+        estimate=estimate_plan([plan_run(run) for run in processRuns],settings.maxTps)
+        LOGGER.info("estimated {} audit manager calls for {} evidence folders, about {} with {} workers (planned {})".format(estimate['apiCalls'],
+            estimate['folders'],datetime.timedelta(seconds=round(estimate['estimatedSeconds'])),settings.maxWorkers,estimate['maxWorkers']))
+    with runMetrics.stage('process_folders'):
+        # the folders of all assessments are scheduled together on the shared workers and rate limiter
+        process_evidence_folders(settings,processRuns)
+    processRuns=[run for run in processRuns if not run.failed()]
+    with runMetrics.stage('deduplicate'):
+        for run in processRuns:
+            if run.deduplicator and not run.folderErrors:
+                try:
+                    associate_deduplicated_evidences(run)
+                except Exception as error:
+                    run.fail(error)
+    with runMetrics.stage('sync'):
+        for run in processRuns:
+            if run.syncState and run.syncState.removedFolders and not run.folderErrors:
+                try:
+                    disassociate_removed_folders(run)
+                except Exception as error:
+                    run.fail(error)
+    processRuns=[run for run in processRuns if not run.failed()]
+    with runMetrics.stage('generate_reports'):
+        for run in processRuns:
+            try:
+                if settings.shardCount and not settings.coordinateShards:
+                    save_shard_output(run)
+                else:
+                    generate_run_report(run)
+            except Exception as error:
+                run.fail(error)
+    with runMetrics.stage('wait_for_reports'):
+        wait_and_publish_reports(settings,[run for run in runs if run.reportId])
+
+
+# namespace of the metrics published in embedded metric format
+EMF_NAMESPACE='AuditManagerReportGenerator'
+
+# builds a CloudWatch embedded metric format document of the numeric values for the given dimensions
+def emf_document(dimensions, values):
+    units={'elapsed_seconds': 'Seconds', 'folders_per_second': 'Count/Second', 'peak_memory_mb': 'Megabytes'}
+    metrics=[]
+    for name, value in values.items():
+        if isinstance(value, (int, float)):
+            unit='Milliseconds' if name.startswith('latency_ms') else ('Seconds' if name.startswith('stage_') else units.get(name, 'Count'))
+            metrics.append({'Name': name, 'Unit': unit})
+    document={'_aws': {'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{'Namespace': EMF_NAMESPACE, 'Dimensions': [list(dimensions)], 'Metrics': metrics}]}}
+    document.update(dimensions)
+    document.update({metric['Name']: values[metric['Name']] for metric in metrics})
+    return document
+
+# logs the metrics of the run as JSON, or prints them as embedded metric format documents
+def emit_run_metrics(settings, runs, profiler=None):
+    runMetrics=settings.runMetrics
+    client=settings.client
+    for run in runs:
+        runMetrics.merge(run.metrics)
+    summary={'run': runMetrics.summary(), 'peak_memory_mb': peak_memory_mb(),
+        'assessments': {run.name: run.metrics.summary() for run in runs}}
+    if isinstance(client, RateLimitedClient):
+        summary['api']=client.statistics()
+    if settings.profileRun:
+        summary['stages']=runMetrics.stage_summary()
+    if settings.metricsFormat == 'emf':
+        runValues=dict(summary['run'], peak_memory_mb=summary['peak_memory_mb'])
+        runValues.update({'stage_' + name: seconds for name, seconds in summary.get('stages', {}).items()})
+        documents=[emf_document({}, runValues)]
+        documents.extend(emf_document({'Assessment': name}, values) for name, values in summary['assessments'].items())
+        for operation, statistics in summary.get('api', {}).items():
+            values={name: value for name, value in statistics.items() if name != 'latency_ms_total'}
+            if statistics.get('calls'):
+                values['latency_ms_average']=round(statistics.get('latency_ms_total', 0) / statistics['calls'], 1)
+            documents.append(emf_document({'Operation': operation}, values))
+        for document in documents:
+            print(json.dumps(document), flush=True)
+    else:
+        LOGGER.info("run metrics : " + json.dumps(summary, default=str))
+    if profiler:
+        profileOutput=io.StringIO()
+        stats=pstats.Stats(profiler, stream=profileOutput)
+        if settings.workerProfileStats:
+            stats.add(settings.workerProfileStats)
+        stats.sort_stats('cumulative').print_stats(25)
+        LOGGER.info("profile of the run : \n" + profileOutput.getvalue())
+
+
+# since python 3.12 cProfile is built on sys.monitoring: a profiler sees every thread of the process and only one profiler
+# may be active at a time, enabling another one raises ValueError
+PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+# runs a task of a worker thread under its own profiler in --profile mode, before python 3.12 cProfile only sees the
+# thread it is enabled in. A process wide profiler already sees the worker threads
+def run_profiled(settings, function, *args):
+    if not settings.profileRun or PROCESS_WIDE_PROFILER:
+        return function(*args)
+    profiler=cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        # merged right away, keeping a profile per task would hold a function table per folder
+        with settings.workerProfileLock:
+            if settings.workerProfileStats is None:
+                settings.workerProfileStats=pstats.Stats(profiler)
+            else:
+                settings.workerProfileStats.add(profiler)
+
+
+# generates the reports of the assessments given by the options, as returned by parse_options() or options_from_event()
+# returns the exit code of the run and the outcome of every assessment
+def generate_assessment_reports(options):
+    LOGGER.info("executing script")
+    try:
+        settings=ReportSettings(options)
+    except ValueError as error:
+        LOGGER.error(" {}".format(error))
+        return {'exitCode': 1, 'results': []}
+    runs=[]
+    exitCode=0
+    profiler=cProfile.Profile() if settings.profileRun else None
+    if profiler:
+        try:
+            profiler.enable()
+        except ValueError:
+            # a process wide profiler already enabled, e.g. by a concurrent invocation, the stage timings are still kept
+            LOGGER.warning("another profiler is active in the process, only the stages of the run are timed")
+            profiler=None
+    try:
+        if settings.completePending:
+            complete_pending_reports(settings)
+            return {'exitCode': 0, 'results': []}
+        #check if audit manager is active
+        if not is_account_active(settings.client):
+            LOGGER.error("audit manager is not active in this account and region")
+            return {'exitCode': 1, 'results': []}
+        if settings.planOnly:
+            return {'exitCode': 0, 'results': [], 'plan': plan_reports(settings,load_report_runs(settings))}
+        runs.extend(load_report_runs(settings))
+        generate_reports(settings,runs)
+        publish_run_results(settings,runs)
+        if any(run.failed() for run in runs):
+            exitCode=1
     except Exception as e:
         LOGGER.error(" exception: {}".format(e))
+        exitCode=1
+    finally:
+        if profiler:
+            profiler.disable()
+        emit_run_metrics(settings, runs, profiler)
+        for run in runs:
+            run.close()
+        settings.close()
+    return {'exitCode': exitCode, 'results': [run.result() for run in runs]}
+
+# entry point into the program
+def main(argv=None):
+    configure_logging()
+    return generate_assessment_reports(parse_options(argv))['exitCode']
+
+# entry point of AWS Lambda or of a long-lived worker, the event holds the options as described in options_from_event().
+# Warm invocations reuse the clients, their credentials and connections, and the assessment index. The report timeout
+# is capped to the remaining time of the invocation, reports still being generated are recorded with --pending_reports
+def lambda_handler(event, context=None):
+    configure_logging()
+    options=options_from_event(event)
+    if context and hasattr(context, 'get_remaining_time_in_millis'):
+        # keep time to upload the evidences and record the pending report
+        options.reportTimeout=min(options.reportTimeout, max(0, context.get_remaining_time_in_millis() // 1000 - 60))
+    return generate_assessment_reports(options)
 
 if __name__ == '__main__':
-    exit(main())
\ No newline at end of file
+    exit(main())
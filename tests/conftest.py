@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+
+import boto3
+import pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# script.py and the fakes are imported by the in-process tests
+sys.path.insert(0, REPOSITORY)
+import script
+
+
+# runs script.py in its own process against the fake audit manager, returns the summary of the fake after the run
+@pytest.fixture
+def run_fake(tmp_path):
+    def run(summaryName, scriptArgs, fakeOptions=()):
+        summaryPath = str(tmp_path / summaryName)
+        command = [sys.executable, os.path.join(REPOSITORY, 'fake_auditmanager.py')] + list(fakeOptions) + \
+            ['--fake_s3_dir', str(tmp_path / 's3'), '--fake_summary', summaryPath, '--'] + list(scriptArgs)
+        environment = {key: value for key, value in os.environ.items() if not key.startswith('AWS_BATCH_')}
+        completed = subprocess.run(command, cwd=str(tmp_path), env=environment, capture_output=True, text=True, timeout=300)
+        assert os.path.exists(summaryPath), completed.stderr
+        with open(summaryPath) as summaryFile:
+            summary = json.load(summaryFile)
+        assert summary['exitCode'] == completed.returncode, completed.stderr
+        summary['log'] = completed.stderr
+        summary['output'] = completed.stdout
+        return summary
+    return run
+
+
+# replaces the boto3 clients of script.py, run in this process, by the given fakes for the duration of a test
+@pytest.fixture
+def install_fakes(monkeypatch):
+    def install(fakeClients):
+        monkeypatch.setattr(boto3, 'client', lambda service, *args, **kwargs: fakeClients[service])
+        monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'fake')
+        monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'fake')
+        monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+        # a cold process
+        monkeypatch.setattr(script, 'awsClients', {})
+        monkeypatch.setattr(script, 'assessmentIndexes', {})
+        return fakeClients
+    return install
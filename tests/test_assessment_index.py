@@ -0,0 +1,27 @@
+# resolution of the assessment name through the paged listing and the cached assessment index
+ASSESSMENTS = ','.join('assessment-{}'.format(index) for index in range(25))
+
+
+def test_assessment_found_on_a_later_page(run_fake):
+    # the fake returns 10 assessments per page, the assessment is on the third page
+    summary = run_fake('run.json', ['--name', 'assessment-23'], ['--fake_assessments', ASSESSMENTS, '--fake_folders', '2'])
+    assert summary['exitCode'] == 0
+    assert summary['calls']['list_assessments'] == 3
+    assert summary['reports'][0]['assessmentId'] == 'assessment-0023'
+
+
+def test_cached_index_skips_the_lookup(tmp_path, run_fake):
+    options = ['--fake_assessments', ASSESSMENTS, '--fake_folders', '2', '--fake_bucket', 'reports']
+    cache = ['--assessment_cache', str(tmp_path / 'index.json')]
+    first = run_fake('first.json', ['--name', 'assessment-3'] + cache, options)
+    assert first['calls']['list_assessments'] == 3 and first['calls']['get_assessment'] == 1
+    second = run_fake('second.json', ['--name', 'assessment-3'] + cache, options)
+    assert second['exitCode'] == 0
+    assert 'list_assessments' not in second['calls'] and 'get_assessment' not in second['calls']
+    # a name missing from the cached index rebuilds it
+    third = run_fake('third.json', ['--name', 'assessment-new'] + cache, ['--fake_assessments', ASSESSMENTS + ',assessment-new', '--fake_folders', '2'])
+    assert third['exitCode'] == 0
+    assert third['calls']['list_assessments'] == 3
+    # an expired index is rebuilt
+    fourth = run_fake('fourth.json', ['--name', 'assessment-3', '--assessment_cache_ttl', '0'] + cache, options)
+    assert fourth['calls']['list_assessments'] == 3
@@ -0,0 +1,47 @@
+# smoke run of the benchmark and the simulated failure modes of the fake audit manager
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark
+
+
+def test_benchmark_smoke_scale_matches_baseline(tmp_path):
+    output = str(tmp_path / 'results.json')
+    # the call counts are deterministic, wall time and memory depend on the machine
+    assert benchmark.main(['--scales', 'smoke', '--output', output, '--baseline', os.path.join(benchmark.REPOSITORY, 'benchmark_baseline.json'),
+        '--tolerance', '10']) == 0
+    with open(output) as outputFile:
+        results = json.load(outputFile)
+    assert [result['scenario'] for result in results] == list(benchmark.SCENARIOS)
+
+
+def test_regressions_are_reported():
+    baseline = [{'scale': 'small', 'scenario': 'filtered', 'apiCalls': 100, 'wallSeconds': 1.0, 'peakMemoryMb': 50}]
+    results = [dict(baseline[0], exitCode=0, apiCalls=120, wallSeconds=1.2, peakMemoryMb=90)]
+    regressions = benchmark.find_regressions(results, baseline, 0.5)
+    assert len(regressions) == 2
+    assert 'calls' in regressions[0] and 'MiB' in regressions[1]
+
+
+def test_scenario_missing_from_the_baseline_is_reported():
+    results = [{'scale': 'small', 'scenario': 'filtered_jsonl', 'exitCode': 0, 'apiCalls': 100, 'wallSeconds': 1.0, 'peakMemoryMb': 50}]
+    assert benchmark.find_regressions(results, [], 0.5) == ['filtered_jsonl@small has no baseline, record it with --output']
+
+
+def test_throttled_run_associates_every_evidence(run_fake):
+    args = ['--name', 'test', '--filter_automatic', 'True', '--max_tps', '1000']
+    expected = run_fake('expected.json', args, ['--fake_folders', '8'])
+    throttled = run_fake('throttled.json', args, ['--fake_folders', '8', '--fake_throttle_rate', '0.3'])
+    assert throttled['exitCode'] == 0
+    assert sum(throttled['throttles'].values()) > 0
+    assert throttled['associatedIds'] == expected['associatedIds']
+
+
+def test_report_still_in_progress_is_recorded_as_pending(tmp_path, run_fake):
+    summary = run_fake('run.json', ['--name', 'test', '--report_timeout', '0', '--pending_reports', str(tmp_path / 'pending')],
+        ['--fake_folders', '2', '--fake_report_polls', '3'])
+    assert summary['exitCode'] == 0
+    assert summary['reports'][0]['status'] == 'IN_PROGRESS'
+    assert os.listdir(str(tmp_path / 'pending')) == [summary['reports'][0]['id'] + '.json']
@@ -0,0 +1,59 @@
+# a run killed part way must resume from its checkpoint without associating any evidence twice
+import collections
+import csv
+import io
+
+import pytest
+
+import fake_auditmanager
+import script
+
+
+class KilledAuditManager(fake_auditmanager.FakeAuditManager):
+    """
+    Audit manager whose calls are all interrupted once a number of evidence batches have been associated,
+    as if the process had been killed. Every associated evidence id is counted
+    """
+    def __init__(self, killAfterBatches, **kwargs):
+        super().__init__(**kwargs)
+        self.killAfterBatches = killAfterBatches
+        self.associationCounts = collections.Counter()
+
+    def call(self, operation):
+        if self.killAfterBatches is not None and self.calls.get('batch_associate_assessment_report_evidence', 0) >= self.killAfterBatches:
+            raise KeyboardInterrupt()
+        super().call(operation)
+
+    def batch_associate_assessment_report_evidence(self, assessmentId, evidenceFolderId, evidenceIds):
+        response = super().batch_associate_assessment_report_evidence(assessmentId, evidenceFolderId, evidenceIds)
+        with self.lock:
+            self.associationCounts.update(evidenceIds)
+        return response
+
+
+def test_resumed_run_associates_every_evidence_once(tmp_path, install_fakes):
+    fake = KilledAuditManager(5, folders=6, evidencesPerFolder=120, bucket='reports')
+    fakeS3 = fake_auditmanager.FakeS3()
+    install_fakes({'auditmanager': fake, 's3': fakeS3, 'sns': fake_auditmanager.FakeSns()})
+    args = ['--name', 'test', '--filter_automatic', 'True', '--max_workers', '2', '--checkpoint', str(tmp_path / 'checkpoint'),
+        '--run_id', 'run-1']
+    with pytest.raises(KeyboardInterrupt):
+        script.generate_assessment_reports(script.parse_options(args))
+    assert fake.reports == []
+    killedIds = set(fake.associationCounts)
+    assert killedIds
+
+    fake.killAfterBatches = None
+    folderCalls = fake.calls['get_evidence_by_evidence_folder']
+    outcome = script.generate_assessment_reports(script.parse_options(args + ['--resume']))
+    assert outcome['exitCode'] == 0 and len(fake.reports) == 1
+    # the folders completed before the kill are restored from the checkpoint
+    assert fake.calls['get_evidence_by_evidence_folder'] - folderCalls < 6
+    expectedIds = set(evidence['id'] for folder in fake.folders['assessment-0000']
+        for evidence in (fake.generate_evidence(folder, number) for number in range(120))
+        if evidence['evidenceByType'] != 'Manual' and evidence['complianceCheck'] != 'NOT_APPLICABLE')
+    assert set(fake.associationCounts) == expectedIds
+    assert max(fake.associationCounts.values()) == 1
+    # the csv holds the evidences of the restored and of the retrieved folders
+    csvRows = list(csv.DictReader(io.StringIO(fakeS3.load('reports', 'evidence_csv/test/' + fake.reports[0]['id'] + '/test').decode('utf-8'))))
+    assert sorted(row['id'] for row in csvRows) == sorted(expectedIds)
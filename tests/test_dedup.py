@@ -0,0 +1,48 @@
+# de-duplicated runs must associate and export exactly the evidences kept by an independent replay of the snapshots
+import csv
+
+import fake_auditmanager
+
+FAKE_OPTIONS = ['--fake_folders', '27', '--fake_controls', '3', '--fake_evidences', '13', '--fake_bucket', 'reports']
+
+
+# replays the 9 daily snapshots of the fake in date order, the results change every 3 days,
+# returns the ids kept in 'latest' and 'changes' mode
+def expected_evidence_ids():
+    fake = fake_auditmanager.FakeAuditManager(folders=27, controls=3, evidencesPerFolder=13)
+    latest = {}
+    changes = set()
+    lastResults = {}
+    for folder in sorted(fake.folders['assessment-0000'], key=lambda folder: folder['date']):
+        for number in range(13):
+            evidence = fake.generate_evidence(folder, number)
+            if evidence['complianceCheck'] == 'NOT_APPLICABLE':
+                continue
+            series = (folder['controlId'], evidence['resourcesIncluded'][0]['arn'], evidence['dataSource'])
+            latest[series + (evidence['complianceCheck'],)] = evidence['id']
+            if lastResults.get(series) != evidence['complianceCheck']:
+                changes.add(evidence['id'])
+                lastResults[series] = evidence['complianceCheck']
+    return set(latest.values()), changes
+
+
+def exported_ids(tmp_path, result):
+    with open(str(tmp_path / 's3' / 'reports' / 'evidence_csv' / 'test' / result['reports'][0]['id'] / 'test'), newline='') as csvFile:
+        return [row['id'] for row in csv.DictReader(csvFile)]
+
+
+def test_dedup_modes_keep_one_evidence_per_state(tmp_path, run_fake):
+    latestIds, changeIds = expected_evidence_ids()
+    everything = run_fake('all.json', ['--name', 'test'], FAKE_OPTIONS)
+    allCount = len(exported_ids(tmp_path, everything))
+    assert len(latestIds) < len(changeIds) < allCount
+
+    for mode, expectedIds in (('latest', latestIds), ('changes', changeIds)):
+        result = run_fake(mode + '.json', ['--name', 'test', '--dedup', mode, '--max_workers', '4'], FAKE_OPTIONS)
+        assert result['exitCode'] == 0
+        exported = exported_ids(tmp_path, result)
+        assert len(exported) == len(set(exported))
+        assert set(exported) == expectedIds
+        assert set(result['associatedIds']['assessment-0000']) == expectedIds
+        assert result['associatedFolders']['assessment-0000'] == []
+        assert 'de-duplication kept {} of {} evidences'.format(len(expectedIds), allCount) in result['log']
@@ -0,0 +1,85 @@
+# the partitioned jsonl export must hold the same evidences as the csv, with nested values and hive partitions
+import csv
+import gzip
+import json
+import os
+
+FAKE_OPTIONS = ['--fake_folders', '6', '--fake_evidences', '80', '--fake_bucket', 'reports']
+
+
+# evidences of the jsonl export of a run by id
+def exported_evidences(tmp_path, result):
+    root = tmp_path / 's3' / 'reports' / 'evidence_jsonl' / 'test' / result['reports'][0]['id']
+    evidences = {}
+    for directory, _, fileNames in os.walk(str(root)):
+        for fileName in fileNames:
+            with gzip.open(os.path.join(directory, fileName), 'rt') as jsonlFile:
+                for line in jsonlFile:
+                    evidence = json.loads(line)
+                    evidences[evidence['id']] = evidence
+    return evidences
+
+
+def test_jsonl_export_matches_csv(tmp_path, run_fake):
+    filters = ['--name', 'test', '--filter_automatic', 'True', '--max_workers', '2']
+    csvRun = run_fake('csv.json', filters, FAKE_OPTIONS)
+    assert csvRun['exitCode'] == 0
+    with open(str(tmp_path / 's3' / 'reports' / 'evidence_csv' / 'test' / csvRun['reports'][0]['id'] / 'test'), newline='') as csvFile:
+        csvRows = {row['id']: row for row in csv.DictReader(csvFile)}
+
+    jsonlRun = run_fake('jsonl.json', filters + ['--export_format', 'jsonl'], FAKE_OPTIONS)
+    assert jsonlRun['exitCode'] == 0
+    root = tmp_path / 's3' / 'reports' / 'evidence_jsonl' / 'test' / jsonlRun['reports'][0]['id']
+    evidences = {}
+    partitions = set()
+    for directory, _, fileNames in os.walk(str(root)):
+        for fileName in fileNames:
+            assert fileName == 'test.json.gz'
+            partition = dict(part.split('=', 1) for part in os.path.relpath(directory, str(root)).split(os.sep))
+            partitions.add((partition['account_id'], partition['evidence_date']))
+            # every batch is a gzip member of its own
+            with gzip.open(os.path.join(directory, fileName), 'rt') as jsonlFile:
+                for line in jsonlFile:
+                    evidence = json.loads(line)
+                    assert evidence['evidenceAwsAccountId'] == partition['account_id']
+                    evidences[evidence['id']] = evidence
+    assert len(partitions) > 1
+    # the fake spreads the folders over 3 days
+    assert {date for _, date in partitions} == {'2024-01-01', '2024-01-02', '2024-01-03'}
+    assert set(evidences) == set(csvRows)
+    for evidenceId, evidence in evidences.items():
+        assert isinstance(evidence['resourcesIncluded'], list) and isinstance(evidence['attributes'], dict)
+        assert str(evidence['attributes']) == csvRows[evidenceId]['attributes']
+        assert evidence['eventName'] == csvRows[evidenceId]['eventName']
+
+
+def test_jsonl_export_rejects_streamed_csv(run_fake):
+    result = run_fake('rejected.json', ['--name', 'test', '--export_format', 'jsonl', '--stream_csv'], FAKE_OPTIONS)
+    assert result['exitCode'] == 1
+    assert result['reports'] == []
+
+
+def test_jsonl_export_of_restored_folders_keeps_missing_values_null(tmp_path, run_fake):
+    fakeOptions = ['--fake_evidences', '40', '--fake_bucket', 'reports', '--fake_no_resources_ratio', '0.2']
+    filters = ['--name', 'test', '--filter_automatic', 'True', '--max_workers', '2', '--export_format', 'jsonl']
+    full = run_fake('full.json', filters, fakeOptions + ['--fake_folders', '9'])
+    assert full['exitCode'] == 0
+    expected = exported_evidences(tmp_path, full)
+    assert any(evidence['resourcesIncluded'] is None for evidence in expected.values())
+
+    # folders of the days before the watermark are restored from the sync state
+    syncArgs = filters + ['--sync', str(tmp_path / 'sync')]
+    assert run_fake('first.json', syncArgs, fakeOptions + ['--fake_folders', '6'])['exitCode'] == 0
+    synced = run_fake('synced.json', syncArgs, fakeOptions + ['--fake_folders', '9'])
+    assert synced['exitCode'] == 0
+    assert synced['calls']['get_evidence_by_evidence_folder'] < 9
+    assert exported_evidences(tmp_path, synced) == expected
+
+    # every folder is restored from the checkpoint of a run stopped before its report was created
+    checkpointArgs = filters + ['--checkpoint', str(tmp_path / 'checkpoint'), '--run_id', 'run-1']
+    assert run_fake('checkpointed.json', checkpointArgs, fakeOptions + ['--fake_folders', '9'])['exitCode'] == 0
+    os.remove(str(tmp_path / 'checkpoint' / 'assessment-0000' / 'run-1' / 'report.json'))
+    resumed = run_fake('resumed.json', checkpointArgs + ['--resume'], fakeOptions + ['--fake_folders', '9'])
+    assert resumed['exitCode'] == 0
+    assert 'get_evidence_by_evidence_folder' not in resumed['calls']
+    assert exported_evidences(tmp_path, resumed) == expected
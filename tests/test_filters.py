@@ -0,0 +1,81 @@
+# folder level filters must prune folders before their evidences are retrieved, evidence level filters are checked one by one
+import datetime
+
+import pytest
+
+import fake_auditmanager
+import script
+
+DATA_SOURCES = ('AWS Config', 'AWS Security Hub', 'AWS CloudTrail')
+
+
+class RecordingAuditManager(fake_auditmanager.FakeAuditManager):
+    """
+    Audit manager recording the folders whose evidences are retrieved
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.retrievedFolders = set()
+
+    def get_evidence_by_evidence_folder(self, assessmentId, controlSetId, evidenceFolderId, maxResults=None, nextToken=None):
+        with self.lock:
+            self.retrievedFolders.add(evidenceFolderId)
+        return super().get_evidence_by_evidence_folder(assessmentId, controlSetId, evidenceFolderId, maxResults, nextToken)
+
+
+@pytest.fixture
+def fake(install_fakes):
+    # 12 folders over 3 days, alternating between 2 control sets and cycling through 3 data sources
+    fake = RecordingAuditManager(folders=12, evidencesPerFolder=60, bucket='reports', dataSources=DATA_SOURCES)
+    install_fakes({'auditmanager': fake, 's3': fake_auditmanager.FakeS3(), 'sns': fake_auditmanager.FakeSns()})
+    return fake
+
+
+def generate(args):
+    return script.generate_assessment_reports(script.parse_options(['--name', 'test', '--max_workers', '2'] + args))
+
+
+def matching_ids(fake, folders, evidencePredicate):
+    return set(evidence['id'] for folder in folders for evidence in (fake.generate_evidence(folder, number) for number in range(60))
+        if evidence['complianceCheck'] != 'NOT_APPLICABLE' and evidencePredicate(evidence))
+
+
+def test_folder_filters_prune_folders_before_their_evidences_are_retrieved(fake):
+    outcome = generate(['--from_date', '2024-01-02', '--to_date', '2024-01-03', '--control_set_ids', 'control-set-0',
+        '--data_sources', 'AWS Config,AWS CloudTrail', '--compliance_status', 'NON_COMPLIANT', '--filter_automatic', 'True'])
+    assert outcome['exitCode'] == 0
+    folders = [folder for folder in fake.folders['assessment-0000'] if folder['date'] >= datetime.datetime(2024, 1, 2)
+        and folder['controlSetId'] == 'control-set-0' and folder['dataSource'] != 'AWS Security Hub']
+    assert 0 < len(folders) < 12
+    assert fake.retrievedFolders == set(folder['id'] for folder in folders)
+    assert fake.calls['get_evidence_by_evidence_folder'] == len(folders)
+    expectedIds = matching_ids(fake, folders, lambda evidence: evidence['complianceCheck'] == 'NON_COMPLIANT'
+        and evidence['evidenceByType'] != 'Manual')
+    assert expectedIds and fake.associatedIds['assessment-0000'] == expectedIds
+    assert outcome['results'][0]['metrics']['evidences_exported'] == len(expectedIds)
+
+
+def test_date_filter_alone_associates_the_folders_as_a_whole(fake):
+    assert generate(['--to_date', '2024-01-01'])['exitCode'] == 0
+    folders = [folder for folder in fake.folders['assessment-0000'] if folder['date'] == datetime.datetime(2024, 1, 1)]
+    assert fake.associatedFolders['assessment-0000'] == set(folder['id'] for folder in folders)
+    assert 'batch_associate_assessment_report_evidence' not in fake.calls
+
+
+def test_folders_holding_only_manual_evidences_are_never_retrieved(install_fakes):
+    fake = RecordingAuditManager(folders=4, evidencesPerFolder=60, bucket='reports', manualRatio=1.0)
+    install_fakes({'auditmanager': fake, 's3': fake_auditmanager.FakeS3(), 'sns': fake_auditmanager.FakeSns()})
+    assert generate(['--filter_automatic', 'True'])['exitCode'] == 0
+    assert 'get_evidence_by_evidence_folder' not in fake.calls
+    assert fake.associatedIds['assessment-0000'] == set()
+
+
+def test_compiled_predicate_checks_every_evidence_filter():
+    evidenceFilter = script.EvidenceFilter(accountIds=['111111111111'], automaticOnly=True, dataSources=['aws config'],
+        complianceStatuses=['non_compliant'])
+    evidence = {'evidenceAwsAccountId': '111111111111', 'evidenceByType': 'Compliance check', 'dataSource': 'AWS Config',
+        'complianceCheck': 'NON_COMPLIANT'}
+    assert evidenceFilter.predicate(evidence)
+    for column, value in (('evidenceAwsAccountId', '222222222222'), ('evidenceByType', 'Manual'), ('dataSource', 'AWS CloudTrail'),
+            ('complianceCheck', 'COMPLIANT')):
+        assert not evidenceFilter.predicate(dict(evidence, **{column: value}))
@@ -0,0 +1,71 @@
+# warm invocations of the lambda handler run in the same process and must reuse the clients and the assessment index
+import boto3
+import pytest
+
+import fake_auditmanager
+import script
+
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 120000
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    fakeClients = {'auditmanager': fake_auditmanager.FakeAuditManager(assessments=['first', 'second'], bucket='reports'),
+        's3': fake_auditmanager.FakeS3(), 'sns': fake_auditmanager.FakeSns()}
+    createdClients = []
+    def client(service, *args, **kwargs):
+        createdClients.append(service)
+        return fakeClients[service]
+    monkeypatch.setattr(boto3, 'client', client)
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'fake')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'fake')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    # a cold process
+    monkeypatch.setattr(script, 'awsClients', {})
+    monkeypatch.setattr(script, 'assessmentIndexes', {})
+    fakeClients['created'] = createdClients
+    return fakeClients
+
+
+def test_warm_invocations_reuse_clients_and_index(fakes):
+    first = script.lambda_handler({'name': 'first', 'filter_automatic': True, 'account_Ids': ['111111111111'], 'max_tps': 1000}, Context())
+    second = script.lambda_handler({'name': 'second', 'max_tps': 1000, 'stream_csv': True}, Context())
+    assert first['exitCode'] == 0 and second['exitCode'] == 0
+    assert [result['status'] for result in first['results'] + second['results']] == ['COMPLETE', 'COMPLETE']
+    assert sorted(fakes['created']) == ['auditmanager', 's3', 'sns']
+    # both assessments are found by the listing of the first invocation
+    assert fakes['auditmanager'].calls['list_assessments'] == 1
+    assert len(fakes['auditmanager'].reports) == 2
+
+
+def test_invalid_options_fail_the_invocation(fakes):
+    assert script.lambda_handler({'name': 'first', 'detach': True}, Context())['exitCode'] == 1
+    with pytest.raises(ValueError):
+        script.lambda_handler({'name': 'first', 'unknown_option': 1}, Context())
+    assert script.main(['--name', 'first', '--resume']) == 1
+
+
+def test_invocations_keep_their_own_settings(fakes):
+    first = script.ReportSettings(script.options_from_event({'name': 'first', 'export_format': 'jsonl', 'memory_budget': 1}))
+    second = script.ReportSettings(script.options_from_event({'name': 'second', 'max_workers': 3}))
+    try:
+        assert (first.assessmentName, first.exportFormat, first.maxWorkers) == ('first', 'jsonl', 1)
+        assert (second.assessmentName, second.exportFormat, second.maxWorkers) == ('second', 'csv', 3)
+        assert first.associationExecutor is not second.associationExecutor and first.runMetrics is not second.runMetrics
+        # the assessment index of the same cache is shared
+        assert first.assessmentIndex is second.assessmentIndex
+        run = script.ReportRun(first, 'first', first.evidenceFilter)
+        assert run.csvEvidenceSpool.memoryBudget == 1024 * 1024
+    finally:
+        first.close()
+        second.close()
+
+
+def test_evidences_are_projected_without_settings():
+    evidence = {'id': 'evidence-1', 'evidenceAwsAccountId': '111111111111', 'attributes': {'findingId': '1'}, 'time': '2024-01-02T00:00:00'}
+    assert script.EvidenceRecord.from_evidence(evidence).attributes == "{'findingId': '1'}"
+    assert script.EvidenceRecord.from_evidence(evidence, 'jsonl').attributes == '{"findingId":"1"}'
+    assert script.EvidenceRecord.from_evidence(evidence).evidenceDate == '2024-01-02'
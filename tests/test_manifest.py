@@ -0,0 +1,81 @@
+# the assessments of a manifest are reported on together, a failing assessment must not affect the others
+import json
+
+import pytest
+
+import fake_auditmanager
+import script
+
+ASSESSMENTS = ['first', 'second', 'third']
+
+
+class FailingCheckpointS3(fake_auditmanager.FakeS3):
+    """
+    S3 client rejecting the checkpoint objects of one assessment
+    """
+    def __init__(self, failingPrefix):
+        super().__init__()
+        self.failingPrefix = failingPrefix
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        if Key.startswith(self.failingPrefix):
+            raise fake_auditmanager.client_error('AccessDenied', 'PutObject', Key)
+        return super().put_object(Bucket, Key, Body, **kwargs)
+
+
+@pytest.fixture
+def fakes(install_fakes):
+    fakeClients = {'auditmanager': fake_auditmanager.FakeAuditManager(assessments=ASSESSMENTS, folders=4, evidencesPerFolder=40, bucket='reports'),
+        's3': fake_auditmanager.FakeS3(), 'sns': fake_auditmanager.FakeSns()}
+    install_fakes(fakeClients)
+    return fakeClients
+
+
+def write_manifest(tmp_path, entries):
+    path = str(tmp_path / 'manifest.json')
+    with open(path, 'w') as manifestFile:
+        json.dump(entries, manifestFile)
+    return path
+
+
+def test_failing_write_fails_only_its_assessment(tmp_path, fakes):
+    # without evidence filters the folders are associated as a whole, the checkpoint is only written once a folder completes
+    fakes['s3'] = FailingCheckpointS3('checkpoint/assessment-0001/')
+    manifest = write_manifest(tmp_path, [{'name': name} for name in ASSESSMENTS])
+    outcome = script.generate_assessment_reports(script.parse_options(['--manifest', manifest,
+        '--checkpoint', 's3://reports/checkpoint', '--max_workers', '2']))
+    results = {result['name']: result for result in outcome['results']}
+    assert outcome['exitCode'] == 1
+    assert results['second']['status'] == 'ERROR' and 'AccessDenied' in results['second']['error']
+    assert results['first']['status'] == results['third']['status'] == 'COMPLETE'
+    assert [report['assessmentId'] for report in fakes['auditmanager'].reports] == ['assessment-0000', 'assessment-0002']
+
+
+def test_manifest_reports_on_every_assessment_with_its_own_filters(tmp_path, fakes):
+    fake = fakes['auditmanager']
+    manifest = write_manifest(tmp_path, [{'name': 'first', 'filter_automatic': True, 'compliance_status': ['NON_COMPLIANT']},
+        {'name': 'unknown'}, {'name': 'third', 'sns_topic': 'arn:aws:sns:us-east-1:111111111111:third'}])
+    outcome = script.generate_assessment_reports(script.parse_options(['--manifest', manifest, '--max_workers', '3',
+        '--sns_topic', 'arn:aws:sns:us-east-1:111111111111:reports']))
+    results = {result['name']: result for result in outcome['results']}
+    # the unknown assessment fails on its own
+    assert outcome['exitCode'] == 1
+    assert results['unknown']['status'] == 'ERROR' and 'not found' in results['unknown']['error']
+    assert results['first']['status'] == results['third']['status'] == 'COMPLETE'
+    assert results['first']['assessmentId'] == 'assessment-0000' and results['third']['assessmentId'] == 'assessment-0002'
+
+    expectedIds = set(evidence['id'] for folder in fake.folders['assessment-0000']
+        for evidence in (fake.generate_evidence(folder, number) for number in range(40))
+        if evidence['evidenceByType'] != 'Manual' and evidence['complianceCheck'] == 'NON_COMPLIANT')
+    assert fake.associatedIds['assessment-0000'] == expectedIds
+    assert results['first']['metrics']['evidences_exported'] == len(expectedIds)
+    assert fake.associatedFolders['assessment-0000'] == set()
+    # the other assessments are associated folder by folder, the one not in the manifest is untouched
+    assert len(fake.associatedFolders['assessment-0002']) == 4
+    assert fake.associatedIds['assessment-0001'] == set() and fake.associatedFolders['assessment-0001'] == set()
+    assert sorted(report['assessmentId'] for report in fake.reports) == ['assessment-0000', 'assessment-0002']
+    # the summary of the manifest is published with the results of every assessment
+    summaries = [json.loads(message['Message']) for message in fakes['sns'].messages if message['Subject'].endswith(' - manifest ' + manifest)]
+    assert [[result['name'] for result in summary] for summary in summaries] == [['first', 'unknown', 'third']]
+    # the report of an assessment is published to its own topic
+    assert [message['Subject'] for message in fakes['sns'].messages if message['TopicArn'].endswith(':third')]
@@ -0,0 +1,33 @@
+# evidences spilled to disk beyond --memory_budget must produce the same csv as evidences held in memory
+FAKE_OPTIONS = ['--fake_folders', '6', '--fake_evidences', '120', '--fake_bucket', 'reports']
+
+
+def report_csv(tmp_path, name, reportId):
+    with open(str(tmp_path / 's3' / 'reports' / 'evidence_csv' / name / reportId / name)) as csvFile:
+        return csvFile.read()
+
+
+def test_spilled_csv_matches_in_memory_csv(tmp_path, run_fake):
+    filters = ['--name', 'test', '--filter_automatic', 'True', '--max_workers', '3']
+    inMemory = run_fake('memory.json', filters, FAKE_OPTIONS)
+    assert inMemory['exitCode'] == 0
+    assert 'spilling' not in inMemory['log']
+
+    # a budget of 0 spills every folder as soon as it is appended
+    spilled = run_fake('spilled.json', filters + ['--memory_budget', '0'], FAKE_OPTIONS)
+    assert spilled['exitCode'] == 0
+    assert 'spilling them to disk' in spilled['log']
+    assert report_csv(tmp_path, 'test', spilled['reports'][0]['id']) == report_csv(tmp_path, 'test', inMemory['reports'][0]['id'])
+
+
+def test_spilled_shard_is_merged_by_the_coordinator(tmp_path, run_fake):
+    single = run_fake('single.json', ['--name', 'test'], FAKE_OPTIONS)
+    shardArgs = ['--name', 'test', '--shard_count', '2', '--shard_output', 's3://reports/shards', '--run_id', 'run-1', '--memory_budget', '0']
+    for index in range(2):
+        assert run_fake('shard-{}.json'.format(index), shardArgs + ['--shard_index', str(index)], FAKE_OPTIONS)['exitCode'] == 0
+    coordinator = run_fake('coordinator.json', shardArgs + ['--coordinate'], FAKE_OPTIONS)
+    assert coordinator['exitCode'] == 0
+    singleLines = report_csv(tmp_path, 'test', single['reports'][0]['id']).splitlines()
+    coordinatorLines = report_csv(tmp_path, 'test', coordinator['reports'][0]['id']).splitlines()
+    assert coordinatorLines[0] == singleLines[0]
+    assert sorted(coordinatorLines[1:]) == sorted(singleLines[1:])
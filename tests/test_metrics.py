@@ -0,0 +1,84 @@
+# metrics emitted at the end of a run against the fake audit manager
+import cProfile
+import json
+import logging
+
+import pytest
+
+import fake_auditmanager
+import script
+
+FAKE_OPTIONS = ['--fake_folders', '6', '--fake_evidences', '1500']
+
+
+def test_run_metrics_match_the_fake(run_fake):
+    summary = run_fake('run.json', ['--name', 'test', '--filter_automatic', 'True', '--max_workers', '3', '--max_tps', '1000'], FAKE_OPTIONS)
+    assert summary['exitCode'] == 0
+    metrics = json.loads(summary['log'].split('run metrics : ', 1)[1].splitlines()[0])
+    assert metrics['run']['evidences_scanned'] == 6 * 1500
+    # two pages of at most 1000 evidences per folder
+    assert metrics['run']['pages'] == 12 == summary['calls']['get_evidence_by_evidence_folder']
+    assert metrics['run']['evidences_associated'] == len(summary['associatedIds']['assessment-0000'])
+    assert metrics['run']['evidences_scanned'] == metrics['run']['evidences_not_applicable'] + \
+        metrics['run']['evidences_filtered_out'] + metrics['run']['evidences_exported']
+    assert metrics['api']['get_evidence_by_evidence_folder']['calls'] == 12
+    assert sum(metrics['api']['get_evidence_by_evidence_folder']['latency_ms_histogram'].values()) == 12
+    assert metrics['peak_memory_mb'] > 0
+    # pages and not applicable evidences are counted instead of logged one by one
+    assert 'retrieving evidence details ...' not in summary['log']
+    assert 'removing evidences' not in summary['log']
+
+
+def test_embedded_metric_format_and_profile(run_fake):
+    summary = run_fake('run.json', ['--name', 'test', '--metrics_format', 'emf', '--profile'], FAKE_OPTIONS)
+    assert summary['exitCode'] == 0
+    documents = [json.loads(line) for line in summary['output'].splitlines() if line.startswith('{')]
+    dimensions = [document['_aws']['CloudWatchMetrics'][0]['Dimensions'][0] for document in documents]
+    assert [] in dimensions and ['Assessment'] in dimensions and ['Operation'] in dimensions
+    for document in documents:
+        for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            assert isinstance(document[metric['Name']], (int, float))
+    runDocument = documents[dimensions.index([])]
+    assert runDocument['stage_process_folders'] >= 0 and runDocument['folders_processed'] == 6
+    assert 'profile of the run' in summary['log']
+    # the sns message of the completed report carries the summary of the run
+    assert 'run summary' in summary['messages'][0]['Message']
+
+
+class ProcessWideProfile(cProfile.Profile):
+    """
+    Profiler of python 3.12 and later: only one profiler may be active in the process
+    """
+    active = []
+
+    def enable(self, *args, **kwargs):
+        if self.active:
+            raise ValueError('Another profiling tool is already active')
+        self.active.append(self)
+        super().enable(*args, **kwargs)
+
+    def disable(self):
+        if self in self.active:
+            self.active.remove(self)
+        super().disable()
+
+
+@pytest.mark.parametrize('processWide', [False, True])
+def test_profile_with_workers_and_filters(processWide, install_fakes, monkeypatch, caplog):
+    if processWide:
+        monkeypatch.setattr(script, 'PROCESS_WIDE_PROFILER', True)
+        monkeypatch.setattr(cProfile, 'Profile', ProcessWideProfile)
+    fake = fake_auditmanager.FakeAuditManager(folders=6, evidencesPerFolder=300, bucket='reports')
+    install_fakes({'auditmanager': fake, 's3': fake_auditmanager.FakeS3(), 'sns': fake_auditmanager.FakeSns()})
+    caplog.set_level(logging.INFO)
+    args = ['--name', 'test', '--profile', '--max_workers', '2', '--filter_automatic', 'True']
+    outcome = script.generate_assessment_reports(script.parse_options(args))
+    assert outcome['exitCode'] == 0 and len(fake.reports) == 1
+    assert outcome['results'][0]['metrics']['folders_processed'] == 6
+    profile = caplog.text.split('profile of the run', 1)[1]
+    assert 'generate_reports' in profile
+    if not processWide:
+        # the folders processed by the worker threads are part of the profile, a process wide profiler simulated
+        # before python 3.12 does not see the worker threads
+        assert 'stream_evidences_to_report' in profile
+    assert ProcessWideProfile.active == []
@@ -0,0 +1,51 @@
+# the plan is made from the folder metadata only and the run made from it follows the planned associations and workers
+import json
+
+FAKE_OPTIONS = ['--fake_folders', '8', '--fake_evidences', '1500', '--fake_bucket', 'reports']
+
+
+def test_plan_retrieves_no_evidences_and_drives_the_run(tmp_path, run_fake):
+    filters = ['--name', 'test', '--filter_automatic', 'True', '--max_tps', '1000']
+    planPath = str(tmp_path / 'plan.json')
+    planned = run_fake('planned.json', filters + ['--plan', '--plan_output', planPath], FAKE_OPTIONS)
+    assert planned['exitCode'] == 0
+    assert planned['reports'] == []
+    assert 'get_evidence_by_evidence_folder' not in planned['calls']
+    with open(planPath) as planFile:
+        plan = json.load(planFile)
+    assert plan['folders'] == 8 and plan['evidences'] == 8 * 1500
+    # 1500 evidences take two pages, manual evidences are left out so every folder is associated in batches
+    assert plan['calls']['get_evidence_by_evidence_folder'] == 16
+    assert {folder['association'] for folder in plan['assessments'][0]['folders']} == {'batches'}
+    assert 1 < plan['maxWorkers'] <= 8
+
+    fromPlan = run_fake('run.json', filters + ['--from_plan', planPath], FAKE_OPTIONS)
+    assert fromPlan['exitCode'] == 0
+    assert len(fromPlan['reports']) == 1
+    assert fromPlan['calls']['get_evidence_folders_by_assessment'] == 1
+    assert fromPlan['calls']['get_evidence_by_evidence_folder'] == plan['calls']['get_evidence_by_evidence_folder']
+    # not applicable evidences are only known once retrieved, the plan is an upper bound
+    assert fromPlan['calls']['batch_associate_assessment_report_evidence'] <= plan['calls']['batch_associate_assessment_report_evidence']
+    assert "with {} workers".format(plan['maxWorkers']) in fromPlan['log']
+
+
+def test_plan_of_other_filters_is_not_followed(tmp_path, run_fake):
+    planPath = str(tmp_path / 'plan.json')
+    assert run_fake('planned.json', ['--name', 'test', '--plan', '--plan_output', planPath], FAKE_OPTIONS)['exitCode'] == 0
+    fromPlan = run_fake('run.json', ['--name', 'test', '--filter_automatic', 'True', '--from_plan', planPath, '--max_tps', '1000'], FAKE_OPTIONS)
+    assert fromPlan['exitCode'] == 0
+    assert fromPlan['calls']['get_evidence_folders_by_assessment'] == 1
+    assert 'was made for other filters' in fromPlan['log']
+
+
+def test_run_from_plan_processes_folders_collected_since_the_plan(tmp_path, run_fake):
+    filters = ['--name', 'test', '--filter_automatic', 'True', '--max_tps', '1000']
+    planPath = str(tmp_path / 'plan.json')
+    assert run_fake('planned.json', filters + ['--plan', '--plan_output', planPath], FAKE_OPTIONS)['exitCode'] == 0
+    fromPlan = run_fake('run.json', filters + ['--from_plan', planPath], ['--fake_folders', '10', '--fake_evidences', '1500', '--fake_bucket', 'reports'])
+    assert fromPlan['exitCode'] == 0
+    # the 2 folders collected since the plan are processed as well
+    assert fromPlan['calls']['get_evidence_by_evidence_folder'] == 10 * 2
+    assert '2 folders collected since the plan are not planned' in fromPlan['log']
+    full = run_fake('full.json', filters, ['--fake_folders', '10', '--fake_evidences', '1500', '--fake_bucket', 'reports'])
+    assert fromPlan['associatedIds'] == full['associatedIds']
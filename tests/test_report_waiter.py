@@ -0,0 +1,100 @@
+# reports are waited for with one listing per poll, backing off up to the deadline, or recorded as pending and completed later
+import json
+import os
+
+import pytest
+
+import fake_auditmanager
+import script
+
+
+class Clock:
+    """
+    Monotonic clock advanced by the sleeps of the waiter
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(script.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(script.time, 'sleep', clock.sleep)
+    # the longest delay of every jittered range
+    monkeypatch.setattr(script.random, 'uniform', lambda low, high: high)
+    return clock
+
+
+def create_reports(fake, count):
+    return [fake.create_assessment_report(name='report', assessmentId='assessment-0000')['assessmentReport']['id'] for _ in range(count)]
+
+
+def test_waiter_backs_off_exponentially_up_to_the_maximum_delay(clock):
+    fake = fake_auditmanager.FakeAuditManager(folders=0, reportPolls=7)
+    reportIds = create_reports(fake, 3)
+    statuses = script.wait_for_assessment_reports(fake, reportIds, 1000, initialDelay=5, maxDelay=30)
+    assert statuses == {reportId: 'COMPLETE' for reportId in reportIds}
+    assert clock.sleeps == [5, 10, 20, 30, 30, 30]
+    # every poll looks up all the reports with a single listing
+    assert fake.calls['list_assessment_reports'] == 7
+
+
+def test_waiter_stops_at_the_deadline(clock):
+    fake = fake_auditmanager.FakeAuditManager(folders=0, reportPolls=100)
+    reportIds = create_reports(fake, 2)
+    assert script.wait_for_assessment_reports(fake, reportIds, 42, initialDelay=5, maxDelay=30) == {}
+    # the last delay is cut short by the deadline
+    assert clock.sleeps == [5, 10, 20, 7]
+    assert clock.now == 42
+
+
+def test_waiter_returns_failed_reports(clock):
+    fake = fake_auditmanager.FakeAuditManager(folders=0, reportPolls=1, failReports=True)
+    reportId = create_reports(fake, 1)[0]
+    assert script.wait_for_assessment_report(fake, reportId, 60) == 'FAILED'
+    assert clock.sleeps == []
+
+
+def test_detached_report_is_completed_by_a_later_invocation(tmp_path, install_fakes):
+    fake = fake_auditmanager.FakeAuditManager(folders=2, evidencesPerFolder=40, bucket='reports', reportPolls=2)
+    fakeSns = fake_auditmanager.FakeSns()
+    install_fakes({'auditmanager': fake, 's3': fake_auditmanager.FakeS3(), 'sns': fakeSns})
+    pendingArgs = ['--pending_reports', str(tmp_path / 'pending')]
+    topic = 'arn:aws:sns:us-east-1:111111111111:reports'
+    outcome = script.generate_assessment_reports(script.parse_options(['--name', 'test', '--detach', '--sns_topic', topic] + pendingArgs))
+    assert outcome['exitCode'] == 0 and outcome['results'][0]['status'] == 'PENDING'
+    # a detached run does not wait for its report
+    assert 'list_assessment_reports' not in fake.calls
+    reportId = fake.reports[0]['id']
+    with open(str(tmp_path / 'pending' / (reportId + '.json'))) as pendingFile:
+        assert json.load(pendingFile)['snsTopic'] == topic
+
+    # the first invocation finds the report still in progress and keeps it
+    assert script.generate_assessment_reports(script.parse_options(['--complete_pending'] + pendingArgs))['exitCode'] == 0
+    assert os.listdir(str(tmp_path / 'pending')) == [reportId + '.json']
+    assert 'get_assessment_report_url' not in fake.calls
+    assert script.generate_assessment_reports(script.parse_options(['--complete_pending'] + pendingArgs))['exitCode'] == 0
+    assert os.listdir(str(tmp_path / 'pending')) == []
+    assert fake.calls['get_assessment_report_url'] == 1
+    assert [message['TopicArn'] for message in fakeSns.messages] == [topic]
+
+
+def test_report_not_complete_by_the_timeout_is_recorded_as_pending(tmp_path, install_fakes, clock):
+    fake = fake_auditmanager.FakeAuditManager(folders=2, evidencesPerFolder=40, bucket='reports', reportPolls=100)
+    install_fakes({'auditmanager': fake, 's3': fake_auditmanager.FakeS3(), 'sns': fake_auditmanager.FakeSns()})
+    outcome = script.generate_assessment_reports(script.parse_options(['--name', 'test', '--report_timeout', '60', '--max_tps', '1000',
+        '--pending_reports', str(tmp_path / 'pending')]))
+    assert outcome['exitCode'] == 0 and outcome['results'][0]['status'] == 'PENDING'
+    # polled after 0, 5, 15, 35 and 60 seconds
+    assert clock.now == pytest.approx(60, abs=0.1)
+    assert fake.calls['list_assessment_reports'] == 5
+    assert os.listdir(str(tmp_path / 'pending')) == [fake.reports[0]['id'] + '.json']
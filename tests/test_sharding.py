@@ -0,0 +1,37 @@
+# runs the shards of an assessment as separate processes against the fake audit manager,
+# the coordinator must produce the same report evidences as a single unsharded run
+FAKE_OPTIONS = ['--fake_folders', '12', '--fake_evidences', '90', '--fake_bucket', 'reports']
+
+
+def report_csv_lines(tmp_path, name, reportId):
+    with open(str(tmp_path / 's3' / 'reports' / 'evidence_csv' / name / reportId / name)) as csvFile:
+        lines = csvFile.read().splitlines()
+    return lines[0], sorted(lines[1:])
+
+
+def test_sharded_run_matches_single_run(tmp_path, run_fake):
+    filters = ['--name', 'test', '--filter_automatic', 'True', '--account_Ids', '111111111111']
+    single = run_fake('single.json', filters, FAKE_OPTIONS)
+    assert single['exitCode'] == 0
+    singleCsv = report_csv_lines(tmp_path, 'test', single['reports'][0]['id'])
+
+    shardArgs = filters + ['--shard_count', '3', '--shard_output', 's3://reports/shards', '--run_id', 'run-1']
+    shards = [run_fake('shard-{}.json'.format(index), shardArgs + ['--shard_index', str(index)], FAKE_OPTIONS) for index in range(3)]
+    shardIds = [set(shard['associatedIds']['assessment-0000']) for shard in shards]
+    assert all(shard['exitCode'] == 0 and not shard['reports'] for shard in shards)
+    # every evidence is associated by exactly one shard
+    assert sum(len(ids) for ids in shardIds) == len(set.union(*shardIds))
+    assert set.union(*shardIds) == set(single['associatedIds']['assessment-0000'])
+
+    coordinator = run_fake('coordinator.json', shardArgs + ['--coordinate'], FAKE_OPTIONS)
+    assert coordinator['exitCode'] == 0
+    assert coordinator['calls'].get('get_evidence_by_evidence_folder') is None
+    assert report_csv_lines(tmp_path, 'test', coordinator['reports'][0]['id']) == singleCsv
+
+
+def test_coordinator_fails_without_all_shards(tmp_path, run_fake):
+    shardArgs = ['--name', 'test', '--shard_count', '2', '--shard_output', str(tmp_path / 'shards'), '--run_id', 'run-2']
+    assert run_fake('shard-0.json', shardArgs + ['--shard_index', '0'], FAKE_OPTIONS)['exitCode'] == 0
+    coordinator = run_fake('coordinator.json', shardArgs + ['--coordinate'], FAKE_OPTIONS)
+    assert coordinator['exitCode'] == 1
+    assert coordinator['reports'] == []
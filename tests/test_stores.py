@@ -0,0 +1,69 @@
+# the local and s3 stores shared by the pending reports, checkpoints, sync states and shard outputs behave the same
+import io
+
+import pytest
+
+import fake_auditmanager
+import script
+
+
+@pytest.fixture(params=['local', 's3'])
+def store(request, tmp_path):
+    if request.param == 'local':
+        return script.LocalStore(str(tmp_path / 'store'))
+    return script.S3Store(fake_auditmanager.FakeS3(), 'bucket', '/prefix/')
+
+
+def test_store_round_trip(store):
+    assert store.read('missing.json') is None and store.open('missing.json') is None
+    store.write('a/one.json', b'{"one": 1}')
+    store.write('a/two.csv', io.BytesIO(b'x,y\n'), 'text/csv')
+    store.write('b.json', b'{}')
+    assert store.list() == ['a/one.json', 'a/two.csv', 'b.json']
+    assert store.list('a/') == ['a/one.json', 'a/two.csv']
+    assert store.read('a/one.json') == b'{"one": 1}'
+    with store.open('a/two.csv') as objectFile:
+        assert objectFile.read() == b'x,y\n'
+    store.delete('a/one.json')
+    store.delete('a/one.json')
+    assert store.list() == ['a/two.csv', 'b.json']
+
+
+def test_locations_are_split_into_bucket_and_key(tmp_path):
+    assert script.split_s3_location('s3://bucket/some/key.json') == ('bucket', 'some/key.json')
+    assert script.split_s3_location('s3://bucket') == ('bucket', '')
+    path = str(tmp_path / 'index' / 'cache.json')
+    assert script.read_location(path) is None
+    script.write_location(path, b'{"cached": true}')
+    assert script.read_location(path) == b'{"cached": true}'
+
+
+def test_checkpoint_compacts_the_batches_of_completed_folders(store):
+    checkpoint = script.CheckpointStore(store)
+    checkpoint.record_batch('assessment-folder-1', ['e1', 'e2'])
+    checkpoint.record_batch('assessment-folder-1', ['e3'])
+    checkpoint.record_batch('assessment-folder-2', ['e4'])
+    checkpoint.record_folder('assessment-folder-1', [{'id': 'e1'}])
+    checkpoint.record_report('report-1')
+    names = store.list()
+    assert len(names) == 3 and 'folder-assessment-folder-1.json' in names and 'report.json' in names
+    state = script.CheckpointState(script.CheckpointStore(store).load())
+    assert state.completedFolders == {'assessment-folder-1': [{'id': 'e1'}]}
+    assert state.associatedIds == {'assessment-folder-2': {'e4'}}
+    assert state.reportId == 'report-1'
+
+
+def test_checkpoint_skips_batches_left_behind_by_completed_folders(store):
+    script.CheckpointStore(store, compactBatches=False).record_batch('assessment-folder-1', ['e1'])
+    script.CheckpointStore(store).record_folder('assessment-folder-1', [])
+    state = script.CheckpointState(script.CheckpointStore(store).load())
+    assert state.completedFolders == {'assessment-folder-1': []} and state.associatedIds == {}
+    assert store.list() == ['folder-assessment-folder-1.json']
+
+
+def test_checkpoint_keeps_the_batches_when_not_compacting(store):
+    checkpoint = script.CheckpointStore(store, compactBatches=False)
+    checkpoint.record_batch('assessment-folder-1', ['e1'])
+    checkpoint.record_folder('assessment-folder-1', [])
+    state = script.CheckpointState(script.CheckpointStore(store, compactBatches=False).load())
+    assert state.associatedIds == {'assessment-folder-1': {'e1'}}
@@ -0,0 +1,153 @@
+# the multipart writer and the streamed csv against a stub s3 client recording the calls, and the release of the streams
+# and temporary files of failed runs
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+
+import pytest
+
+import fake_auditmanager
+import script
+
+MIB = 1024 * 1024
+
+
+class StubS3:
+    def __init__(self):
+        self.calls = []
+        self.parts = {}
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls.append(('create_multipart_upload', kwargs))
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, **kwargs):
+        self.calls.append(('upload_part', {key: value for key, value in kwargs.items() if key != 'Body'}))
+        self.parts[kwargs['PartNumber']] = kwargs['Body']
+        return {'ETag': 'etag-{}'.format(kwargs['PartNumber'])}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.calls.append(('complete_multipart_upload', kwargs))
+
+    def abort_multipart_upload(self, **kwargs):
+        self.calls.append(('abort_multipart_upload', kwargs))
+
+    def operations(self):
+        return [name for name, _ in self.calls]
+
+    def body(self):
+        return b''.join(self.parts[number] for number in sorted(self.parts))
+
+
+def evidence_record(number):
+    return script.EvidenceRecord.from_row(['AWS Config', '111111111111', 'config.amazonaws.com', 'rule', 'Compliance check',
+        "[{'arn': 'arn:aws:s3:::bucket'}]", "{'findingId': '" + str(number) + "'}", 'COMPLIANT', 'folder-1', 'evidence-{:06d}'.format(number)])
+
+
+def test_writer_splits_parts_at_the_minimum_part_size():
+    s3 = StubS3()
+    # parts smaller than 5 MiB are rejected by s3, the part size is raised to the minimum
+    writer = script.S3MultipartWriter(s3, 'bucket', 'key', 1 * MIB)
+    for _ in range(12):
+        writer.write(b'x' * MIB)
+    assert [len(s3.parts[number]) for number in sorted(s3.parts)] == [5 * MIB, 5 * MIB]
+    writer.close()
+    assert [len(s3.parts[number]) for number in sorted(s3.parts)] == [5 * MIB, 5 * MIB, 2 * MIB]
+    assert s3.calls[-1] == ('complete_multipart_upload', {'Bucket': 'bucket', 'Key': 'key', 'UploadId': 'upload-1',
+        'MultipartUpload': {'Parts': [{'ETag': 'etag-1', 'PartNumber': 1}, {'ETag': 'etag-2', 'PartNumber': 2},
+            {'ETag': 'etag-3', 'PartNumber': 3}]}})
+
+
+def test_writer_uploads_an_empty_part_when_closed_without_data():
+    s3 = StubS3()
+    script.S3MultipartWriter(s3, 'bucket', 'key', 5 * MIB).close()
+    assert s3.operations() == ['create_multipart_upload', 'upload_part', 'complete_multipart_upload']
+    assert s3.parts == {1: b''}
+
+
+def test_streamed_csv_is_gzip_compressed():
+    s3 = StubS3()
+    stream = script.StreamingEvidenceCsv(s3, 'bucket', 'key', 5 * MIB, compress=True)
+    stream.write_evidences([evidence_record(number) for number in range(3)])
+    stream.write_evidences([evidence_record(3)])
+    stream.close()
+    assert s3.calls[0][1]['ContentEncoding'] == 'gzip'
+    rows = list(csv.reader(io.StringIO(gzip.decompress(s3.body()).decode('utf-8'))))
+    assert rows[0] == script.CSV_EVIDENCE_HEADER
+    assert [row[-1] for row in rows[1:]] == ['evidence-{:06d}'.format(number) for number in range(4)]
+    assert stream.rowCount == 4
+
+
+def test_streamed_csv_without_compression_matches_the_compiled_csv():
+    s3 = StubS3()
+    records = [evidence_record(number) for number in range(5)]
+    stream = script.StreamingEvidenceCsv(s3, 'bucket', 'key', 5 * MIB)
+    stream.write_evidences(records)
+    stream.close()
+    assert 'ContentEncoding' not in s3.calls[0][1]
+    assert s3.body().decode('utf-8') == script.compile_evidence_csv(records).getvalue()
+
+
+def test_aborted_stream_is_never_completed():
+    s3 = StubS3()
+    stream = script.StreamingEvidenceCsv(s3, 'bucket', 'key', 5 * MIB, compress=True)
+    stream.write_evidences([evidence_record(0)])
+    stream.abort()
+    assert s3.operations() == ['create_multipart_upload', 'abort_multipart_upload']
+    assert s3.calls[-1][1] == {'Bucket': 'bucket', 'Key': 'key', 'UploadId': 'upload-1'}
+
+
+class FailingUploadS3(fake_auditmanager.FakeS3):
+    """
+    S3 client failing the multipart uploads of one assessment
+    """
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        if Key.startswith('evidence_csv/first/'):
+            raise fake_auditmanager.client_error('InternalError', 'UploadPart')
+        return super().upload_part(Bucket, Key, UploadId, PartNumber, Body, **kwargs)
+
+
+@pytest.fixture
+def fakes(install_fakes, monkeypatch, tmp_path):
+    fakeClients = {'auditmanager': fake_auditmanager.FakeAuditManager(assessments=['first', 'second'], folders=3, evidencesPerFolder=40,
+        bucket='reports'), 's3': FailingUploadS3(), 'sns': fake_auditmanager.FakeSns()}
+    install_fakes(fakeClients)
+    # the temporary directories of the runs are created here
+    (tmp_path / 'tmp').mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / 'tmp'))
+    return fakeClients
+
+
+def generate_reports(tmp_path, args):
+    manifest = str(tmp_path / 'manifest.json')
+    with open(manifest, 'w') as manifestFile:
+        json.dump([{'name': 'first'}, {'name': 'second'}], manifestFile)
+    return script.generate_assessment_reports(script.parse_options(['--manifest', manifest, '--filter_automatic', 'True'] + args))
+
+
+def test_failing_upload_part_aborts_the_stream(tmp_path, fakes):
+    outcome = generate_reports(tmp_path, ['--stream_csv'])
+    results = {result['name']: result for result in outcome['results']}
+    assert results['first']['status'] == 'ERROR' and 'InternalError' in results['first']['error']
+    assert results['second']['status'] == 'COMPLETE'
+    assert fakes['s3'].uploads == {}
+
+
+@pytest.mark.parametrize('args', [['--stream_csv'], ['--export_format', 'jsonl'], ['--memory_budget', '0']])
+def test_unexpected_failure_releases_streams_and_temporary_files(tmp_path, fakes, monkeypatch, args):
+    processedRuns = []
+    def fail_processing(settings, runs):
+        for run in runs:
+            script.append_csv_evidences(run, [evidence_record(number) for number in range(10)])
+        processedRuns.extend(runs)
+        raise RuntimeError('interrupted')
+    monkeypatch.setattr(script, 'process_evidence_folders', fail_processing)
+    outcome = generate_reports(tmp_path, args)
+    assert outcome['exitCode'] == 1
+    assert len(processedRuns) == 2
+    assert all(run.csvEvidenceSpool.spillFile is None and run.evidenceJsonl is None for run in processedRuns)
+    assert fakes['s3'].uploads == {}
+    assert os.listdir(str(tmp_path / 'tmp')) == []
@@ -0,0 +1,133 @@
+# a sync must only retrieve the folders collected since the last sync and only (dis)associate the evidences which changed
+import csv
+import datetime
+import io
+import json
+
+import pytest
+
+import fake_auditmanager
+import script
+from test_checkpoint import KilledAuditManager
+
+# 3 controls collect a folder every day, 9 folders are 3 days and 15 folders 5 days of the same assessment
+FAKE_OPTIONS = ['--fake_controls', '3', '--fake_evidences', '40', '--fake_bucket', 'reports']
+FILTERS = ['--name', 'test', '--filter_automatic', 'True', '--max_workers', '2']
+
+
+def exported_rows(tmp_path, result):
+    with open(str(tmp_path / 's3' / 'reports' / 'evidence_csv' / 'test' / result['reports'][0]['id'] / 'test'), newline='') as csvFile:
+        return sorted(tuple(row) for row in csv.reader(csvFile))
+
+
+def test_sync_retrieves_and_associates_only_new_folders(tmp_path, run_fake):
+    syncArgs = FILTERS + ['--sync', 's3://reports/sync']
+    first = run_fake('first.json', syncArgs, FAKE_OPTIONS + ['--fake_folders', '9'])
+    assert first['exitCode'] == 0
+    assert first['calls']['get_evidence_by_evidence_folder'] == 9
+
+    second = run_fake('second.json', syncArgs, FAKE_OPTIONS + ['--fake_folders', '15'])
+    assert second['exitCode'] == 0
+    # the folders of the watermark day and the 2 new days are retrieved, the 2 days before are restored
+    assert second['calls']['get_evidence_by_evidence_folder'] == 9
+    assert 'batch_disassociate_assessment_report_evidence' not in second['calls']
+
+    full = run_fake('full.json', FILTERS, FAKE_OPTIONS + ['--fake_folders', '15'])
+    fullIds = set(full['associatedIds']['assessment-0000'])
+    firstIds = set(first['associatedIds']['assessment-0000'])
+    secondIds = set(second['associatedIds']['assessment-0000'])
+    # evidences associated by the first sync are not associated again
+    assert not firstIds & secondIds
+    assert firstIds | secondIds == fullIds
+    assert exported_rows(tmp_path, second) == exported_rows(tmp_path, full)
+
+
+def test_sync_with_other_filters_disassociates_the_difference(tmp_path, run_fake):
+    syncArgs = FILTERS + ['--sync', str(tmp_path / 'sync')]
+    first = run_fake('first.json', syncArgs, FAKE_OPTIONS + ['--fake_folders', '9'])
+    assert first['exitCode'] == 0
+
+    narrowed = run_fake('narrowed.json', syncArgs + ['--compliance_status', 'NON_COMPLIANT'], FAKE_OPTIONS + ['--fake_folders', '9'])
+    assert narrowed['exitCode'] == 0
+    # other filters retrieve every folder again, but nothing is associated twice
+    assert narrowed['calls']['get_evidence_by_evidence_folder'] == 9
+    assert narrowed['associatedIds']['assessment-0000'] == []
+    exportedIds = set(row[-1] for row in exported_rows(tmp_path, narrowed) if row[-1] != 'id')
+    assert exportedIds < set(first['associatedIds']['assessment-0000'])
+    assert set(narrowed['disassociatedIds']['assessment-0000']) == set(first['associatedIds']['assessment-0000']) - exportedIds
+
+    latest = run_fake('latest.json', syncArgs + ['--compliance_status', 'NON_COMPLIANT', '--filter_latest', 'True'],
+        FAKE_OPTIONS + ['--fake_folders', '9'])
+    assert latest['exitCode'] == 0
+    # the folders of the days before the latest one are disassociated as a whole
+    assert latest['calls']['get_evidence_by_evidence_folder'] == 3
+    assert len(latest['disassociatedFolders']['assessment-0000']) == 6
+
+
+def test_sync_cannot_be_combined_with_dedup(run_fake):
+    result = run_fake('rejected.json', FILTERS + ['--sync', 'sync', '--dedup', 'latest'], FAKE_OPTIONS + ['--fake_folders', '9'])
+    assert result['exitCode'] == 1
+    assert result['reports'] == []
+
+
+def test_sync_state_keeps_only_the_ids_in_memory():
+    def row(evidenceId):
+        return ['AWS Config', '111111111111', '', '', 'Compliance check', '', '', 'COMPLIANT', 'folder', evidenceId, '', '', '']
+
+    lines = [{'watermark': '2024-01-03', 'signature': 'filters'},
+        {'folderId': 'folder-1', 'date': '2024-01-01', 'rows': [row('e1'), row('e2')]},
+        {'folderId': 'folder-2', 'date': '2024-01-02', 'rows': [row('e3')]},
+        {'folderId': 'folder-3', 'date': '2024-01-03', 'rows': [row('e4')]}]
+    state = script.SyncState('assessment', 'filters')
+    state.load(io.BytesIO('\n'.join(json.dumps(line) for line in lines).encode('utf-8')))
+    assert state.associatedIds == {'folder-1': {'e1', 'e2'}, 'folder-2': {'e3'}, 'folder-3': {'e4'}}
+    folders = [{'id': folderId, 'date': datetime.datetime(2024, 1, day)} for folderId, day in (('folder-2', 2), ('folder-3', 3))]
+    # the folders of the watermark day are retrieved again
+    assert state.select(folders) == 1
+    assert state.removedFolders == {'folder-1'}
+    assert [restored[-4] for restored in state.restore('folder-2')] == ['e3']
+    assert 'folder-2' not in state.unchangedFolders
+    state.close()
+
+
+def non_compliant_ids(fake, evidencesPerFolder):
+    return set(evidence['id'] for folder in fake.folders['assessment-0000']
+        for evidence in (fake.generate_evidence(folder, number) for number in range(evidencesPerFolder)) if evidence['complianceCheck'] == 'NON_COMPLIANT')
+
+
+def test_sync_with_filters_disassociates_folders_associated_as_a_whole(tmp_path, install_fakes):
+    fake = fake_auditmanager.FakeAuditManager(folders=6, evidencesPerFolder=40, controls=3, bucket='reports')
+    install_fakes({'auditmanager': fake, 's3': fake_auditmanager.FakeS3(), 'sns': fake_auditmanager.FakeSns()})
+    syncArgs = ['--name', 'test', '--max_workers', '2', '--sync', str(tmp_path / 'sync')]
+    assert script.generate_assessment_reports(script.parse_options(syncArgs))['exitCode'] == 0
+    # the folder level associations include the not applicable evidences, which are not exported
+    assert len(fake.associatedFolders['assessment-0000']) == 6
+    assert len(fake.associatedIds['assessment-0000']) == 6 * 40
+
+    assert script.generate_assessment_reports(script.parse_options(syncArgs + ['--compliance_status', 'NON_COMPLIANT']))['exitCode'] == 0
+    expectedIds = non_compliant_ids(fake, 40)
+    assert fake.associatedFolders['assessment-0000'] == set()
+    assert expectedIds and fake.associatedIds['assessment-0000'] == expectedIds
+
+
+def test_killed_sync_with_filters_resumes_without_disassociating_folders_again(tmp_path, install_fakes):
+    fake = KilledAuditManager(None, folders=6, evidencesPerFolder=150, controls=3, bucket='reports')
+    install_fakes({'auditmanager': fake, 's3': fake_auditmanager.FakeS3(), 'sns': fake_auditmanager.FakeSns()})
+    syncArgs = ['--name', 'test', '--max_workers', '2', '--sync', str(tmp_path / 'sync')]
+    assert script.generate_assessment_reports(script.parse_options(syncArgs))['exitCode'] == 0
+
+    fake.killAfterBatches = 3
+    filteredArgs = syncArgs + ['--compliance_status', 'NON_COMPLIANT', '--checkpoint', str(tmp_path / 'checkpoint'), '--run_id', 'run-1']
+    with pytest.raises(KeyboardInterrupt):
+        script.generate_assessment_reports(script.parse_options(filteredArgs))
+    disassociatedFolders = fake.calls['disassociate_assessment_report_evidence_folder']
+    assert disassociatedFolders and fake.associationCounts
+
+    fake.killAfterBatches = None
+    assert script.generate_assessment_reports(script.parse_options(filteredArgs + ['--resume']))['exitCode'] == 0
+    # every folder is disassociated once, the evidences the killed attempt associated again are kept
+    assert fake.calls['disassociate_assessment_report_evidence_folder'] == 6
+    expectedIds = non_compliant_ids(fake, 150)
+    assert fake.associatedFolders['assessment-0000'] == set()
+    assert fake.associatedIds['assessment-0000'] == expectedIds
+    assert set(fake.associationCounts) == expectedIds and max(fake.associationCounts.values()) == 1
@@ -0,0 +1,39 @@
+# a folder whose evidences all match the filters is associated with a single folder level call
+import fake_auditmanager
+import script
+
+MATCH_ALL = ['--compliance_status', 'COMPLIANT,NON_COMPLIANT', '--data_sources', 'AWS Config']
+
+
+def generate(install_fakes, fake, args):
+    install_fakes({'auditmanager': fake, 's3': fake_auditmanager.FakeS3(), 'sns': fake_auditmanager.FakeSns()})
+    return script.generate_assessment_reports(script.parse_options(['--name', 'test', '--max_workers', '2'] + args))
+
+
+def test_fully_matching_folder_is_associated_as_a_whole(install_fakes):
+    fake = fake_auditmanager.FakeAuditManager(folders=1, evidencesPerFolder=120, bucket='reports', notApplicableRatio=0)
+    outcome = generate(install_fakes, fake, MATCH_ALL)
+    assert outcome['exitCode'] == 0
+    assert fake.calls['associate_assessment_report_evidence_folder'] == 1
+    assert 'batch_associate_assessment_report_evidence' not in fake.calls
+    assert len(fake.associatedIds['assessment-0000']) == 120
+    assert outcome['results'][0]['metrics']['evidences_exported'] == 120
+
+
+def test_not_applicable_evidences_keep_the_folder_in_batches(install_fakes):
+    # a folder level association would include the not applicable evidences
+    fake = fake_auditmanager.FakeAuditManager(folders=1, evidencesPerFolder=120, bucket='reports')
+    assert generate(install_fakes, fake, MATCH_ALL)['exitCode'] == 0
+    assert 'associate_assessment_report_evidence_folder' not in fake.calls
+    assert fake.calls['batch_associate_assessment_report_evidence'] == 3
+    evidences = [fake.generate_evidence(fake.folders['assessment-0000'][0], number) for number in range(120)]
+    assert fake.associatedIds['assessment-0000'] == set(evidence['id'] for evidence in evidences if evidence['complianceCheck'] != 'NOT_APPLICABLE')
+
+
+def test_folder_larger_than_the_limit_is_associated_in_batches(install_fakes, monkeypatch):
+    monkeypatch.setattr(script, 'MAX_WHOLE_FOLDER_EVIDENCES', 60)
+    fake = fake_auditmanager.FakeAuditManager(folders=1, evidencesPerFolder=120, bucket='reports', notApplicableRatio=0)
+    assert generate(install_fakes, fake, MATCH_ALL)['exitCode'] == 0
+    assert 'associate_assessment_report_evidence_folder' not in fake.calls
+    assert fake.calls['batch_associate_assessment_report_evidence'] == 3
+    assert len(fake.associatedIds['assessment-0000']) == 120